@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+# Benchmark of startup time and peak memory (RSS) of the sampler, each measured in a fresh Python process:
+#   - 'python main.py --help'               (argument parsing only)
+#   - 'import helper_functions'             (analysis/plotting helpers, heavy libraries are imported lazily)
+#   - 'import model'                        (sampler runtime dependencies: numpy, scipy, numba)
+#   - constructing a MultinomialSBM         (imports + loading a synthetic dataset + initialization)
+#
+# Usage: python benchmark_startup.py [--repeats 5] [--N 100] [--main_dir DIR]
+# If no main_dir is given, a random synthetic dataset of N nodes is written to a temporary folder.
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+construct_code = '''
+import sys
+sys.path.insert(0, {repo_dir!r})
+from main import get_parser
+from model import MultinomialSBM
+config = get_parser().parse_args(['--dataset', 'synthetic', '--main_dir', {main_dir!r}, '--noc', '10'])
+model = MultinomialSBM(config)
+'''
+
+
+def run_measured(cmd):
+    # run command in a new process and return wall time (sec) and peak RSS (MB) of that process
+    t0 = time.time()
+    p = subprocess.Popen(cmd, cwd=repo_dir, stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(p.pid, 0)
+    elapsed = time.time() - t0
+    p.returncode = os.waitstatus_to_exitcode(status)
+    if p.returncode != 0:
+        raise RuntimeError('command failed: ' + ' '.join(cmd))
+    maxrss = rusage.ru_maxrss / 1024**2 if sys.platform == 'darwin' else rusage.ru_maxrss / 1024
+    return elapsed, maxrss
+
+
+def write_syndata(main_dir, N, S=10):
+    # random symmetric binary graphs with the filename main.py expects for the default synthetic configuration
+    data_path = os.path.join(main_dir, 'data', 'synthetic')
+    os.makedirs(data_path, exist_ok=True)
+    rng = np.random.default_rng(0)
+    A = np.triu(rng.random((N, N, S)) < 0.2, 1).astype(float)
+    A = A + A.transpose(1, 0, 2)
+    np.save(os.path.join(data_path, 'A_5_5_5_unbalanced_0.npy'), A)
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        main_dir = args.main_dir
+        if main_dir is None:
+            main_dir = tmp_dir
+            write_syndata(main_dir, args.N)
+        benchmarks = {'main.py --help': [sys.executable, 'main.py', '--help'],
+                      'import helper_functions': [sys.executable, '-c', 'import helper_functions'],
+                      'import model': [sys.executable, '-c', 'import model'],
+                      'construct MultinomialSBM': [sys.executable, '-c', construct_code.format(repo_dir=repo_dir, main_dir=main_dir)]}
+
+        print('{:<26} | {:>12} | {:>12} | {:>12}'.format('benchmark', 'min time (s)', 'mean time (s)', 'peak RSS (MB)'))
+        print('---------------------------+--------------+--------------+--------------')
+        for name, cmd in benchmarks.items():
+            run_measured(cmd) # warm-up (file system cache, numba cache)
+            results = np.array([run_measured(cmd) for _ in range(args.repeats)])
+            print(f"{name:<26} | {results[:,0].min():12.3f} | {results[:,0].mean():12.3f} | {results[:,1].max():12.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', type=int, default=5, help='number of repeated measurements per benchmark')
+    parser.add_argument('--N', type=int, default=100, help='number of nodes in generated synthetic dataset')
+    parser.add_argument('--main_dir', type=str, default=None, help='main directory with data folder (default: generate temporary synthetic dataset)')
+    main(parser.parse_args())
@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+# Thread scaling benchmark of the sampler's parallel kernels for 1 to N threads:
+#   - spmatmul:     numba sparse x dense product A @ Z.T (used in compute_n_link for hcp data)
+#   - n_link:       full sufficient statistic Z @ A @ Z.T for all subjects (numba + BLAS)
+# on random sparse symmetric graphs with the given number of nodes, average degree and number of clusters.
+#
+# Usage: python benchmark_threads.py [--N 59412] [--degree 100] [--S 10] [--noc 50] [--max_threads 8]
+
+
+def random_graph(N, degree, rng):
+    from scipy.sparse import random as sprandom, triu
+    A = sprandom(N, N, density=degree/N/2, format='csr', random_state=rng, data_rvs=np.ones, dtype=np.int32)
+    A = triu(A, 1)
+    return (A + A.T).tocsr()
+
+
+def main(args):
+    max_threads = args.max_threads
+    os.environ['NUMBA_NUM_THREADS'] = str(max_threads) # size numba's thread pool before it is imported
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import numba
+    from threadpoolctl import threadpool_limits
+    from model import spdenmatmul
+    from run_utils import parallelism_info
+
+    rng = np.random.default_rng(0)
+    A = [random_graph(args.N, args.degree, rng) for _ in range(args.S)]
+    ind = rng.integers(args.noc, size=args.N)
+    Z = np.zeros((args.noc, args.N))
+    Z[ind, np.arange(args.N)] = 1
+    spdenmatmul(A[0], Z.T) # compile numba kernel
+    print('nnz per graph:', A[0].nnz, ', available cpus:', parallelism_info()['cpus'])
+
+    kernels = {'spmatmul': lambda: spdenmatmul(A[0], Z.T),
+               'n_link': lambda: np.stack([Z @ spdenmatmul(As, Z.T) for As in A], axis=2)}
+    print('{:<10} | {:>8} | {:>12} | {:>8} | {:>10}'.format('kernel', 'threads', 'time (s)', 'speedup', 'efficiency'))
+    print('-----------+----------+--------------+----------+-----------')
+    for name, kernel in kernels.items():
+        time_1 = None
+        for n_threads in range(1, max_threads+1):
+            numba.set_num_threads(n_threads)
+            with threadpool_limits(limits=n_threads, user_api='blas'):
+                times = []
+                for _ in range(args.repeats):
+                    t0 = time.perf_counter()
+                    kernel()
+                    times.append(time.perf_counter() - t0)
+            t = min(times)
+            if time_1 is None:
+                time_1 = t
+            print(f"{name:<10} | {n_threads:8d} | {t:12.4f} | {time_1/t:8.2f} | {time_1/t/n_threads:10.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--N', type=int, default=59412, help='number of nodes (default: HCP vertex resolution)')
+    parser.add_argument('--degree', type=float, default=100, help='average node degree of generated graphs')
+    parser.add_argument('--S', type=int, default=10, help='number of graphs')
+    parser.add_argument('--noc', type=int, default=50, help='number of clusters')
+    parser.add_argument('--max_threads', type=int, default=os.cpu_count(), help='largest number of threads to benchmark')
+    parser.add_argument('--repeats', type=int, default=3, help='number of repeated measurements (minimum is reported)')
+    main(parser.parse_args())
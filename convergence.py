@@ -0,0 +1,129 @@
+import os
+import re
+from collections import deque
+import numpy as np
+
+# Online MCMC convergence diagnostics used by MultinomialSBM.train() (see ConvergenceMonitor):
+# effective sample size (ESS) of logP and noc, split-Rhat of logP across chains and
+# partition stability (NMI between successive MAP partitions).
+
+
+def autocorrelation(x):
+    # normalized autocorrelation function of 1D array x (computed with FFT)
+    n = len(x)
+    x = x - np.mean(x)
+    f = np.fft.rfft(x, n=2*n)
+    acf = np.fft.irfft(f * np.conjugate(f))[:n]
+    return acf / acf[0]
+
+
+def ess(x):
+    # Effective sample size of 1D chain x using Geyer's initial monotone sequence estimator
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    if n < 4:
+        return 0.0
+    if np.var(x) == 0: # constant chain (e.g. noc of parametric model), no Monte Carlo uncertainty
+        return float(n)
+    rho = autocorrelation(x)
+    pairs = rho[:n - n % 2].reshape(-1, 2).sum(axis=1) # sums of consecutive autocorrelations (positive for reversible chains)
+    negative = np.nonzero(pairs < 0)[0]
+    if len(negative) > 0:
+        pairs = pairs[:negative[0]]
+    pairs = np.minimum.accumulate(pairs) # monotone sequence
+    tau = max(-1 + 2 * np.sum(pairs), 1 / np.log10(n)) # integrated autocorrelation time (ESS is bounded by n*log10(n))
+    return n / tau
+
+
+def split_rhat(chains):
+    # Split-Rhat (potential scale reduction) of a list of 1D chains, each chain is split in two halves
+    halves = []
+    for chain in chains:
+        chain = np.asarray(chain, dtype=float)
+        h = len(chain) // 2
+        if h >= 2:
+            halves += [chain[:h], chain[-h:]]
+    if len(halves) < 2:
+        return np.inf
+    m = min(len(half) for half in halves)
+    halves = np.array([half[-m:] for half in halves])
+    W = np.mean(np.var(halves, axis=1, ddof=1)) # within-chain variance
+    B = m * np.var(np.mean(halves, axis=1), ddof=1) # between-chain variance
+    if W == 0:
+        return 1.0 if B == 0 else np.inf
+    var_plus = (m - 1) / m * W + B / m
+    return np.sqrt(var_plus / W)
+
+
+def nmi(labels1, labels2):
+    # Normalized mutual information (arithmetic normalization) between two partitions given as label vectors
+    _, a = np.unique(labels1, return_inverse=True)
+    _, b = np.unique(labels2, return_inverse=True)
+    n = len(a)
+    P = np.bincount(a * (b.max() + 1) + b, minlength=(a.max() + 1) * (b.max() + 1)).reshape(a.max() + 1, b.max() + 1) / n
+    pa = P.sum(axis=1)
+    pb = P.sum(axis=0)
+    nz = P > 0
+    mi = np.sum(P[nz] * np.log(P[nz] / np.outer(pa, pb)[nz]))
+    ha = -np.sum(pa * np.log(pa))
+    hb = -np.sum(pb * np.log(pb))
+    if ha == 0 and hb == 0: # both partitions have a single cluster
+        return 1.0
+    return max(mi / ((ha + hb) / 2), 0.0)
+
+
+def load_logP_trace(run_dir):
+    # logP trace of the latest saved sample (model_sample{iter}.npy) in a results folder (used as reference chain)
+    iters = [int(m.group(1)) for m in (re.match(r'model_sample(\d+)\.npy$', f) for f in os.listdir(run_dir)) if m]
+    if len(iters) == 0:
+        return None
+    sample = np.load(os.path.join(run_dir, 'model_sample'+str(max(iters))+'.npy'), allow_pickle=True).item()
+    return np.asarray(sample['logP'])
+
+
+class ConvergenceMonitor(object):
+    # Online convergence check of a Gibbs chain
+
+    # Usage: monitor = ConvergenceMonitor(...); each iteration: diagnostics = monitor.update(logP, noc, MAP_labels); monitor.converged
+
+    # Input:
+    # min_iter          minimum number of iterations before the chain can be declared converged
+    # min_ess           minimum ESS of logP and noc (computed on the second half of the chain, first half is burn-in)
+    # max_rhat          maximum split-Rhat of logP (this chain and any reference chains)
+    # min_nmi           minimum NMI between successive MAP partitions over the last nmi_window iterations
+    # nmi_window        number of iterations the MAP partition has to be stable
+    # reference_chains  list of logP traces of other chains of the same experiment (included in split-Rhat)
+
+    def __init__(self, min_iter=20, min_ess=20, max_rhat=1.05, min_nmi=0.95, nmi_window=5, reference_chains=None):
+        self.min_iter = min_iter
+        self.min_ess = min_ess
+        self.max_rhat = max_rhat
+        self.min_nmi = min_nmi
+        self.reference_chains = [np.asarray(chain) for chain in (reference_chains or []) if chain is not None]
+        self.logP = []
+        self.noc = []
+        self.nmi_MAP = deque(maxlen=nmi_window)
+        self.MAP_labels = None
+        self.converged = False
+        self.diagnostics = {}
+
+    def update(self, logP, noc, MAP_labels):
+        self.logP.append(logP)
+        self.noc.append(noc)
+        if self.MAP_labels is not None:
+            self.nmi_MAP.append(1.0 if MAP_labels is self.MAP_labels else nmi(self.MAP_labels, MAP_labels))
+        self.MAP_labels = MAP_labels
+
+        n = len(self.logP)
+        logP = np.asarray(self.logP[n//2:]) # discard first half as burn-in
+        chains = [logP] + [chain[len(chain)//2:] for chain in self.reference_chains]
+        self.diagnostics = {'ess_logP': ess(logP),
+                            'ess_noc': ess(self.noc[n//2:]),
+                            'rhat_logP': split_rhat(chains),
+                            'nmi_MAP': min(self.nmi_MAP) if len(self.nmi_MAP) == self.nmi_MAP.maxlen else 0.0}
+        self.converged = (n >= self.min_iter and
+                          self.diagnostics['ess_logP'] >= self.min_ess and
+                          self.diagnostics['ess_noc'] >= self.min_ess and
+                          self.diagnostics['rhat_logP'] <= self.max_rhat and
+                          self.diagnostics['nmi_MAP'] >= self.min_nmi)
+        return self.diagnostics
@@ -0,0 +1,314 @@
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import asyncio
+import argparse
+import contextlib
+from collections import deque
+
+# Local sampler daemon: long-running worker processes keep the imported modules, compiled numba kernels and loaded datasets
+# resident, so many short runs (e.g. synthetic experiments) do not pay interpreter, import, data loading and compilation
+# startup each time. Runs are requested over a Unix socket with main.py arguments, scheduled on the worker pool (an idle
+# worker that already holds the run's dataset is preferred) and the results of each iteration are streamed back to the
+# client. Every run writes the same results folder as 'python main.py ...'.
+#
+# Usage: python daemon.py --socket /tmp/sbm.sock --workers 4 [--threads_per_worker 1] [--main_dir ...]
+#        python main.py --daemon /tmp/sbm.sock --dataset synthetic ...   (thin client, same arguments as a local run)
+#        python daemon.py --socket /tmp/sbm.sock --status               (or --shutdown: finish running jobs and exit)
+#
+# Protocol: one json object per line. Requests: {"cmd": "run", "config": {main.py arguments}}, {"cmd": "status"} and
+# {"cmd": "shutdown"}. Events sent for a run: queued (job, position), started (job, worker, output), progress (job and
+# the results of an iteration: iter, logP, dlogP, noc, time, T, moves) and finished (job, status, save_dir, elapsed, output).
+
+
+def data_key(config):
+    # identifier of the dataset of a run (runs with the same key can reuse the graphs resident in a worker)
+    if config.dataset == 'synthetic':
+        return (config.main_dir, 'synthetic', config.K, config.S1, config.S2, config.Nc_type, config.alpha)
+    elif config.dataset == 'parcel':
+        return (config.main_dir, 'parcel', config.parcel_file)
+    return (config.main_dir, config.dataset)
+
+
+def _worker(conn, threads, resident_datasets):
+    # worker process: runs the jobs sent by the daemon one at a time, modules, numba kernels and the last resident_datasets datasets
+    # stay loaded between jobs
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the daemon stops the workers (Ctrl-C of the daemon is not passed on)
+    import numpy as np
+    import main as main_module
+    from scipy.sparse import csr_matrix
+    from model import keep_data_resident, spdenmatmul
+    from run_utils import close_writers
+    keep_data_resident(resident_datasets)
+    spdenmatmul(csr_matrix(np.eye(2)), np.ones((2, 2))) # compile (or load cached) numba kernel
+    conn.send(('ready',))
+    while True:
+        message = conn.recv()
+        if message[0] == 'close':
+            break
+        _, job, config_dict, output = message
+        config = main_module.get_parser().parse_args([])
+        config.num_threads = threads
+        for key, value in config_dict.items():
+            setattr(config, key, value)
+        t0 = time.time()
+        with open(output, 'w') as f, contextlib.redirect_stdout(f), contextlib.redirect_stderr(f):
+            try:
+                main_module.main(config, progress=lambda results: conn.send(('progress', job, results)))
+                status = 'finished'
+            except (Exception, SystemExit) as e:
+                print(repr(e))
+                status = 'failed: ' + repr(e)
+            finally:
+                close_writers() # (writer of a run that failed before closing it)
+        conn.send(('done', job, status, config.save_dir, time.time() - t0))
+    conn.close()
+
+
+class SamplerDaemon(object):
+    # Unix socket server and pool of worker processes
+
+    # Input:
+    # socket_path           path of the Unix socket
+    # n_workers             number of worker processes
+    # threads_per_worker    numba/BLAS threads of each run (unless num_threads is given in the run request)
+    # log_dir               folder for the output (stdout/stderr) of each run
+    # resident_datasets     number of datasets each worker keeps loaded (least recently used are dropped)
+    def __init__(self, socket_path, n_workers, threads_per_worker, log_dir, resident_datasets=2):
+        self.socket_path = socket_path
+        self.n_workers = n_workers
+        self.threads_per_worker = threads_per_worker
+        self.log_dir = log_dir
+        self.resident_datasets = resident_datasets
+        self.workers = [] # per worker: process, connection, current job (None: idle), data keys of resident datasets (most recent last), ready
+        self.queue = deque() # jobs waiting for a worker
+        self.jobs = {} # job id -> job (config, data key, client writer, worker, status)
+        self.n_jobs = 0
+        self.closing = False
+
+    def start_worker(self, w):
+        import multiprocessing
+        context = multiprocessing.get_context('spawn') # workers do not inherit the event loop and socket of the daemon
+        conn, child_conn = context.Pipe()
+        process = context.Process(target=_worker, args=(child_conn, self.threads_per_worker, self.resident_datasets), daemon=True)
+        process.start()
+        child_conn.close()
+        worker = {'process': process, 'conn': conn, 'job': None, 'datasets': [], 'ready': False}
+        if w < len(self.workers):
+            self.workers[w] = worker
+        else:
+            self.workers.append(worker)
+        asyncio.get_running_loop().add_reader(conn.fileno(), self.worker_message, w)
+
+    def send(self, job, event):
+        # send event to the client of a job (the run continues if the client has disconnected)
+        writer = job['writer']
+        if writer is not None and not writer.is_closing():
+            writer.write((json.dumps(dict(event, job=job['id'])) + '\n').encode())
+
+    def schedule(self):
+        # start queued jobs on idle workers, preferring a worker that already holds the job's dataset
+        started = False
+        while len(self.queue) > 0:
+            idle = [w for w, worker in enumerate(self.workers) if worker['ready'] and worker['job'] is None]
+            if len(idle) == 0:
+                break
+            started = True
+            job = self.queue.popleft()
+            w = next((w for w in idle if job['data_key'] in self.workers[w]['datasets']), idle[0])
+            worker = self.workers[w]
+            worker['job'] = job['id']
+            job['worker'] = w
+            job['status'] = 'running'
+            worker['conn'].send(('run', job['id'], job['config'], job['output']))
+            self.send(job, {'event': 'started', 'worker': w, 'output': job['output']})
+        if started: # waiting jobs moved up in the queue
+            for position, job in enumerate(self.queue):
+                self.send(job, {'event': 'queued', 'position': position})
+
+    def worker_message(self, w):
+        worker = self.workers[w]
+        try:
+            message = worker['conn'].recv()
+        except (EOFError, OSError): # worker process died, its job fails and the worker is restarted
+            asyncio.get_running_loop().remove_reader(worker['conn'].fileno())
+            if worker['job'] is not None:
+                self.finish(self.jobs[worker['job']], 'failed: worker exited with code ' + str(worker['process'].exitcode), None, None)
+            if not self.closing:
+                self.start_worker(w)
+            return
+        if message[0] == 'ready':
+            worker['ready'] = True
+        elif message[0] == 'progress':
+            self.send(self.jobs[message[1]], dict(message[2], event='progress'))
+        elif message[0] == 'done':
+            _, job, status, save_dir, elapsed = message
+            worker['job'] = None
+            data_key = self.jobs[job]['data_key']
+            if data_key in worker['datasets']:
+                worker['datasets'].remove(data_key)
+            worker['datasets'] = (worker['datasets'] + [data_key])[-self.resident_datasets:] if self.resident_datasets > 0 else []
+            self.finish(self.jobs[job], status, save_dir, elapsed)
+        if message[0] != 'progress':
+            self.schedule()
+            self.check_shutdown()
+
+    def finish(self, job, status, save_dir, elapsed):
+        job['status'] = status
+        self.send(job, {'event': 'finished', 'status': status, 'save_dir': save_dir, 'elapsed': elapsed, 'output': job['output']})
+        job['writer'] = None
+        print(f"Job {job['id']} {status}" + (f" ({elapsed:.1f} s)" if elapsed is not None else ''), flush=True)
+
+    def submit(self, config_dict, writer):
+        # queue a run request (config_dict: main.py arguments) of a client
+        import main as main_module # only argument parsing (the model is imported by the workers)
+        config = main_module.get_parser().parse_args([])
+        for key, value in config_dict.items():
+            if not hasattr(config, key):
+                writer.write((json.dumps({'event': 'finished', 'status': 'failed: unknown main.py argument ' + key}) + '\n').encode())
+                return
+            setattr(config, key, value)
+        self.n_jobs += 1
+        job = {'id': self.n_jobs, 'config': config_dict, 'data_key': data_key(config), 'writer': writer, 'worker': None,
+               'status': 'queued', 'output': os.path.join(self.log_dir, 'job'+str(self.n_jobs)+'.out')}
+        self.jobs[job['id']] = job
+        self.queue.append(job)
+        self.schedule()
+        if job['status'] == 'queued':
+            self.send(job, {'event': 'queued', 'position': len(self.queue) - 1})
+
+    def status(self):
+        return {'event': 'status', 'queued': len(self.queue), 'jobs': self.n_jobs, 'closing': self.closing,
+                'workers': [{'worker': w, 'pid': worker['process'].pid, 'ready': worker['ready'], 'job': worker['job'],
+                             'datasets': [list(key) for key in worker['datasets']]} for w, worker in enumerate(self.workers)]}
+
+    def check_shutdown(self):
+        if self.closing and all(worker['job'] is None for worker in self.workers):
+            self.stopped.set()
+
+    def shutdown(self):
+        # stop accepting runs, cancel queued runs and stop when the running ones have finished
+        self.closing = True
+        while len(self.queue) > 0:
+            self.finish(self.queue.popleft(), 'cancelled', None, None)
+        self.check_shutdown()
+
+    async def handle_client(self, reader, writer):
+        while True:
+            try:
+                line = await reader.readline()
+            except (asyncio.CancelledError, ConnectionError): # daemon stopped or client disconnected
+                break
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+            except ValueError:
+                writer.write(b'{"event": "error", "message": "invalid json"}\n')
+                continue
+            if request.get('cmd') == 'run':
+                if self.closing:
+                    writer.write(b'{"event": "finished", "status": "failed: daemon is shutting down"}\n')
+                else:
+                    self.submit(request.get('config', {}), writer)
+            elif request.get('cmd') == 'status':
+                writer.write((json.dumps(self.status()) + '\n').encode())
+            elif request.get('cmd') == 'shutdown':
+                self.shutdown()
+                writer.write((json.dumps(self.status()) + '\n').encode())
+            else:
+                writer.write(b'{"event": "error", "message": "unknown command"}\n')
+            await writer.drain()
+        for job in self.jobs.values():
+            if job['writer'] is writer:
+                job['writer'] = None
+        writer.close()
+
+    async def serve(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path) # stale socket of a previous daemon
+        self.stopped = asyncio.Event()
+        for w in range(self.n_workers):
+            self.start_worker(w)
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, self.shutdown)
+        loop.add_signal_handler(signal.SIGINT, self.shutdown)
+        server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+        print(f"Sampler daemon listening on {self.socket_path} with {self.n_workers} workers (output of runs in {self.log_dir})", flush=True)
+        async with server:
+            await self.stopped.wait()
+        for worker in self.workers:
+            loop.remove_reader(worker['conn'].fileno())
+            worker['conn'].send(('close',))
+            worker['process'].join(timeout=10)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        print('Sampler daemon stopped', flush=True)
+
+
+def request(socket_path, message):
+    # send a request to the daemon and yield its events until the connection is closed
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        f = sock.makefile('rwb')
+        f.write((json.dumps(message) + '\n').encode())
+        f.flush()
+        for line in f:
+            yield json.loads(line)
+
+
+def submit_config(socket_path, config, parser):
+    # Run main.py configuration on the daemon (thin client of main.py --daemon), prints progress like a local run
+    ## INPUT
+    # socket_path   Unix socket of the daemon
+    # config        main.py configuration (argparse namespace)
+    # parser        main.py argument parser (arguments with default values are not sent, the workers use their defaults)
+    ## OUTPUT
+    # finished event of the run (status, save_dir, elapsed, output)
+    defaults = vars(parser.parse_args([]))
+    config_dict = {key: value for key, value in vars(config).items() if key != 'daemon' and value != defaults.get(key)}
+    config_dict['main_dir'] = os.path.abspath(config.main_dir) # paths relative to this client
+    for key in ['init_from', 'cache_dir', 'save_dir']:
+        if config_dict.get(key):
+            config_dict[key] = os.path.abspath(config_dict[key])
+    if config_dict.get('convergence_chains'):
+        config_dict['convergence_chains'] = [os.path.abspath(path) for path in config_dict['convergence_chains']]
+    for event in request(socket_path, {'cmd': 'run', 'config': config_dict}):
+        if event['event'] == 'queued':
+            print(f"Job {event['job']} queued (position {event['position']})", flush=True)
+        elif event['event'] == 'started':
+            print(f"Job {event['job']} started on worker {event['worker']} (output in {event['output']})", flush=True)
+            if config.disp:
+                print('{:<12} | {:<12} | {:<12} | {:<12} | {:<12}'.format('Iteration', 'logP', 'dlogP/|logP|', 'noc', 'time'))
+        elif event['event'] == 'progress':
+            if config.disp:
+                print(f"{event['iter']:12.0f} | {event['logP']:12.4e} | {event['dlogP']:12.4e} | {event['noc']:12.0f} | {event['time']:12.4f}", flush=True)
+        elif event['event'] == 'finished':
+            print(f"Job {event.get('job')} {event['status']}" + (f", results in {event['save_dir']} ({event['elapsed']:.1f} s)" if event.get('save_dir') else ''), flush=True)
+            return event
+    return {'status': 'failed: connection to daemon closed'}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', type=str, default=os.path.join(os.environ.get('TMPDIR', '/tmp'), 'sbm_daemon.sock'), help='path of the Unix socket')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('LSB_DJOB_NUMPROC', os.cpu_count())), help='number of worker processes (default: number of LSF slots)')
+    parser.add_argument('--threads_per_worker', type=int, default=1, help='numba/BLAS threads of each run (unless num_threads is given in the run request)')
+    parser.add_argument('--resident_datasets', type=int, default=2, help='number of datasets each worker keeps loaded between runs (least recently used are dropped)')
+    parser.add_argument('--main_dir', type=str, default='/work3/s174162/speciale/', help='main directory (output of runs is written to main_dir/results/daemon_logs)')
+    parser.add_argument('--log_dir', type=str, default=None, help='folder for output of each run (default: main_dir/results/daemon_logs)')
+    parser.add_argument('--status', action='store_true', help='print status of a running daemon')
+    parser.add_argument('--shutdown', action='store_true', help='stop a running daemon (running jobs are finished, queued jobs are cancelled)')
+    args = parser.parse_args()
+    if args.status or args.shutdown:
+        for event in request(args.socket, {'cmd': 'shutdown' if args.shutdown else 'status'}):
+            print(json.dumps(event, indent=2))
+            break
+        sys.exit(0)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    daemon = SamplerDaemon(args.socket, args.workers, args.threads_per_worker, args.log_dir or os.path.join(args.main_dir, 'results', 'daemon_logs'), args.resident_datasets)
+    asyncio.run(daemon.serve())
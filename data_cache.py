@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+import numpy as np
+from run_utils import save_npy_atomic, write_json_atomic
+
+# Content-addressed on-disk cache of data-derived quantities shared by runs on the same dataset
+# (e.g. symmetrised HCP graphs and the number of links between clusters of the initial partition).
+# Entries are keyed by the hash of the data files they are computed from and the parameters of the computation,
+# so a changed data file never returns a stale entry. The total size of the cache is bounded, the least recently
+# used entries are deleted first. Entries are written with write-and-rename, so concurrent jobs can share the cache.
+#
+# Usage: cache = DataCache(cache_dir, max_size_mb); key = cache.key('name', file_digest(path), param); value = cache.get_or_compute(key, function)
+
+
+def file_digest(path, cache_dir=None, block_size=2**24):
+    # sha256 of file content. If cache_dir is given, the digest is remembered for the file's (path, size, modification time),
+    # so large data files are only hashed again when they change
+    stat = os.stat(path)
+    file_id = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    index_path = os.path.join(cache_dir, 'digests.json') if cache_dir is not None else None
+    index = {}
+    if index_path is not None and os.path.exists(index_path):
+        try:
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError): # written by another job in the meantime (or corrupt), recompute
+            index = {}
+        if file_id in index:
+            return index[file_id]
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+    if index_path is not None:
+        index[file_id] = digest
+        write_json_atomic(index_path, index)
+    return digest
+
+
+class DataCache(object):
+    # Input:
+    # cache_dir     folder of cache (created if it does not exist)
+    # max_size_mb   maximum total size of cached entries in MB (least recently used entries are deleted when exceeded)
+    def __init__(self, cache_dir, max_size_mb=20000):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024**2
+        os.makedirs(cache_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, *parts):
+        # cache key from name of the computation, file digests and parameters
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key):
+        # cached object or None if not cached
+        path = self.path(key)
+        try:
+            obj = np.load(path, allow_pickle=True)
+        except (OSError, ValueError, EOFError): # not cached (or evicted by another job)
+            return None
+        try:
+            os.utime(path) # mark as recently used
+        except OSError:
+            pass
+        return obj.item() if obj.dtype == object and obj.shape == () else obj
+
+    def put(self, key, obj):
+        save_npy_atomic(self.path(key), obj)
+        self.evict()
+
+    def get_or_compute(self, key, compute):
+        # cached object for key, or compute() which is then cached
+        obj = self.get(key)
+        if obj is not None:
+            self.hits += 1
+            return obj
+        self.misses += 1
+        obj = compute()
+        self.put(key, obj)
+        return obj
+
+    def evict(self):
+        # delete least recently used entries until the cache fits in max_size
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy') and not name.startswith('.'):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,317 @@
+import os
+import copy
+import math
+import time
+import shutil
+import zipfile
+import tempfile
+import numpy as np
+
+# Pre-submission estimate of memory and runtime of a run (main.py --estimate True).
+# The dataset is only inspected through its file headers (number of nodes N, number of graphs S and number of links of
+# each graph), so the estimate is cheap even when the graphs do not fit in memory on the submitting node. Short calibration
+# runs (a few iterations with the chosen model_type, noc, splitmerge and hyperparameter settings) are made on random
+# stand-in graphs with noc planted clusters and the same S, dtype and average degree (hcp) as the dataset. Each calibration
+# run is a separate process, so its peak resident memory can be measured. Peak memory, initialization time and time per
+# iteration of stand-ins of increasing size n are fitted by c0 + c1 n + c2 n^2 and extrapolated to N. For sparse graphs
+# (hcp), where N is large, one iteration (partial Gibbs sweeps, split-merge and hyperparameters) is also timed on a stand-in
+# with all N nodes. The calibration runs use the threads of this process (--num_threads), so the estimate should be made
+# on the same kind of node as the job.
+
+
+def npy_header(f):
+    # shape and dtype of an .npy file (file object positioned at the start of the file), without reading the array
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+    return shape, dtype
+
+
+def npz_headers(path):
+    # dictionary with (shape, dtype) of each array of an .npz file, only the headers of the members are decompressed
+    headers = {}
+    with zipfile.ZipFile(path) as archive:
+        for name in archive.namelist():
+            with archive.open(name) as f:
+                headers[name[:-len('.npy')] if name.endswith('.npy') else name] = npy_header(f)
+    return headers
+
+
+def npz_array(path, name):
+    # single (small) array of an .npz file
+    with zipfile.ZipFile(path) as archive, archive.open(name+'.npy') as f:
+        return np.lib.format.read_array(f)
+
+
+def sparse_graph_info(path):
+    # Number of nodes and links of a graph saved with scipy.sparse.save_npz, from the headers (and indptr) of the file
+    ## INPUT
+    # path      .npz file
+    ## OUTPUT
+    # N         number of nodes
+    # nnz       number of nonzero entries of the symmetrised graph (entries of the upper triangle are mirrored if only the upper triangle is stored)
+    # dtype     dtype of link counts
+    headers = npz_headers(path)
+    N = int(npz_array(path, 'shape')[0])
+    nnz = headers['data'][0][0]
+    if 'indptr' in headers and npz_array(path, 'format').item() in ('csr', b'csr'):
+        row_nnz = np.diff(npz_array(path, 'indptr')) # N+1 row pointers, small compared with the graph
+        if np.all(row_nnz <= N - 1 - np.arange(N)): # row i only has room for columns > i: upper triangle is stored
+            nnz *= 2
+    return N, nnz, headers['data'][1]
+
+
+def dataset_info(config):
+    # Size of the dataset of config (N, S, number of links of each graph and dtype) read from file headers
+    data_path = os.path.join(config.main_dir, 'data/'+config.dataset)
+    if config.dataset == 'synthetic':
+        from model import synthetic_filename
+        path = os.path.join(data_path, synthetic_filename(config)+'.npy')
+        with open(path, 'rb') as f:
+            shape, dtype = npy_header(f)
+        N, _, S = shape
+        return {'dataset': 'synthetic', 'N': N, 'S': S, 'dtype': dtype, 'dense': True, 'file_mb': os.path.getsize(path) / 2**20}
+    elif config.dataset == 'hcp':
+        from model import hcp_filenames
+        paths = [os.path.join(data_path, filename) for filename in hcp_filenames]
+        graphs = [sparse_graph_info(path) for path in paths]
+        return {'dataset': 'hcp', 'N': graphs[0][0], 'S': len(graphs), 'nnz': [nnz for _, nnz, _ in graphs], 'dtype': graphs[0][2], 'dense': False,
+                'file_mb': sum(os.path.getsize(path) for path in paths) / 2**20}
+    elif config.dataset == 'parcel':
+        path = os.path.join(config.main_dir, 'data', 'hcp', config.parcel_file)
+        shape, dtype = npz_headers(path)['Nlink']
+        return {'dataset': 'parcel', 'N': shape[0], 'S': shape[2], 'dtype': dtype, 'dense': True, 'file_mb': os.path.getsize(path) / 2**20}
+    raise ValueError('Estimate is not supported for dataset ' + str(config.dataset))
+
+
+def write_standin(main_dir, config, info, n, rng, max_degree=None):
+    # Random stand-in dataset with n nodes and the same S, dtype and average degree (at most max_degree) as info, written where config expects the data.
+    # The graphs have noc planted clusters, each pair of clusters with its own distribution of links over the graphs (the model
+    # distinguishes clusters by these distributions), so the number of clusters of the calibration runs stays close to noc
+    S = info['S']
+    labels = rng.integers(config.noc, size=n)
+    eta = rng.dirichlet(np.ones(S), size=(config.noc, config.noc))
+    eta = (eta + eta.transpose(1, 0, 2)) / 2 # distribution of links of each pair of clusters over the graphs
+    if info['dataset'] == 'hcp':
+        from scipy.sparse import coo_matrix, save_npz
+        from model import hcp_filenames
+        data_path = os.path.join(main_dir, 'data', 'hcp')
+        os.makedirs(data_path, exist_ok=True)
+        order = np.argsort(labels, kind='stable')
+        size = np.bincount(labels, minlength=config.noc)
+        start = np.cumsum(size) - size
+        for s, (nnz, filename) in enumerate(zip(info['nnz'], hcp_filenames)):
+            n_edges = int(round(min(nnz / info['N'], n - 1, max_degree or n) * n / 2)) # same average degree (at most n-1 and max_degree)
+            p = eta[:, :, s] * np.outer(size, size)
+            pair = rng.choice(config.noc**2, size=n_edges, p=p.ravel() / p.sum())
+            k, l = np.divmod(pair, config.noc)
+            i = order[start[k] + rng.integers(size[k])]
+            j = order[start[l] + rng.integers(size[l])]
+            graph = coo_matrix((np.ones(n_edges, dtype=info['dtype']), (np.minimum(i, j), np.maximum(i, j))), shape=(n, n)).tocsr()
+            save_npz(os.path.join(data_path, filename), graph)
+        return
+    mean = 20 if info['dataset'] == 'parcel' else 2 # mean number of links between two nodes
+    A = np.triu(rng.poisson(mean * S * eta[labels][:, labels]).transpose(2, 0, 1), 1)
+    A = (A + A.transpose(0, 2, 1)).transpose(1, 2, 0)
+    if np.issubdtype(info['dtype'], np.integer):
+        A = np.minimum(A, np.iinfo(info['dtype']).max)
+    A = A.astype(info['dtype'])
+    if info['dataset'] == 'synthetic':
+        from model import synthetic_filename
+        data_path = os.path.join(main_dir, 'data', 'synthetic')
+        os.makedirs(data_path, exist_ok=True)
+        np.save(os.path.join(data_path, synthetic_filename(config)+'.npy'), A)
+    elif info['dataset'] == 'parcel':
+        data_path = os.path.join(main_dir, 'data', 'hcp')
+        os.makedirs(data_path, exist_ok=True)
+        A[np.arange(n), np.arange(n), :] = 100 # links within parcels
+        np.savez(os.path.join(data_path, config.parcel_file), Nlink=A, sizes=np.full(n, 100))
+
+
+def calibration_config(config, main_dir, iters):
+    # copy of config for a calibration run in main_dir (no caching, convergence check, profiling, validation or saved results elsewhere)
+    cal = copy.copy(config)
+    cal.main_dir = main_dir
+    cal.save_dir = os.path.join(main_dir, 'results')
+    os.makedirs(cal.save_dir, exist_ok=True)
+    cal.maxiter_gibbs = iters
+    cal.deadline = None
+    cal.use_convergence_criteria = False
+    cal.use_cache = False
+    cal.subject_workers = 0
+    cal.init_from = None
+    cal.unit_test = False
+    cal.disp = False
+    cal.save_step = iters + 1
+    cal.keep_samples = 1
+    cal.seed = 0
+    if cal.model_type == 'parametric':
+        cal.splitmerge = False
+    return cal
+
+
+def _calibration_run(conn, config, info, n, iters, sweep_nodes=None, max_degree=None):
+    # calibration run in a fresh (spawned) process, so its peak resident memory can be measured. With sweep_nodes, only
+    # partial Gibbs sweeps over sweep_nodes randomly chosen nodes and the rest of one iteration (split-merge and hyperparameters)
+    # are timed (instead of iters iterations)
+    import sys
+    import resource
+    from run_utils import configure_threads
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        configure_threads(num_threads=config.num_threads, blas_threads=config.blas_threads, cpu_list=config.cpu_list, chain_index=config.chain_index)
+        from model import MultinomialSBM
+        main_dir = tempfile.mkdtemp(prefix='estimate_')
+        try:
+            write_standin(main_dir, config, info, n, np.random.default_rng(n), max_degree)
+            base_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # interpreter and modules (ru_maxrss is in kB on Linux)
+            t0 = time.time()
+            model = MultinomialSBM(calibration_config(config, main_dir, iters))
+            result = {'n': n, 'base_mb': base_mb, 'init_time': time.time() - t0}
+            if sweep_nodes is None:
+                model.maxiter = 1 # first iteration compiles numba kernels and is not timed
+                model.train()
+                timings = dict(model.timings)
+                model.maxiter = iters
+                model.train()
+                model.writer.close()
+                result['iter_time'] = float(np.mean(model.iteration_times[1:]))
+                result['gibbs_time'] = (model.timings['gibbs'] - timings['gibbs']) / (iters - 1)
+            else:
+                sweep_times = []
+                for _ in range(iters + 1): # (first sweep is not timed)
+                    nodes = model.rng['gibbs'].choice(n, size=sweep_nodes, replace=False)
+                    t0 = time.time()
+                    model.Z, model.logP_A, model.logP_Z, _, _ = model.gibbs_sample_Z(model.Z, nodes, comp=[], Force=[])
+                    sweep_times.append(time.time() - t0)
+                result['gibbs_time'] = n * float(np.median(sweep_times[1:])) / sweep_nodes
+                t0 = time.time() # rest of an iteration (as in train)
+                if model.splitmerge:
+                    for _ in range(model.maxiter_splitmerge):
+                        model.Z, model.logP_A, model.logP_Z = model.splitmerge_sample_Z(model.Z, model.logP_A, model.logP_Z)
+                model.sumZ = np.sum(model.Z, axis=1)
+                model.noc = model.Z.shape[0]
+                model.sample_alpha()
+                model.sample_eta0()
+                result['iter_time'] = result['gibbs_time'] + time.time() - t0
+            result['noc'] = model.noc
+            result['peak_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        finally:
+            shutil.rmtree(main_dir, ignore_errors=True)
+        conn.send(result)
+    except Exception as e:
+        conn.send(e)
+    conn.close()
+
+
+def calibrate(config, info, n, iters=2, sweep_nodes=None, max_degree=None):
+    # Calibration run on a stand-in dataset with n nodes in its own process
+    ## INPUT
+    # config        main.py configuration
+    # info          dataset_info of the dataset
+    # n             number of nodes of the stand-in dataset
+    # iters         number of iterations of the calibration run (the first iteration, which compiles numba kernels, is not timed)
+    # sweep_nodes   only time partial Gibbs sweeps over this many nodes (None: run iters iterations)
+    # max_degree    maximum average degree of stand-in graphs (hcp)
+    ## OUTPUT
+    # dictionary with n, noc (after the run), resident memory of interpreter and modules and peak resident memory (MB),
+    # init time, time per iteration and time of Gibbs sweep (sec)
+    import multiprocessing
+    context = multiprocessing.get_context('spawn')
+    conn, child_conn = context.Pipe()
+    process = context.Process(target=_calibration_run, args=(child_conn, config, info, n, iters, sweep_nodes, max_degree), daemon=True)
+    process.start()
+    result = conn.recv()
+    process.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def fit_extrapolate(n, y, N, degree):
+    # Non-negative least squares fit of y = c0 + c1 n (+ c2 n^2) to the calibration points, evaluated at N
+    from scipy.optimize import nnls
+    degree = min(degree, len(n) - 1)
+    n = np.asarray(n, dtype=float)
+    coef, _ = nnls(np.stack([n**p for p in range(degree+1)], axis=1), np.asarray(y, dtype=float))
+    return float(sum(c * N**p for p, c in enumerate(coef)))
+
+
+def lsf_resources(memory_mb, minutes, n_cores, max_hours=72):
+    # suggested bsub options (as in submit_hpc.sh) for total memory (MB) and wall-time (minutes) of a run
+    mem_gb = max(math.ceil(memory_mb / n_cores / 1024 * 2) / 2, 0.5) # per slot, rounded up to 0.5 GB
+    minutes = max(15 * math.ceil(minutes / 15), 15)
+    walltime = min(minutes, max_hours * 60)
+    return ['#BSUB -n ' + str(n_cores),
+            '#BSUB -R "span[hosts=1]"',
+            '#BSUB -R "rusage[mem=' + '{:g}'.format(mem_gb) + 'GB]"',
+            '#BSUB -M ' + '{:g}'.format(mem_gb) + 'GB',
+            '#BSUB -W {:d}:{:02d}'.format(walltime // 60, walltime % 60)], walltime
+
+
+def estimate(config, sizes=None, safety=1.3, sweep_nodes=400, standin_max_mb=1000):
+    # Predict peak memory and time per iteration of a run with config and print suggested LSF resource lines
+    ## INPUT
+    # config            main.py configuration (dataset, model_type, noc, splitmerge, maxiter_* ...)
+    # sizes             numbers of nodes of the calibration runs (default: n0, 2 n0 and 4 n0 with n0 = config.estimate_nodes)
+    # safety            factor applied to predicted memory and time in the suggested resources
+    # sweep_nodes       number of nodes of the partial Gibbs sweeps with all N nodes (sparse graphs)
+    # standin_max_mb    maximum size of the stand-in graphs with all N nodes (their degree is reduced if needed)
+    ## OUTPUT
+    # dictionary with dataset info, calibration results and predictions
+    info = dataset_info(config)
+    N, S = info['N'], info['S']
+    if sizes is None:
+        n0 = config.estimate_nodes or max(200, 4 * config.noc, 2 * int(max(info.get('nnz', [0])) / N))
+        sizes = sorted(set(min(N, n0 * k) for k in (1, 2, 4)))
+    print(f"Dataset {info['dataset']}: N = {N} nodes, S = {S} graphs, dtype {info['dtype']}, {info['file_mb']:.1f} MB on disk"
+          + (f", average degree {np.mean(info['nnz']) / N:.1f}" if 'nnz' in info else ''))
+    if config.subject_workers > 0:
+        print('Note: the estimate is for graphs held in the main process (subject_workers = 0), with subject workers the graphs are split over the worker processes')
+    print('Calibration runs on stand-in graphs with', sizes, 'nodes ...', flush=True)
+    results = []
+    for n in sizes:
+        results.append(calibrate(config, info, n))
+        r = results[-1]
+        print(f"  n = {r['n']:<7d} noc = {r['noc']:<5d} peak memory {r['peak_mb']:9.1f} MB   init {r['init_time']:7.2f} s   iteration {r['iter_time']:7.3f} s (Gibbs sweep {r['gibbs_time']:.3f} s)", flush=True)
+
+    n = [r['n'] for r in results]
+    rss_base = float(np.mean([r['base_mb'] for r in results]))
+    peak_mb = rss_base + fit_extrapolate(n, [r['peak_mb'] - r['base_mb'] for r in results], N, 2)
+    init_time = fit_extrapolate(n, [r['init_time'] for r in results], N, 2)
+    gibbs_time = fit_extrapolate(n, [r['gibbs_time'] for r in results], N, 2)
+    other_time = fit_extrapolate(n, [r['iter_time'] - r['gibbs_time'] for r in results], N, 2) # split-merge and hyperparameters
+    if not info['dense'] and N > max(n):
+        # the per-node cost of Gibbs sweeps grows with N (rows of the partition matrix), which small stand-ins do not show
+        # (their partition matrix fits in cache), and sparse small stand-ins do not keep noc clusters, so an iteration is
+        # timed on a stand-in with all N nodes
+        max_degree = standin_max_mb * 2**20 / (12 * S * N) # int32 links and indices of S graphs
+        full = calibrate(config, info, N, sweep_nodes=min(sweep_nodes, N // 2), max_degree=max_degree)
+        gibbs_time = full['gibbs_time']
+        other_time = full['iter_time'] - full['gibbs_time']
+        if max_degree >= np.mean(info['nnz']) / N: # same graphs sizes as the dataset
+            peak_mb = max(peak_mb, full['peak_mb'])
+        print(f"  n = {N:<7d} noc = {full['noc']:<5d} peak memory {full['peak_mb']:9.1f} MB   iteration {full['iter_time']:7.3f} s (Gibbs sweep {gibbs_time:.3f} s from partial sweeps over {min(sweep_nodes, N // 2)} nodes"
+              + (f", average degree reduced to {max_degree:.0f})" if max_degree < np.mean(info['nnz']) / N else ')'), flush=True)
+    iter_time = gibbs_time + other_time
+    total_min = (init_time + config.maxiter_gibbs * iter_time) / 60
+    n_cores = config.num_threads or 5 # default of submit_hpc.sh
+    lines, walltime = lsf_resources(safety * peak_mb, safety * total_min + config.walltime_margin, n_cores)
+
+    print(f"Predicted peak memory: {peak_mb / 1024:.2f} GB (of which {rss_base:.0f} MB interpreter and modules)")
+    print(f"Predicted time: {init_time:.1f} s initialization, {iter_time:.2f} s per iteration (Gibbs sweep {gibbs_time:.2f} s), {total_min:.1f} min for {config.maxiter_gibbs} iterations"
+          + (' (upper bound, convergence criteria may stop earlier)' if config.use_convergence_criteria else ''))
+    if config.model_type == 'nonparametric':
+        print(f"The number of clusters of the nonparametric model depends on the data, the prediction is for about {config.noc} clusters "
+              "(time of Gibbs sweeps grows about quadratically with the number of clusters, rerun with --noc set to the expected number of clusters)")
+    print(f"Suggested LSF resources (x{safety} safety factor, {n_cores} slots):")
+    for line in lines:
+        print(line)
+    print(f"and main.py --walltime {walltime}")
+    if walltime < safety * total_min + config.walltime_margin:
+        n_jobs = math.ceil((safety * total_min + config.walltime_margin) / walltime)
+        print(f"The run does not fit in the maximum wall-time, continue it in about {n_jobs} jobs with --init_from <results folder of previous job>")
+    return {'info': info, 'calibration': results, 'rss_base_mb': rss_base, 'peak_mb': peak_mb, 'init_time': init_time,
+            'iter_time': iter_time, 'gibbs_time': gibbs_time, 'total_min': total_min, 'lsf': lines}
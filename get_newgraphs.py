@@ -1,12 +1,20 @@
-from article_helper_functions import *
 import os
+import numpy as np
+from parcellate_graphs import load_atlas, parcellate, save_parcellation
 
-os.environ["OMP_NUM_THREADS"] = "5"  # set number of threads to 5
+# Compute graphs in Glasser atlas resolution for all HCP graphs in one pass (atlas loaded once, graphs processed in parallel)
+data_path = '/work3/s174162/speciale/data/hcp'
+workers = int(os.environ.get('LSB_DJOB_NUMPROC', 5)) # number of LSF slots
 
-#print('Computing dmri graph')
-dmri_filenames = ['dmri_sparse2.npz','dmri_sparse3.npz','dmri_sparse4.npz','dmri_sparse5.npz'] # 'dmri_sparse1.npz'
-fmri_filenames = ['fmri_sparse2.npz','fmri_sparse3.npz','fmri_sparse4.npz','fmri_sparse5.npz'] # 'fmri_sparse1.npz'
+# same order of graphs as used by the model (first 5 functional, last 5 structural)
+filenames = ['fmri_sparse1.npz', 'fmri_sparse2.npz', 'fmri_sparse3.npz', 'fmri_sparse4.npz', 'fmri_sparse5.npz', 
+             'dmri_sparse1.npz', 'dmri_sparse2.npz', 'dmri_sparse3.npz', 'dmri_sparse4.npz', 'dmri_sparse5.npz']
+graph_files = [os.path.join(data_path, filename) for filename in filenames]
 
-for i in range(len(dmri_filenames)):
-    Glasser_A_dmri = compute_Glasser_A(dmri_filenames[i])
-    Glasser_A_fmri = compute_Glasser_A(fmri_filenames[i])
\ No newline at end of file
+z, K = load_atlas([os.path.join(data_path, 'Glasser_L.mat'), os.path.join(data_path, 'Glasser_R.mat')])
+Nlink, Ntot, sizes = parcellate(graph_files, z, K, workers=workers)
+Glasser_A = save_parcellation(os.path.join(data_path, 'Glasser_counts.npz'), Nlink, Ntot, sizes, graph_files) # 360 x 360 x 10
+
+# density graph of each subject (same files as written by compute_Glasser_A)
+for s, filename in enumerate(filenames):
+    np.save(os.path.join(data_path, 'Glasser_A_'+filename.split('.')[0]+'.npy'), Glasser_A[:, :, s])
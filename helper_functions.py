@@ -1,23 +1,10 @@
 import os
-import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap
-from sklearn.metrics.cluster import normalized_mutual_info_score
-from PIL import Image
-import nilearn as ni
-from nilearn import plotting as nplt
-import seaborn as sns
-import matplotlib.image as mpimg
-from sklearn import metrics
-import networkx as nx
-from scipy.stats import entropy
-from scipy.sparse import load_npz, triu
-from scipy.io import loadmat
 from scipy.sparse import csr_matrix, load_npz, triu
-from matplotlib.patches import Ellipse, Arc
-from matplotlib.colors import Normalize
-from matplotlib import colormaps
+from run_utils import MANIFEST_NAME, read_manifest
+
+# NOTE: analysis and plotting libraries (pandas, matplotlib, sklearn, PIL, scipy.stats) are imported inside the functions using them,
+# so importing this module (e.g. from batch jobs) does not pay their import time and memory
 
 # main directory
 main_dir = '/work3/s174162/speciale'
@@ -27,13 +14,25 @@ legend_fontsize = 10
 subtitle_fontsize = 16
 title_fontsize = 18
 dpi = 400
-cmap_color=plt.cm.Greys
-
-os.environ["OMP_NUM_THREADS"] = "10"  # set number of threads
-
-def get_exp_overview(top_dir):
+cmap_color='Greys' # colormap name (resolved by matplotlib when plotting)
+
+def parse_log_value(value):
+    # Try to convert the value (string) from a log file to a number
+    try:
+        value = float(value)
+        # Check if the value is an integer and convert it if it is
+        if value.is_integer():
+            value = int(value)
+    except ValueError:
+        pass
+    return value
+
+
+def get_exp_overview(top_dir, skip_unfinished=False):
+    import pandas as pd
     ## INPUT
-    # top_dir:  top-level results directory containing the log files, e.g. 'results/hcp/'
+    # top_dir:          top-level results directory containing the log files, e.g. 'results/hcp/'
+    # skip_unfinished:  if True, skip runs whose run manifest (run.json) is not marked as finished (running, failed or half-written runs)
     
     ## OUTPUT
     # df_new:   Pandas DataFrame with experiment overview (containing the data from the log file)
@@ -43,26 +42,24 @@ def get_exp_overview(top_dir):
 
     # Recursively iterate over all log files in the directory structure
     for root, dirs, files in os.walk(top_dir):
-        for file_name in files:
-            if file_name == 'log.txt':
-                # Read the contents of the file
-                with open(os.path.join(root, file_name), 'r') as f:
-                    file_data = f.readlines()
-                
-                # Parse the data from the file and add it to the list
-                file_dict = {}
-                for line in file_data:
-                    key, value = line.strip().split(': ')
-                    # Try to convert the value to a number
-                    try:
-                        value = float(value)
-                        # Check if the value is an integer and convert it if it is
-                        if value.is_integer():
-                            value = int(value)
-                    except ValueError:
-                        pass
-                    file_dict[key] = value
-                data.append(file_dict)
+        if MANIFEST_NAME in files:
+            # Read the experiment specification from the run manifest (written by main.py)
+            manifest = read_manifest(root)
+            if manifest is None or (skip_unfinished and manifest['status'] != 'finished'):
+                continue
+            # values are parsed the same way as in log.txt, so old and new runs are grouped together
+            data.append({key: parse_log_value(str(value)) for key, value in manifest['experiment'].items()})
+        elif 'log.txt' in files and not skip_unfinished: # older runs without run manifest
+            # Read the contents of the file
+            with open(os.path.join(root, 'log.txt'), 'r') as f:
+                file_data = f.readlines()
+            
+            # Parse the data from the file and add it to the list
+            file_dict = {}
+            for line in file_data:
+                key, value = line.strip().split(': ')
+                file_dict[key] = parse_log_value(value)
+            data.append(file_dict)
 
     # Convert the list of dictionaries to a Pandas DataFrame
     df = pd.DataFrame(data)
@@ -199,6 +196,8 @@ def generate_syndata(K, S1, S2, Nc_type, alpha, seed=0, save_data=False, disp_da
 
     # 6) Display data
     if disp_data:
+        import matplotlib.pyplot as plt
+        from matplotlib.colors import ListedColormap
 
         fig, ax = plt.subplots()
         cmap = ListedColormap(['w', 'k']) 
@@ -322,7 +321,24 @@ def generate_syndata(K, S1, S2, Nc_type, alpha, seed=0, save_data=False, disp_da
     return A, Z, Zexp, eta_p1, eta_p2
 
 
+def get_MAP_labels(sample):
+    # cluster label of each node in the MAP partition of a saved sample (samples saved before MAP labels were stored contain the partition matrix 'Z')
+    if 'labels' in sample['MAP']:
+        return sample['MAP']['labels']
+    return sample['MAP']['Z'].T.argmax(axis=1)
+
+
+def get_partition_trace(sample):
+    # trace of the partitions of all logged samples of a saved sample (trace[k]: node labels of iteration sample['iter'][k]),
+    # samples saved before the partition trace was stored contain an empty list 'Z'
+    from partition_trace import PartitionTrace
+    if not isinstance(sample['Z'], dict):
+        return None
+    return PartitionTrace.from_state(sample['Z'])
+
+
 def get_syn_nmi(exp_paths, K, Nc_type, alpha, main_dir=main_dir, dataset='synthetic'):
+    from sklearn.metrics.cluster import normalized_mutual_info_score
     
     Zexp_filename = 'Zexp_'+str(K)+'_'+str(Nc_type)+'_{:.2g}'.format(alpha)
     Z_exp = np.load(os.path.join(main_dir,'data',dataset,Zexp_filename+'.npy'))
@@ -330,8 +346,7 @@ def get_syn_nmi(exp_paths, K, Nc_type, alpha, main_dir=main_dir, dataset='synthe
     nmi_list = []
     for path in exp_paths:
         sample = np.load(os.path.join(path, 'model_sample'+str(maxiter_gibbs)+'.npy'), allow_pickle=True).item()
-        Z_MAP = sample['MAP']['Z'].T
-        labels_MAP = Z_MAP.argmax(axis=1)
+        labels_MAP = get_MAP_labels(sample)
         labels_exp = Z_exp.argmax(axis=1)
         nmi = normalized_mutual_info_score(labels_true=labels_exp, labels_pred=labels_MAP)
         nmi_list.append(nmi)
@@ -340,6 +355,7 @@ def get_syn_nmi(exp_paths, K, Nc_type, alpha, main_dir=main_dir, dataset='synthe
 
 
 def boxplot_syn_nmi(df, K, ini_noc, maxiter_gibbs=100, dataset='synthetic'):
+    import matplotlib.pyplot as plt
     # function for plotting boxplot of NMI(Z_MAP,Z_exp) across multiple initializations over alpha
 
     ## INPUT
@@ -420,6 +436,7 @@ def get_stats(exp_folders, par, maxiter_gibbs, dataset='hcp'):
 
 
 def plot_par(df, par, miniter_gibbs=None, dataset='hcp', main_dir=main_dir, label_fontsize=label_fontsize, subtitle_fontsize=subtitle_fontsize, title_fontsize=title_fontsize, fig_name=None):
+    import matplotlib.pyplot as plt
     
     # Input:  
     # dataset: 'hcp'
@@ -490,6 +507,7 @@ def generate_number_pairs(max_num):
 
 
 def get_pairwise_nmi(exp_folders, noc, main_dir=main_dir, dataset='hcp'):
+    from sklearn.metrics.cluster import normalized_mutual_info_score
     # compute pairwise nmi for hcp data
     
     exp_paths = [os.path.join(main_dir,'results',dataset,folder) for folder in exp_folders]
@@ -505,10 +523,8 @@ def get_pairwise_nmi(exp_folders, noc, main_dir=main_dir, dataset='hcp'):
     for pair in pairs:
         sample0 = np.load(os.path.join(exp_paths[pair[0]], 'model_sample'+str(maxiter_gibbs)+'.npy'), allow_pickle=True).item()
         sample1 = np.load(os.path.join(exp_paths[pair[1]], 'model_sample'+str(maxiter_gibbs)+'.npy'), allow_pickle=True).item()
-        Z0 = sample0['MAP']['Z'].T
-        Z1 = sample1['MAP']['Z'].T
-        labels0 = Z0.argmax(axis=1)
-        labels1 = Z1.argmax(axis=1)
+        labels0 = get_MAP_labels(sample0)
+        labels1 = get_MAP_labels(sample1)
         nmi = normalized_mutual_info_score(labels_true=labels0, labels_pred=labels1)
         nmi_list.append(nmi)
     
@@ -516,6 +532,7 @@ def get_pairwise_nmi(exp_folders, noc, main_dir=main_dir, dataset='hcp'):
 
 
 def boxplot_par_over_ininoc(df, par):
+    import matplotlib.pyplot as plt
     # function for plotting boxplot of a given parameter across multiple initializations over initial noc
 
     ## INPUT
@@ -562,6 +579,7 @@ def boxplot_par_over_ininoc(df, par):
 
 
 def plot_par_over_ininoc(df, pars):
+    import matplotlib.pyplot as plt
     # function for plotting boxplot of a given parameter across multiple initializations over initial noc
 
     ## INPUT
@@ -618,6 +636,7 @@ def plot_par_over_ininoc(df, pars):
      
         
 def plot_eta(dataset, eta, exp_name_title=None, main_dir=main_dir, label_fontsize=label_fontsize, subtitle_fontsize=subtitle_fontsize, title_fontsize=title_fontsize, cmap_color=cmap_color):
+    import matplotlib.pyplot as plt
     if dataset == 'hcp' or dataset == 'synthetic':
         S1 = 5 
         S2 = 5
@@ -668,6 +687,8 @@ def plot_eta(dataset, eta, exp_name_title=None, main_dir=main_dir, label_fontsiz
    
    
 def plot_ZMAP(Z, dataset):
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import ListedColormap
     noc = Z.shape[0]
     fig, ax = plt.subplots()
     cmap_binary = ListedColormap(['w', 'k']) #ListedColormap(['k', 'w']) 
@@ -695,6 +716,7 @@ def center_crop(im, crop_shape):
 
 
 def merge_images(im1,im2,im3, crop_shape, paste_shape, merged_im_title):
+    from PIL import Image
     # merge images from different views into one (brain icons for each cluster in connectivity plot)
 
     # crop_shape = (width, height)
@@ -715,6 +737,7 @@ def merge_images(im1,im2,im3, crop_shape, paste_shape, merged_im_title):
     return newnew_image
 
 def compute_Glasser_A(filename):
+    from scipy.io import loadmat
     # Compute new adjacency matrix with density estimated using Glasser atlas parcellation
     ## INPUT
     # filename          filename of dmri or fmri graph from HCP data e.g. 'dmri_sparse1.npz' or 'fmri_sparse1.npz' (dimension 59412x59412)
@@ -734,11 +757,10 @@ def compute_Glasser_A(filename):
     A = load_npz(os.path.join(data_path, filename)).astype(dtype=np.int32)
     A = triu(A,1)
 
+    from parcellate_graphs import pair_counts
     N = len(z)
     Z = csr_matrix((np.ones(N), (z-1, np.arange(N))), shape=(np.max(z), N)) # Note: z - 1 because python is 0-indexed and labels start at 1
-    sumZ = Z.sum(axis=1)
-    Ntot = np.asarray(sumZ @ sumZ.T - Z @ Z.T)
-    Ntot = Ntot - 0.5 * np.diag(np.diag(Ntot))
+    Ntot = pair_counts(np.asarray(Z.sum(axis=1)).ravel()) # number of vertex pairs between parcels (closed form from parcel sizes)
     Nlink = (Z @ A @ Z.T).toarray()
     Nlink = Nlink + Nlink.T
     Nlink = Nlink - 0.5 * np.diag(np.diag(Nlink))
@@ -768,6 +790,8 @@ def get_best_run(df, noc, dataset='hcp'):
 
 
 def plot_eta_metric_matrix(eta, metric, subset=None):
+    import matplotlib.pyplot as plt
+    from scipy.stats import entropy
     noc = eta.shape[0]
     # computing subset
     if subset == 'fmri':
@@ -843,6 +867,10 @@ def get_curved_line(start, end, direction, shift=0.1, num_points=100):
 
 def plot_eta_graph(eta, top_links=False, plot_function=True, plot_structure=True, main_dir=main_dir, label_fontsize=label_fontsize, subtitle_fontsize=subtitle_fontsize, title_fontsize=title_fontsize):
     ''' Plots the mean eta (cluster link-probabilities) across functional (red) and structural (blue) graphs with brain icons at each node'''
+    import matplotlib.pyplot as plt
+    import matplotlib.image as mpimg
+    from matplotlib.patches import Arc
+    from PIL import Image
     
     K = eta.shape[0]
 
@@ -1,83 +1,166 @@
 import os
+import sys
+import signal
 import argparse
 import time 
 from datetime import datetime
 import numpy as np
-from model import MultinomialSBM
+from run_utils import MANIFEST_NAME, METRICS_NAME, MetricsWriter, new_manifest, write_json_atomic, peak_rss_mb, timestamp, configure_threads
 
-def main(config):
-    # initiate results folder and log.txt file
-    exp_name = config.dataset+'_'+str(datetime.now())
-    config.save_dir = os.path.join(config.main_dir, 'results/'+config.dataset+'/'+exp_name)
-    if not os.path.exists(config.save_dir):
-        os.mkdir(config.save_dir)
+def terminate(signum, frame):
+    # SIGTERM (e.g. from LSF) raises SystemExit in the main thread, so pending samples and the run manifest are written before exiting
+    sys.exit(128 + signum)
+
+def main(config, progress=None):
+    # progress: function called with a dictionary of results after each iteration (used by daemon.py)
+    # wall-time budget of training (reserving walltime_margin minutes for saving the final sample)
+    config.deadline = time.time() + (config.walltime - config.walltime_margin) * 60 if config.walltime is not None else None
+    # threading configuration (must be done before numba kernels are compiled/run)
+    parallelism = configure_threads(num_threads=config.num_threads, blas_threads=config.blas_threads, cpu_list=config.cpu_list, chain_index=config.chain_index)
+    from model import MultinomialSBM # imported here so e.g. 'python main.py --help' does not load numba/scipy
     
     # making sure parameters make sense wrt. other parameters
     if config.model_type == 'parametric':
         config.splitmerge = False
         config.threshold_annealing = False
+    if config.subject_workers > 0:
+        config.splitmerge = False # split-merge moves are not supported with subject-sharded workers
     if config.threshold_annealing:
-        config.maxiter_gibbs = 400
+        config.maxiter_gibbs = max(config.maxiter_gibbs, config.anneal_iters) # run at least until final temperature is reached
         config.use_convergence_criteria = False
         
-    config.use_convergence_criteria = False # TESTING
-    config.threshold_annealing = False # TESTING
+    if config.estimate:
+        # only predict memory and runtime of the run (and suggest LSF resources), no results folder is made
+        from estimate import estimate
+        estimate(config)
+        return
+    
+    # initiate results folder and log.txt file
+    exp_name = config.dataset+'_'+str(datetime.now())
+    config.save_dir = os.path.join(config.main_dir, 'results/'+config.dataset+'/'+exp_name)
+    if not os.path.exists(config.save_dir):
+        os.makedirs(config.save_dir)
+    
     print(config)
+    print(f"Parallelism: {parallelism['numba_threads']} numba threads, BLAS threads {[pool['num_threads'] for pool in parallelism['blas'] or []]}, cpus {parallelism['cpus']}")
         
     # log file with specifications for experiment:
     if config.dataset == 'hcp':
-        with open(os.path.join(config.save_dir, 'log.txt'), 'w') as f:
-            f.write(f"dataset: {config.dataset}\n")
-            f.write(f"exp_name: {exp_name}\n")
-            f.write(f"model_type: {config.model_type}\n")
-            f.write(f"splitmerge: {config.splitmerge}\n")
-            f.write(f"noc: {config.noc}\n")
-            f.write(f"maxiter_gibbs: {config.maxiter_gibbs}\n")
-            f.write(f"maxiter_eta0: {config.maxiter_eta0}\n")
-            f.write(f"maxiter_alpha: {config.maxiter_alpha}\n")
-            #f.write(f"total_time_min: {elapsed_time}\n")
+        log_keys = ['model_type', 'splitmerge', 'noc', 'maxiter_gibbs', 'maxiter_eta0', 'maxiter_alpha']
+    elif config.dataset == 'parcel':
+        log_keys = ['parcel_file', 'model_type', 'splitmerge', 'noc', 'maxiter_gibbs', 'maxiter_eta0', 'maxiter_alpha']
     elif config.dataset == 'synthetic':
-        with open(os.path.join(config.save_dir, 'log.txt'), 'w') as f:
-            f.write(f"dataset: {config.dataset}\n")
-            f.write(f"exp_name: {exp_name}\n")
-            f.write(f"K: {config.K}\n")
-            f.write(f"S1: {config.S1}\n")
-            f.write(f"S2: {config.S2}\n")
-            f.write(f"Nc_type: {config.Nc_type}\n")
-            f.write(f"alpha: {config.alpha}\n")
-            f.write(f"model_type: {config.model_type}\n")
-            f.write(f"splitmerge: {config.splitmerge}\n")
-            f.write(f"noc: {config.noc}\n")
-            f.write(f"maxiter_gibbs: {config.maxiter_gibbs}\n")
-            f.write(f"maxiter_eta0: {config.maxiter_eta0}\n")
-            f.write(f"maxiter_alpha: {config.maxiter_alpha}\n")
+        log_keys = ['K', 'S1', 'S2', 'Nc_type', 'alpha', 'model_type', 'splitmerge', 'noc', 'maxiter_gibbs', 'maxiter_eta0', 'maxiter_alpha']
     else: 
-        print('Unknown dataset. Please choose between synthetic or hcp.')
-    
-    start_time = time.time()
+        log_keys = []
+        print('Unknown dataset. Please choose between synthetic, hcp or parcel.')
+    experiment = {'dataset': config.dataset, 'exp_name': exp_name}
+    experiment.update({key: getattr(config, key) for key in log_keys})
+    if config.init_from:
+        experiment['init_from'] = config.init_from
+    if len(log_keys) > 0:
+        with open(os.path.join(config.save_dir, 'log.txt'), 'w') as f:
+            for key, value in experiment.items():
+                f.write(f"{key}: {value}\n")
     
-    #%% Run code
-    print('Using ' + config.dataset + ' dataset')
-    model = MultinomialSBM(config)
+    # machine-readable run manifest (run.json), created now and completed when the run ends
+    manifest_path = os.path.join(config.save_dir, MANIFEST_NAME)
+    manifest = new_manifest(exp_name, config, experiment)
+    manifest['parallelism'] = parallelism
+    write_json_atomic(manifest_path, manifest)
     
-    model.train()
-    # SAVE MODEL OUTPUTS (final)
-    np.save(os.path.join(config.save_dir,'model_sample'+str(config.maxiter_gibbs)+'.npy'), model.sample)
-
-    elapsed_time = (time.time() - start_time) /60
+    start_time = time.time()
+    model = None
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        #%% Run code
+        print('Using ' + config.dataset + ' dataset')
+        t0 = time.time()
+        model = MultinomialSBM(config)
+        model.progress = progress
+        if config.metrics:
+            model.metrics = MetricsWriter(os.path.join(config.save_dir, METRICS_NAME), fsync_every=config.metrics_fsync)
+        manifest['timings']['init'] = time.time() - t0
+        manifest['seed'] = model.seed # entropy of the seed sequence (reproduces the run with --seed)
+        if model.init_info is not None:
+            manifest['init_from'] = model.init_info
+            print(f"Initialized from MAP (iteration {model.init_info['MAP_iter']}, noc {model.init_info['noc']}, logP {model.init_info['logP']:.4e}) of {model.init_info['run_dir']}")
+            with open(os.path.join(config.save_dir, 'log.txt'), 'a') as f:
+                f.write(f"init_from_sample: {model.init_info['sample_file']} (MAP iteration {model.init_info['MAP_iter']}, noc {model.init_info['noc']})\n")
+        write_json_atomic(manifest_path, manifest)
+        
+        # SIGTERM or SIGUSR2 (LSF warning before the wall-time kill, bsub -wa USR2) stops training after the current iteration
+        signal.signal(signal.SIGTERM, model.request_stop)
+        signal.signal(signal.SIGUSR2, model.request_stop)
+        if config.profile != 'none':
+            from profiling import Profiler
+            model.profiler = Profiler(config.save_dir, mode=config.profile, start_iter=config.profile_start, stop_iter=config.profile_stop, memory=config.profile_memory)
+        t0 = time.time()
+        model.train()
+        manifest['timings']['train'] = time.time() - t0
+        if model.profiler is not None:
+            report_path = model.profiler.finish()
+            with open(report_path) as f:
+                print(''.join(f.readlines()[:40]))
+            print('Profiling output written to', config.save_dir)
+        signal.signal(signal.SIGTERM, terminate)
+        
+        # SAVE MODEL OUTPUTS (final)
+        t0 = time.time()
+        model.save_sample(os.path.join(config.save_dir,'model_sample'+str(config.maxiter_gibbs)+'.npy'))
+        model.writer.close() # wait for all samples to be written
+        manifest['timings']['save_final'] = time.time() - t0
+        manifest['status'] = 'finished'
+    except BaseException as e:
+        manifest['status'] = 'terminated' if isinstance(e, SystemExit) else 'failed'
+        manifest['error'] = repr(e)
+        raise
+    finally:
+        elapsed_time = (time.time() - start_time) /60
+        manifest['end_time'] = timestamp()
+        manifest['total_time_min'] = elapsed_time
+        manifest['peak_rss_mb'] = peak_rss_mb()
+        if model is not None:
+            model.writer.close()
+            if model.metrics is not None:
+                model.metrics.close()
+            if model.shards is not None:
+                model.shards.close()
+            manifest['timings'].update({'train_'+phase: t for phase, t in model.timings.items()})
+            manifest['iterations'] = model.it
+            manifest['stop_reason'] = model.stop_reason
+            manifest['stop_signal'] = model.stop_signal
+            if model.cache is not None:
+                manifest['cache'] = {'hits': model.cache.hits, 'misses': model.cache.misses}
+            if 'convergence' in model.sample:
+                manifest['convergence'] = model.sample['convergence']
+            if model.unit_test:
+                manifest['unit_test'] = model.unit_test_summary()
+                for name, stats in manifest['unit_test'].items():
+                    print(f"Unit test {name}: {stats['n']} checks, max absdiff {stats['max_absdiff']:.2e}, max reldiff {stats['max_reldiff']:.2e}, mean reldiff {stats['mean_reldiff']:.2e}, {stats['failed']} failed")
+            manifest['noc'] = model.noc
+            manifest['logP'] = model.logP
+            manifest['logP_A'] = model.logP_A
+            manifest['logP_Z'] = model.logP_Z
+            if 'MAP' in model.sample:
+                manifest['MAP_logP'] = model.sample['MAP']['logP']
+                manifest['MAP_iter'] = model.sample['MAP']['iter']
+        write_json_atomic(manifest_path, manifest)
     print('total_time_min:', elapsed_time)
 
-if __name__ == '__main__':
+def get_parser():
     parser = argparse.ArgumentParser()
 
     # Data configuration.
-    parser.add_argument('--dataset', type=str, default='synthetic', help='dataset name (synthetic, hcp, decnef)')
+    parser.add_argument('--dataset', type=str, default='synthetic', help='dataset name (synthetic, hcp, parcel, decnef)')
         # Synthetic data configuration. 
     parser.add_argument('--K', type=int, default=5, help='number of clusters (synthetic data)')
     parser.add_argument('--S1', type=int, default=5, help='number of graphs of type 1 (synthetic data)')
     parser.add_argument('--S2', type=int, default=5, help='number of graphs of type 2 (synthetic data)')
     parser.add_argument('--Nc_type', type=str, default='unbalanced', help='balanced or unbalanced no. of nodes in each cluster')
     parser.add_argument('--alpha', type=float, default=0, help='scaling parameter for similiarty between eta_p1 and eta_p2 (used for article synthetic data)') # only used in article
+        # Parcel-level data configuration.
+    parser.add_argument('--parcel_file', type=str, default='Glasser_counts.npz', help='parcel-level link counts in data/hcp (output of parcellate_graphs.py, parcel data)')
 
     # Model configuration.
     parser.add_argument('--model_type', type=str, default='parametric', help='model type (nonparametric/parametric)')
@@ -89,15 +172,68 @@ if __name__ == '__main__':
     parser.add_argument('--maxiter_eta0', type=int, default=10, help='max number of MH iterations for sampling eta0')
     parser.add_argument('--maxiter_alpha', type=int, default=100, help='max number of MH iterations for sampling alpha')
     parser.add_argument('--maxiter_splitmerge', type=int, default=10, help='max number of splitmerge iterations')
-    parser.add_argument('--unit_test', type=bool, default=False, help='perform unit test (True/False)')
+    parser.add_argument('--candidate_pruning', type=int, default=0, help='Gibbs sweeps score only the clusters a node links to, its own cluster and this many randomly chosen other clusters, with Metropolis-Hastings correction (0: score all clusters)')
+    parser.add_argument('--matlab_compare', type=bool, default=False, help='use random values generated in matlab for comparison (True/False)')
+    parser.add_argument('--unit_test', type=bool, default=False, help='validation mode: check incremental log probabilities of the samplers against evalProbs (from scratch) and report drift statistics (True/False)')
+    parser.add_argument('--unit_test_rate', type=float, default=0.01, help='fraction of nodes (Gibbs sweeps) and MH proposals checked in validation mode')
+    parser.add_argument('--unit_test_reltol', type=float, default=1e-9, help='relative tolerance of checks in validation mode (relative to the compared values, e.g. logQ differences, plus the rounding error of logP computed from scratch)')
+    parser.add_argument('--threshold_annealing', type=bool, default=False, help='use annealing (True/False), only used for nonparametric model')
+    parser.add_argument('--anneal_schedule', type=str, default='geometric', help='annealing schedule of temperature: linear, geometric or adaptive (cooling scaled by node move rate)')
+    parser.add_argument('--anneal_T0', type=float, default=10.0, help='initial annealing temperature')
+    parser.add_argument('--anneal_Tend', type=float, default=1.0, help='final annealing temperature (1 = posterior, <1 = greedy search for MAP)')
+    parser.add_argument('--anneal_iters', type=int, default=100, help='number of iterations to reach final temperature')
+    parser.add_argument('--anneal_target', type=float, default=0.05, help='target fraction of nodes moved per Gibbs sweep (adaptive schedule)')
     parser.add_argument('--use_convergence_criteria', type=bool, default=True, help='use convergence criteria (True/False). If True, the algorithm stops when the convergence criteria is met')
+    parser.add_argument('--convergence_action', type=str, default='stop', help='action when converged: stop (stop training) or stop_splitmerge (continue Gibbs sampling without split-merge)')
+    parser.add_argument('--convergence_min_iter', type=int, default=20, help='minimum number of iterations before convergence can be declared')
+    parser.add_argument('--convergence_min_ess', type=float, default=20, help='minimum effective sample size of logP and noc (second half of chain)')
+    parser.add_argument('--convergence_max_rhat', type=float, default=1.05, help='maximum split-Rhat of logP (across this chain and convergence_chains)')
+    parser.add_argument('--convergence_min_nmi', type=float, default=0.95, help='minimum NMI between successive MAP partitions (last 5 iterations)')
+    parser.add_argument('--convergence_chains', type=str, nargs='*', default=[], help='results folders of other chains of the same experiment (included in split-Rhat)')
+    
+    # Parallelism.
+    parser.add_argument('--num_threads', type=int, default=None, help='number of threads for numba kernels (default: number of LSF slots, LSB_DJOB_NUMPROC, or available cpus)')
+    parser.add_argument('--blas_threads', type=int, default=None, help='number of BLAS threads used by numpy (default: num_threads)')
+    parser.add_argument('--cpu_list', type=str, default=None, help='pin the run to these cpus, e.g. 0-4 (default: no pinning)')
+    parser.add_argument('--chain_index', type=int, default=None, help='index of this chain when several chains share a node; pins the chain to its own block of num_threads cpus')
     
     # Miscellaneous.
+    parser.add_argument('--walltime', type=float, default=None, help='wall-time budget of the run in minutes (e.g. bsub -W), training stops when the next iteration is not predicted to fit')
+    parser.add_argument('--walltime_margin', type=float, default=5, help='minutes of the wall-time budget reserved for saving the final sample')
+    parser.add_argument('--use_cache', type=bool, default=False, help='cache data-derived quantities (symmetrised graphs, initial cluster link counts) across runs on disk (True/False), see README')
+    parser.add_argument('--cache_dir', type=str, default='', help='cache folder (default: main_dir/cache)')
+    parser.add_argument('--cache_size_mb', type=float, default=2000, help='maximum size of cache in MB (least recently used entries are deleted)')
+    parser.add_argument('--save_queue', type=int, default=2, help='max number of sample snapshots waiting to be written (training waits if the writer is further behind)')
+    parser.add_argument('--keep_samples', type=int, default=2, help='number of latest sample files (model_sample{iter}.npy) to keep, older ones are deleted (0: keep all)')
+    parser.add_argument('--MAP_eta_dtype', type=str, default='float64', help='dtype of eta stored in MAP sample: float64, float32 or none (eta not stored)')
+    parser.add_argument('--metrics', type=bool, default=True, help='write one json line of results per iteration (logP, noc, alpha, phase timings, split-merge acceptance, memory) to metrics.jsonl in the results folder, followed by monitor.py (True/False)')
+    parser.add_argument('--metrics_fsync', type=int, default=10, help='sync metrics.jsonl to disk every this many iterations (0: only at the end of the run)')
+    parser.add_argument('--profile', type=str, default='none', help='profile training: none, cprofile (deterministic, exact call counts and call graph) or sample (stack sampling only, low overhead). Output in results folder')
+    parser.add_argument('--profile_start', type=int, default=1, help='first profiled iteration')
+    parser.add_argument('--profile_stop', type=int, default=None, help='last profiled iteration (default: until training ends)')
+    parser.add_argument('--profile_memory', type=bool, default=False, help='trace memory allocations in profiled iterations with tracemalloc (True/False), slows down the profiled iterations many times')
+    parser.add_argument('--sweep_key', type=str, default=None, help='identifier of configuration in a parameter sweep (set by sweep.py, stored in run.json)')
+    parser.add_argument('--subject_workers', type=int, default=0, help='number of worker processes holding the graphs of contiguous ranges of subjects (0: graphs loaded in main process). Only hcp and synthetic data, split-merge is disabled')
+    parser.add_argument('--init_from', type=str, default=None, help='results folder of a previous run on the same data, training starts from the MAP partition, alpha and eta0 of its last saved sample')
+    parser.add_argument('--estimate', type=bool, default=False, help='only estimate peak memory and runtime of the run from the data file headers and short calibration runs, and print suggested LSF resources (True/False)')
+    parser.add_argument('--estimate_nodes', type=int, default=None, help='number of nodes of the smallest calibration run of --estimate (default: max(200, 4 noc, 2 x average degree))')
+    parser.add_argument('--daemon', type=str, default=None, help='Unix socket of a running sampler daemon (daemon.py), the run is made by the daemon and its progress is printed here')
+    parser.add_argument('--seed', type=int, default=None, help='seed of random number generators (default: random seed, which is saved in run.json)')
     parser.add_argument('--main_dir', type=str, default='/work3/s174162/speciale/', help='main directory')
     parser.add_argument('--save_dir', type=str, default=None, help='directory to save results')
     parser.add_argument('--disp', type=bool, default=True, help='display iteration results (True/False)')
     parser.add_argument('--sample_step', type=int, default=1, help='number of iterations between each logged sample')
     parser.add_argument('--save_step', type=int, default=10, help='number of iterations between each saved sample (temporay results files)')
+    parser.add_argument('--trace_Z', type=bool, default=True, help='store the partition of each logged sample in sample[\'Z\'] (delta-encoded, see partition_trace.py)')
+    parser.add_argument('--trace_keyframe_step', type=int, default=100, help='number of logged partitions between each full partition (keyframe) of the partition trace')
+
+    return parser
 
+if __name__ == '__main__':
+    parser = get_parser()
     config = parser.parse_args()
+    if config.daemon:
+        from daemon import submit_config
+        event = submit_config(config.daemon, config, parser)
+        sys.exit(0 if event['status'] == 'finished' else 1)
     main(config)
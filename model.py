@@ -10,11 +10,32 @@ import numpy as np
 from scipy.sparse import csr_matrix, load_npz, triu # csc_matrix
 from scipy.special import gammaln, gamma
 import time
+from collections import OrderedDict
 from numba import njit, prange
-import scipy.io
-from helper_functions import compute_A#, generate_syndata
+from convergence import ConvergenceMonitor, load_logP_trace
+from partition_trace import PartitionTrace
+from run_utils import AsyncWriter, current_rss_mb
+from data_cache import DataCache, file_digest
 
-os.environ["OMP_NUM_THREADS"] = "10"  # set number of threads
+# graphs of HCP dataset (first 5 functional, last 5 structural)
+hcp_filenames = ['fmri_sparse1.npz', 'fmri_sparse2.npz', 'fmri_sparse3.npz', 'fmri_sparse4.npz', 'fmri_sparse5.npz', 
+                 'dmri_sparse1.npz', 'dmri_sparse2.npz', 'dmri_sparse3.npz', 'dmri_sparse4.npz', 'dmri_sparse5.npz']
+
+# datasets loaded by MultinomialSBM that are kept in memory for later runs in the same process (None: not kept, see keep_data_resident)
+resident_data = None
+resident_max = 0 # maximum number of resident datasets (least recently used are dropped)
+
+def keep_data_resident(max_datasets=2):
+    # keep the last max_datasets loaded datasets in memory, so later runs in this process on the same (unchanged) data files do 
+    # not load them again (used by the worker processes of daemon.py; the graphs are only read by the model, so runs can share them)
+    global resident_data, resident_max
+    if resident_data is None:
+        resident_data = OrderedDict()
+    resident_max = max_datasets
+
+def synthetic_filename(config):
+    # name (without .npy) of synthetic adjacency matrix in data/synthetic of configuration (K, S1, S2, Nc_type, alpha)
+    return 'A_'+str(config.K)+'_'+str(config.S1)+'_'+str(config.S2)+'_'+str(config.Nc_type)+'_{:.3g}'.format(config.alpha)
 
 ## numba code for matrix multiplication between parallel csr sparse matrix A and dense matrix B
 # wrapper with initialization of result array
@@ -70,6 +91,8 @@ class MultinomialSBM(object): # changed name from IRMUnipartiteMultinomial to Mu
         self.S2 = config.S2
         self.Nc_type = config.Nc_type
         self.alpha = config.alpha
+            # Parcel-level data configuration.
+        self.parcel_file = config.parcel_file
         
         # Model configuration. 
         self.model_type = config.model_type
@@ -82,10 +105,24 @@ class MultinomialSBM(object): # changed name from IRMUnipartiteMultinomial to Mu
         self.maxiter_alpha = config.maxiter_alpha
         self.maxiter_splitmerge = config.maxiter_splitmerge 
         self.matlab_compare = config.matlab_compare
-        #self.unit_test = config.unit_test
-        #self.reltol = 1e-9 # relative tolerance used for unit tests
+        self.candidate_pruning = config.candidate_pruning # number of randomly chosen non-neighbour clusters scored for each node in Gibbs sweeps (0: all clusters)
+        self.unit_test = config.unit_test # validate incremental log probabilities against evalProbs (from scratch) while training
+        self.unit_test_rate = config.unit_test_rate # fraction of nodes (Gibbs sweeps) and proposals (MH samplers) that are checked
+        self.reltol = config.unit_test_reltol # relative tolerance used for unit tests
+        self.unit_test_stats = {} # name of check -> absolute and relative differences and number of failed checks (see unit_test_record)
         self.use_convergence_criteria = config.use_convergence_criteria 
-        self.convergence_criteria = 1e-7 # convergence criteria (based on dlogP/abs(logP))
+        self.convergence_action = config.convergence_action # 'stop' (stop training) or 'stop_splitmerge' (continue with Gibbs sampling only)
+        if self.use_convergence_criteria:
+            reference_chains = [load_logP_trace(run_dir) for run_dir in config.convergence_chains]
+            self.convergence = ConvergenceMonitor(min_iter=config.convergence_min_iter, min_ess=config.convergence_min_ess, max_rhat=config.convergence_max_rhat, 
+                                                  min_nmi=config.convergence_min_nmi, reference_chains=reference_chains)
+        self.threshold_annealing = config.threshold_annealing
+        self.anneal_schedule = config.anneal_schedule # 'linear', 'geometric' or 'adaptive' (geometric cooling scaled by node move rate)
+        self.anneal_T0 = config.anneal_T0 # initial temperature
+        self.anneal_Tend = config.anneal_Tend # final temperature (1 = sample from posterior, <1 = greedy search for MAP)
+        self.anneal_iters = config.anneal_iters # number of iterations to go from T0 to Tend
+        self.anneal_target = config.anneal_target # target fraction of nodes moved per Gibbs sweep (adaptive schedule)
+        self.T = self.anneal_T0 if self.threshold_annealing else 1.0 # temperature of Z updates, target distribution is P(A,Z)^(1/T)
         
         # Miscellaneous.
         self.main_dir = config.main_dir
@@ -93,15 +130,50 @@ class MultinomialSBM(object): # changed name from IRMUnipartiteMultinomial to Mu
         self.disp = config.disp
         self.sample_step = config.sample_step
         self.save_step = config.save_step
+        self.MAP_eta_dtype = config.MAP_eta_dtype # dtype of eta in MAP snapshot ('float64', 'float32' or 'none' to not store eta)
+        self.deadline = config.deadline # time (time.time()) training has to finish by (None: no wall-time budget)
+        self.stop_signal = None # signal number received (SIGTERM/SIGUSR2), training stops after the current iteration
+        self.profiler = None # profiling.Profiler (set by main.py --profile), called at the start of each iteration
+        self.progress = None # function called with a dictionary of results after each iteration (e.g. set by daemon.py to stream progress to the client)
+        self.metrics = None # run_utils.MetricsWriter (set by main.py --metrics), one json line of results is written per iteration
+        self.iteration_times = [] # duration of each iteration (used to predict if the next iteration fits in the wall-time budget)
+        self.writer = AsyncWriter(max_queue=config.save_queue, keep_latest=config.keep_samples) # saves samples in a background thread
+        
+        # Random number generators: independent child streams of one seed for each component of the sampler,
+        # so a run is reproduced by its seed (the entropy is drawn from the OS if no seed is given)
+        seed_seq = np.random.SeedSequence(config.seed)
+        self.seed = seed_seq.entropy
+        self.rng = dict(zip(['init', 'gibbs', 'splitmerge', 'hyper', 'unit_test'], [np.random.default_rng(child) for child in seed_seq.spawn(5)]))
         
         self.it = 0
-        self.sample = {'iter': [], 'Z': [], 'noc': [], 'logP_A': [], 'logP_Z': [], 'logP': [], 'eta': [], 'alpha': [], 'eta0': []}
+        self.logP_A = None
+        self.logP_Z = None
+        self.logP = None
+        self.stop_reason = None # reason for stopping training ('maxiter' or 'converged')
+        self.n_moves = 0 # number of nodes that changed cluster in last Gibbs sweep
+        self.n_reject_pruning = 0 # number of rejected Metropolis-Hastings proposals of candidate-pruned Gibbs sweep (candidate_pruning > 0)
+        self.n_accept_splitmerge = 0 # number of accepted split-merge proposals in last iteration
+        self.timings = {'gibbs': 0.0, 'splitmerge': 0.0, 'alpha': 0.0, 'eta0': 0.0, 'eta': 0.0, 'save': 0.0} # accumulated time (sec) spent in each phase of train()
+        self.sample = {'iter': [], 'Z': [], 'noc': [], 'logP_A': [], 'logP_Z': [], 'logP': [], 'eta': [], 'alpha': [], 'eta0': [], 'T': [], 'moves': []}
+        
+        # Cache of data-derived quantities shared by runs on the same data (None: no caching)
+        self.cache = DataCache(config.cache_dir or os.path.join(self.main_dir, 'cache'), config.cache_size_mb) if config.use_cache else None
         
         # Load data (generate N x N x S adjacency matrix, A)
-        self.load_data()
+        self.A_diag = None # N x S number of links within each node (only parcel-level graphs, where a node is a parcel of vertices)
+        self.shards = None # sharding.ShardedSubjects if the graphs are held by subject-sharded worker processes
+        if config.subject_workers > 0:
+            from sharding import ShardedSubjects
+            self.cache = None
+            self.A = None
+            self.shards = ShardedSubjects(self.dataset, self.subject_sources(), config.subject_workers, self.model_type)
+        else:
+            self.load_data()
         
         # Initialize variables
-        if self.dataset == 'hcp':
+        if self.shards is not None:
+            self.N, self.S = self.shards.N, self.shards.S
+        elif self.dataset == 'hcp':
             self.N = self.A[0].shape[0]
             self.S = len(self.A)
         else:
@@ -109,18 +181,32 @@ class MultinomialSBM(object): # changed name from IRMUnipartiteMultinomial to Mu
         
         self.alpha = np.log(self.N) # chosen heuristically (add to input later if needed)
         self.eta0 = np.ones(self.S) # default (add to input later if needed)
-        self.eta = np.zeros((self.noc, self.noc, self.S))
+        self._eta = None # cache of eta (computed lazily by the eta property)
+        self.n_link_base = None # noc x noc x S number of links between clusters of self.Z (without eta0), kept from the last Gibbs sweep (None: not valid)
+        self.partition_trace = PartitionTrace(self.N, config.trace_keyframe_step) if config.trace_Z else None # delta-encoded partition of each sample (saved in sample['Z'])
         
-        # Initialize Z (random clustering assignment matrix)
-        ind = np.random.choice(self.noc, self.N)
+        # Initialize Z (random clustering assignment matrix, or MAP partition of a previous run)
+        self.init_info = None # provenance of warm start (config.init_from)
+        if config.init_from:
+            ind = self.load_init_state(config.init_from, config)
+            self.noc = int(np.max(ind)) + 1
+        else:
+            ind = self.rng['init'].integers(self.noc, size=self.N)
         self.Z = csr_matrix((np.ones(self.N), (ind, np.arange(self.N))), shape=(self.noc, self.N)).toarray()
         self.Z = self.Z[self.Z.sum(axis=1) > 0,:] # remove empty clusters (if any)
         self.sumZ = [] # no. nodes in each cluster
+        self.noc = self.Z.shape[0]
+        if self.cache is not None and config.seed is not None and not config.init_from: # number of links between clusters of initial partition 
+            # (only shared by runs with the same seed and noc, e.g. repeated runs of a batch job; a random initial partition is never reused)
+            key = self.cache.key('n_link', self.data_digest, config.seed, config.noc)
+            self.n_link_base = self.cache.get_or_compute(key, lambda: self.compute_n_link(Z=self.Z, noc=self.noc, add_eta0=False, eta0=None))
        
     def train(self):
         # Set algorithm variables
-        logP_list = [] # list for saving last 10 logP values (used for evaluate convergence)
         logP = -np.inf
+        MAP_labels = None # node labels of MAP partition (used for convergence diagnostics)
+        MAP_buffers = [np.empty(self.N, dtype=np.int32), np.empty(self.N, dtype=np.int32)] # MAP labels alternate between two buffers (the previous MAP labels are kept for convergence diagnostics)
+        MAP_eta = None # buffer of MAP eta (reused as long as noc is unchanged)
         logP_best = -np.inf
 
         if self.disp: # Display algorithm
@@ -134,97 +220,265 @@ class MultinomialSBM(object): # changed name from IRMUnipartiteMultinomial to Mu
 ############################################################### Main loop ###############################################################
     
         while self.it < self.maxiter:
+            if self.deadline is not None and time.time() + self.predict_iteration_time() > self.deadline:
+                print('Stopping before iteration', self.it+1, 'since it is not predicted to finish within the wall-time budget')
+                self.stop_reason = 'time_limit'
+                break
             self.it += 1
+            if self.profiler is not None:
+                self.profiler.step(self.it)
             start_time = time.time()
+            timings_start = dict(self.timings) # (time spent in each phase of this iteration is written to the metrics file)
             logP_old = logP
 
             # Gibbs sampling of Z
-            JJ = np.random.permutation(self.N) # random permutation of the nodes
+            t0 = time.time()
+            JJ = self.rng['gibbs'].permutation(self.N) # random permutation of the nodes
             
             self.Z, self.logP_A, self.logP_Z, _, _ = self.gibbs_sample_Z(self.Z, JJ, comp=[], Force=[]) # input: Z, A, eta0, alpha, N. Output: Z, logP_A, logP_Z
+            self.timings['gibbs'] += time.time() - t0
+            if self.unit_test:
+                self.unit_test_logP('gibbs_sweep')
             if self.splitmerge:
+                t0 = time.time()
+                self.n_accept_splitmerge = 0
                 for _ in range(self.maxiter_splitmerge):
+                    if self.stop_signal is not None: # skip remaining split-merge proposals
+                        break
                     self.Z, self.logP_A, self.logP_Z, = self.splitmerge_sample_Z(self.Z, self.logP_A, self.logP_Z)
+                self.timings['splitmerge'] += time.time() - t0
             
             self.sumZ = np.sum(self.Z, axis=1) # no. nodes in each cluster
             ind = np.argsort(-self.sumZ) # sort clusters by size (descending)
             self.Z = self.Z[ind,:] # sort partition matrix by cluster size
             self.noc = self.Z.shape[0]
+            if self.n_link_base is not None:
+                self.n_link_base = self.n_link_base[ind][:, ind] # same order of clusters as Z
             
             # Sample alpha
+            t0 = time.time()
             self.sample_alpha() # input: Z, alpha. Output: logP_Z, alpha
+            self.timings['alpha'] += time.time() - t0
             
             # Sample eta0
+            t0 = time.time()
             self.sample_eta0() # input: A, Z, eta0. Output: logP_A, eta0
+            self.timings['eta0'] += time.time() - t0
+            if self.unit_test:
+                self.unit_test_logP('hyperparameters') # logP_A and logP_Z kept by the MH samplers (and split-merge)
+                self.sample['unit_test'] = self.unit_test_summary()
             
-            # Calculate eta (we compute expected value of posterior of eta)
-            self.calculate_eta() # input: Z, eta0. Output: eta
+            # eta (expected value of posterior of eta) is computed from n_link_base when used (MAP improves)
+            self._eta = None
             
             # Evaluate result
             logP = self.logP_A + self.logP_Z # posterior probability (log likelihood + log prior), logP_Z|A
+            self.logP = logP
             dlogP = logP - logP_old
             elapsed_time = (time.time() - start_time) # elapsed time
+            self.iteration_times.append(elapsed_time)
             
             # Display iteration
             if self.it % 1 == 0 and self.disp:
-                print(f"{self.it:12.0f} | {logP:12.4e} | {dlogP/abs(logP):12.4e} | {self.noc:12.0f} | {elapsed_time:12.4f}")
+                print(f"{self.it:12.0f} | {logP:12.4e} | {dlogP/abs(logP):12.4e} | {self.noc:12.0f} | {elapsed_time:12.4f}" + (f" | T = {self.T:.4f}, moves = {self.n_moves}" if self.threshold_annealing else ''))
+            if self.progress is not None:
+                self.progress({'iter': self.it, 'logP': float(logP), 'dlogP': float(dlogP/abs(logP)), 'noc': int(self.noc), 'time': elapsed_time, 'T': float(self.T), 'moves': int(self.n_moves)})
 
             # Store sample
             if self.it % self.sample_step == 0:
                 self.sample['iter'].append(self.it) 
-                #self.sample['Z'].append(self.Z) 
+                if self.partition_trace is not None:
+                    self.partition_trace.append(np.argmax(self.Z, axis=0)) # node labels (changes since the last sample are stored)
                 self.sample['noc'].append(self.noc)
                 self.sample['logP_A'].append(self.logP_A) # logP(A|Z) (log likelihood)
                 self.sample['logP_Z'].append(self.logP_Z) # logP(Z) (log prior)
                 self.sample['logP'].append(logP) # logP(Z,A) (log likelihood + log prior)
+                self.sample['T'].append(self.T) # temperature used for Z updates in this iteration
+                self.sample['moves'].append(self.n_moves) # number of nodes that changed cluster in Gibbs sweep
                 #self.sample['eta'].append(self.eta) 
                 #self.sample['alpha'].append(self.alpha) 
                 #self.sample['eta0'].append(self.eta0)
              
-            # Store MAP sample   
+            # Store MAP sample (compact snapshot: node labels instead of the noc x N partition matrix, copied into reused buffers)
             if logP > logP_best:
+                MAP_labels = MAP_buffers[0] if MAP_labels is not MAP_buffers[0] else MAP_buffers[1]
+                MAP_labels[:] = np.argmax(self.Z, axis=0)
+                if self.MAP_eta_dtype != 'none':
+                    if MAP_eta is None or MAP_eta.shape != self.eta.shape:
+                        MAP_eta = np.empty(self.eta.shape, dtype=self.MAP_eta_dtype)
+                    MAP_eta[:] = self.eta
                 self.sample['MAP'] = {'iter': self.it, 
-                                      'Z': self.Z, 
+                                      'labels': MAP_labels, # cluster of each node (clusters sorted by size)
                                       'noc': self.noc, 
                                       'logP_A': self.logP_A, 
                                       'logP_Z': self.logP_Z, 
                                       'logP': logP, 
-                                      'eta': self.eta, 
+                                      'eta': MAP_eta if self.MAP_eta_dtype != 'none' else None, 
                                       'alpha': self.alpha, 
-                                      'eta0': self.eta0}
+                                      'eta0': self.eta0.copy()}
+                if self.dataset == 'parcel':
+                    self.sample['MAP']['density'] = self.calculate_density(self.Z, self.get_n_link_base() + self.eta0)
                 logP_best = logP
             
             # save sample for every save step (e.g. every 10th iteration)
             if self.it % self.save_step == 0 and self.it > 0:
-                np.save(os.path.join(self.save_dir,'model_sample'+str(self.it)+'.npy'), self.sample)
+                t0 = time.time()
+                self.save_sample(os.path.join(self.save_dir,'model_sample'+str(self.it)+'.npy'))
+                self.timings['save'] += time.time() - t0
             
-            # Convergence criteria
+            # Convergence criteria (ESS of logP and noc, split-Rhat of logP and stability of MAP partition)
             if self.use_convergence_criteria:
-                logP_list.append(logP)
-                if len(logP_list) >= 10:
-                    logP_list = logP_list[-10:]
-                    if np.mean(np.diff(logP_list)/np.abs(logP_list[:-1])) < self.convergence_criteria:
-                        print('Convergence criteria reached')
-                        break
+                self.sample['convergence'] = self.convergence.update(logP, self.noc, MAP_labels)
+            
+            # Live metrics of iteration (followed by monitor.py)
+            if self.metrics is not None:
+                self.metrics.write(self.metrics_record(logP, elapsed_time, timings_start))
+            
+            if self.use_convergence_criteria and self.convergence.converged:
+                if self.convergence_action == 'stop':
+                    print('Convergence criteria reached:', self.sample['convergence'])
+                    self.stop_reason = 'converged'
+                    break
+                elif self.splitmerge:
+                    print('Convergence criteria reached, stopping split-merge sampling:', self.sample['convergence'])
+                    self.splitmerge = False
+            
+            # Update temperature for next iteration
+            if self.threshold_annealing:
+                self.update_temperature()
+            
+            # Stop if the scheduler signalled that the job is about to be killed
+            if self.stop_signal is not None:
+                print('Received signal', self.stop_signal, '- stopping after iteration', self.it)
+                self.stop_reason = 'time_limit'
+                break
+        if self.stop_reason is None:
+            self.stop_reason = 'maxiter'
+        self.save_checkpoint()
             
         # Display final iteration
         print('Result of final iteration')
         print('%12s | %12s | %12s | %12s | %12s ' % ('iter', 'logP', 'dlogP/|logP|', 'noc', 'time'))
         print('%12.0f | %12.4e | %12.4e | %12.0f | %12.4f ' % (self.it, logP, dlogP/abs(logP), self.noc, elapsed_time))
 
+    def metrics_record(self, logP, elapsed_time, timings_start):
+        # results of the last iteration written to the metrics file (json line)
+        record = {'iter': self.it,
+                  'time': time.time(), # end of iteration (unix time)
+                  'iter_time': elapsed_time,
+                  'logP': float(logP),
+                  'logP_A': float(self.logP_A),
+                  'logP_Z': float(self.logP_Z),
+                  'noc': int(self.noc),
+                  'alpha': float(self.alpha),
+                  'eta0_mean': float(np.mean(self.eta0)),
+                  'T': float(self.T),
+                  'moves': int(self.n_moves),
+                  'splitmerge_accept': self.n_accept_splitmerge / self.maxiter_splitmerge if self.splitmerge else None, # fraction of accepted split-merge proposals
+                  'pruning_rejects': self.n_reject_pruning if self.candidate_pruning > 0 else None,
+                  'timings': {phase: self.timings[phase] - timings_start[phase] for phase in self.timings}, # time (sec) of each phase of this iteration
+                  'rss_mb': current_rss_mb()}
+        if 'convergence' in self.sample:
+            record['convergence'] = self.sample['convergence']
+        return record
+
+    def request_stop(self, signum, frame):
+        # signal handler (SIGTERM/SIGUSR2): training stops after the current iteration
+        self.stop_signal = signum
+
+    def predict_iteration_time(self):
+        # predicted duration of the next iteration (the slowest of the last 5 iterations plus 20 %, split-merge makes iteration times vary)
+        if len(self.iteration_times) == 0:
+            return 0.0
+        return 1.2 * max(self.iteration_times[-5:])
+
+    def load_init_state(self, run_dir, config):
+        # Warm start: MAP partition, alpha and eta0 of the last saved sample of a previous run on the same data (sets alpha and eta0, returns node labels)
+        from helper_functions import get_MAP_labels
+        from run_utils import read_manifest, latest_sample_file
+        sample_file = latest_sample_file(run_dir)
+        if sample_file is None:
+            raise FileNotFoundError('No model_sample{iter}.npy to initialize from in ' + run_dir)
+        manifest = read_manifest(run_dir)
+        if manifest is not None: # runs before run.json was written are only checked by their dimensions
+            data_keys = {'synthetic': ['dataset', 'K', 'S1', 'S2', 'Nc_type', 'alpha'], 'parcel': ['dataset', 'parcel_file']}.get(self.dataset, ['dataset'])
+            mismatch = [key for key in data_keys if key in manifest['config'] and manifest['config'][key] != getattr(config, key)]
+            if len(mismatch) > 0:
+                raise ValueError('Run in ' + run_dir + ' used different data: ' + ', '.join(f"{key}={manifest['config'][key]} (now {getattr(config, key)})" for key in mismatch))
+        
+        MAP = np.load(sample_file, allow_pickle=True).item()['MAP']
+        labels = np.asarray(get_MAP_labels({'MAP': MAP}))
+        eta0 = np.asarray(MAP['eta0'], dtype=float)
+        if labels.shape != (self.N,):
+            raise ValueError(f"MAP partition of {sample_file} has {labels.shape[0]} nodes, data has {self.N}")
+        if eta0.shape != (self.S,):
+            raise ValueError(f"eta0 of {sample_file} has {eta0.shape[0]} subjects, data has {self.S}")
+        if not (np.isfinite(MAP['alpha']) and MAP['alpha'] > 0 and np.all(eta0 > 0)):
+            raise ValueError('Invalid alpha or eta0 in ' + sample_file)
+        
+        self.alpha = float(MAP['alpha'])
+        self.eta0 = eta0.copy()
+        _, labels = np.unique(labels, return_inverse=True) # consecutive cluster labels
+        self.init_info = {'run_dir': os.path.abspath(run_dir), 
+                          'sample_file': os.path.basename(sample_file), 
+                          'exp_name': manifest['exp_name'] if manifest is not None else None, 
+                          'model_type': manifest['config'].get('model_type') if manifest is not None else None, 
+                          'MAP_iter': int(MAP['iter']), 
+                          'noc': int(np.max(labels)) + 1, 
+                          'logP': float(MAP['logP']), 
+                          'alpha': self.alpha}
+        return labels
+
+    def save_checkpoint(self):
+        # state of the chain needed to continue sampling (partition, hyperparameters, temperature and random number generator states)
+        checkpoint = {'iter': self.it,
+                      'labels': np.argmax(self.Z, axis=0).astype(np.int32),
+                      'noc': self.noc,
+                      'alpha': self.alpha,
+                      'eta0': self.eta0.copy(),
+                      'T': self.T,
+                      'logP_A': self.logP_A,
+                      'logP_Z': self.logP_Z,
+                      'seed': self.seed,
+                      'rng': {name: rng.bit_generator.state for name, rng in self.rng.items()},
+                      'stop_reason': self.stop_reason}
+        self.writer.save(os.path.join(self.save_dir, 'checkpoint.npy'), checkpoint, prune=False)
+
+    def snapshot_sample(self):
+        # copy of sample dictionary that is not modified by later iterations (lists and reused MAP buffers are copied)
+        sample = {key: value.copy() if isinstance(value, (list, dict)) else value for key, value in self.sample.items()}
+        if self.partition_trace is not None:
+            sample['Z'] = self.partition_trace.state()
+        if 'MAP' in sample:
+            sample['MAP'] = {key: value.copy() if isinstance(value, np.ndarray) else value for key, value in sample['MAP'].items()}
+        return sample
+
+    def save_sample(self, path):
+        # save snapshot of sample dictionary in background thread (call self.writer.close() to wait until it is written)
+        self.writer.save(path, self.snapshot_sample())
+
 ############################################################### Gibbs sampler ###############################################################
     def gibbs_sample_Z(self, Z, JJ, comp, Force):
+        # Gibbs sweep of Z. Unrestricted sweeps (comp is empty, always for the parametric model) are done by gibbs_sample_Z_slots
+        # (or gibbs_sample_Z_sharded), this function does the restricted sweeps of the split-merge sampler, where the nodes JJ are
+        # only assigned to the clusters in comp (Force: forced assignments, index in comp of each node, used to compute the
+        # transition probability of the reverse move)
         logQ_trans = 0 # log of transition probability of Z (used for split-merge MH sampler step)
         if self.model_type == 'parametric':
             Force = []
             comp = []
+        if self.shards is not None:
+            return self.gibbs_sample_Z_sharded(Z, JJ)
+        if len(comp) == 0:
+            return self.gibbs_sample_Z_slots(Z, JJ)
         if self.matlab_compare:
+            import scipy.io # only needed when comparing with matlab
             randval_list = scipy.io.loadmat('matlab_randvar/rand_val.mat')['randval_list'].ravel()
         
+        rng = self.rng['splitmerge'] # restricted Gibbs sweeps are part of the split-merge proposal
         const = self.multinomialln(self.eta0) # likelihood constant, log B(eta0)
         self.sumZ = np.sum(Z, axis=1) # number of nodes in each cluster
         self.noc = Z.shape[0] # number of clusters
-    
         n_link = self.compute_n_link(Z=Z, noc=self.noc, add_eta0=True, eta0=self.eta0) # sufficient statistic
         
         mult_eval = self.multinomialln(n_link) # compute (multinomial) log likelihood of number of links between clusters, log Beta(nlink+eta0)
@@ -242,97 +496,41 @@ class MultinomialSBM(object): # changed name from IRMUnipartiteMultinomial to Mu
             if len(d) > 0: # if d is not an empty list (there exists non-empty cluster exist for node i
                 n_link[:, d, :] -= ZAi # removing link contribution of node i: (number of links between clusters and non-empty cluster d) minus (sum of links between node i and other nodes in respective cluster/block for subject s)
                 n_link[d, :, :] = np.transpose(n_link[:, d, :], (1,0,2)) # making sure n_link is symmetric
+                if self.A_diag is not None:
+                    n_link[d, d, :] -= self.A_diag[i] # removing links within node i (parcel-level graphs)
                 Z[:, i] = 0 # remove cluster assignment for node i (i.e. remove it from cluster d)
 
-            ######### NOT in split merge sampler step (comp is empty) #########
-            if len(comp) == 0: # if no components are given (i.e. if we are not in the split-merge MH sampler step)
-                if self.sumZ[d] == 0: #if sum of nodes in cluster d is 0 then it means that node i was the only node in cluster d ("singleton cluster") and since we removed node i's contibution to sumZ, the cluster is now empty
-                    v = np.arange(self.noc) 
-                    v = v[v != d] # removing singleton cluster
-                    d = [] 
-                    self.noc -= 1 # reducing number of clusters by 1 
-                    P = csr_matrix((np.ones(self.noc),(np.arange(self.noc),v)), shape=(self.noc, self.noc+1))#.toarray() # NEW (changed from csc to csr)
-                    Z = spdenmatmul(P,Z) # NEW
-                    ZAi = ZAi[v, :, :]
-                    self.sumZ = self.sumZ[v]
-                    n_link = n_link[v][:, v, :]
-                    mult_eval = mult_eval[v][:, v]
- 
-                # Calculate probability for existing communities as well as proposal cluster
-                mult_eval[:,d] = self.multinomialln(n_link[:,d,:]) # updating likelihood given that node i is NOT in cluster d - i.e. compute multinomial likelihood for number of links between cluster d and other clusters for each subject  
-                mult_eval[d,:] = mult_eval[:,d].T
-                sum_mult_eval_dnoi = np.sum(mult_eval, axis=0)
-                if self.model_type == 'nonparametric':
-                    mult_eval_di = self.multinomialln(np.concatenate((n_link + ZAi, ZAi + self.eta0), axis=1)) # (note we use broadcasting here to add the contribution of node i to each cluster)
-                    logQ = np.append(np.sum(mult_eval_di[:, :self.noc], axis=0), np.sum(mult_eval_di[:, self.noc], axis=0) - self.noc * const).T - np.append(sum_mult_eval_dnoi, 0) # note that prior is not included here since its just constant
-                else:
-                    mult_eval_di = self.multinomialln(n_link + ZAi)
-                    logQ = np.sum(mult_eval_di, axis=0) - sum_mult_eval_dnoi # notice that the conditional prior is not included here, but instead implemented as weight 
-                
-                # Sample from posterior conditional
-                QQ = np.exp(logQ - np.max(logQ)) # normalize to avoid numerical problems
-                if self.model_type == 'nonparametric':
-                    weight = np.append(self.sumZ, self.alpha) # alpha is the weight for the CRP prior
-                else:
-                    weight = self.sumZ + self.alpha # = gamma(self.sumZ + 1 + self.alpha)/gamma(self.sumZ + self.alpha)
-                    
-                #if self.unit_test:
-                #    self.unit_test_gibbs(logQ, weight, i)
-                
-                QQ = weight * QQ # compute true (weighted) pdf (weighted by the conditional prior)
-                randval = np.random.rand()
-                ind = np.argmax(randval < np.cumsum(QQ/np.sum(QQ)),axis=0) # generate random sample using cdf (inverse transform sampling)
-                if ind >= self.noc: # this part is only the case for CRP prior (if self.model_type == 'nonparametric')
-                        # modifying shapes to include extra cluster
-                        Z = np.concatenate((Z, np.zeros((1,self.N))), axis=0)
-                        self.noc = Z.shape[0]
-                        n_link = np.concatenate((n_link, np.zeros((1, self.noc-1, self.S))), axis = 0)
-                        n_link = np.concatenate((n_link, np.zeros((self.noc, 1, self.S))), axis = 1)
-                        mult_eval = np.concatenate((mult_eval, np.zeros((1, self.noc-1))), axis=0)
-                        mult_eval = np.concatenate((mult_eval, np.zeros((self.noc, 1))), axis=1)
-                        ZAi = np.concatenate((ZAi, np.zeros((1, 1, self.S))), axis=0)
-                        Z[ind, i] = 1 # updating partition: assigning node i to cluster with given index ind)
-                        self.sumZ = np.append(self.sumZ, 0) # add zero nodes to the last cluster
-                        n_link[:, ind, :] = self.eta0.reshape(1, 1, -1)
-                        n_link[ind, :, :] = self.eta0.reshape(1, 1, -1)
-                        mult_eval[:, ind] = 0 
-                        mult_eval[ind, :] = 0
-                        mult_eval_di = np.append(mult_eval_di[:, ind], const).T
-                        ZAi[ind, 0, :] = 0
-                else: # ind < self.noc
-                    Z[ind, i] = 1 #  updating partition: assigning node i to cluster with given index ind)
-                    mult_eval_di = mult_eval_di[:, ind]
-                    
-            else: ######### In split merge sampler step (comp is NOT empty meaning that the Gibbs sampling will be restricted to the given clusters in comp)!!! #########
-                # Calculate probability for existing communities as well as proposal cluster (only for non-parametric model) - only changes for lines where sum_mult_eval_dnoi and mult_eval_di are computed
-                mult_eval[:,d] = self.multinomialln(n_link[:,d,:]) # updating likelihood given that node i is NOT in cluster d - i.e. compute multinomial likelihood for number of links between cluster d and other clusters for each subject                 
-                mult_eval[d,:] = mult_eval[:,d].T
-                sum_mult_eval_dnoi = np.sum(mult_eval[:, comp], axis=0)
-                mult_eval_di = self.multinomialln(n_link[:,comp,:] + ZAi) # (note we use broadcasting here to add the contribution of node i to each cluster)
-                logQ = sum_mult_eval_dnoi + np.sum(mult_eval_di, axis=0)
+            # Calculate probability for the clusters in comp (Gibbs sampling restricted to the given clusters)
+            mult_eval[:,d] = self.multinomialln(n_link[:,d,:]) # updating likelihood given that node i is NOT in cluster d - i.e. compute multinomial likelihood for number of links between cluster d and other clusters for each subject                 
+            mult_eval[d,:] = mult_eval[:,d].T
+            sum_mult_eval_dnoi = np.sum(mult_eval[:, comp], axis=0)
+            mult_eval_di = self.multinomialln(self.add_node_links(n_link[:,comp,:], ZAi, i, comp)) # (note we use broadcasting here to add the contribution of node i to each cluster)
+            logQ = np.sum(mult_eval_di, axis=0) - sum_mult_eval_dnoi
+            
+            # Sample from posterior conditional
+            QQ = np.exp((logQ - np.max(logQ)) / self.T) # normalize to avoid numerical problems (tempered by T when annealing)
+            weight = self.sumZ[comp]
+            if self.unit_test and self.rng['unit_test'].random() < self.unit_test_rate:
+                self.unit_test_gibbs(Z, comp, logQ, weight, i, name='splitmerge_gibbs')
                 
-                # Sample from posterior conditional
-                QQ = np.exp(logQ - np.max(logQ)) # normalize to avoid numerical problems
-                weight = self.sumZ[comp]
-                #if self.unit_test:
-                #    self.unit_test_splitmerge_Z(Z, comp, i, logQ, weight)
-                    
-                QQ = weight * QQ # compute true (weighted) pdf
-                if len(Force) == 0:
-                    ind = np.argmax(np.random.rand() < np.cumsum(QQ/np.sum(QQ)), axis=0) # generate random sample using cdf (inverse transform sampling)
-                else:
-                    ind = int(Force[i])
-                q_tmp = logQ - np.max(logQ) + np.log(weight)
-                q_tmp -= np.log(np.sum(np.exp(q_tmp)))
-                logQ_trans += q_tmp[ind]
-                Z[comp[ind], i] = 1
-                mult_eval_di = mult_eval_di[:, ind]
-                mult_eval[d,:] = mult_eval[:,d].T
-                ind = comp[ind]
+            QQ = weight ** (1 / self.T) * QQ # compute true (weighted) pdf
+            if len(Force) == 0:
+                ind = np.argmax(rng.random() < np.cumsum(QQ/np.sum(QQ)), axis=0) # generate random sample using cdf (inverse transform sampling)
+            else:
+                ind = int(Force[i])
+            q_tmp = (logQ - np.max(logQ) + np.log(weight)) / self.T
+            q_tmp -= np.log(np.sum(np.exp(q_tmp)))
+            logQ_trans += q_tmp[ind]
+            Z[comp[ind], i] = 1
+            mult_eval_di = mult_eval_di[:, ind]
+            mult_eval[d,:] = mult_eval[:,d].T
+            ind = comp[ind]
                 
             # Add contribution of new node i partition assignment
             self.sumZ += Z[:, i] # updating sum of nodes in each cluster, i.e. adding new node assignment (node i) to respective cluster
             n_link[:, ind, :] += ZAi[:,0,:] # update af number of links
+            if self.A_diag is not None:
+                n_link[ind, ind, :] += self.A_diag[i] # links within node i (parcel-level graphs)
             n_link[ind, :, :] = n_link[:,ind,:].copy()
             mult_eval[:, ind] = mult_eval_di
             mult_eval[ind, :] = mult_eval_di.T
@@ -340,9 +538,8 @@ class MultinomialSBM(object): # changed name from IRMUnipartiteMultinomial to Mu
             # Remove empty clusters
             if np.any(self.sumZ == 0): # if any empty clusters exists
                 d = np.nonzero(self.sumZ == 0)[0] # find empty cluster
-                if len(comp) > 0:
-                    ind_d = np.nonzero(d < comp)[0] # find index of empty cluster in comp
-                    comp[ind_d] = comp[ind_d] - 1 # update comp to reflect that cluster d is removed
+                ind_d = np.nonzero(d < comp)[0] # find index of empty cluster in comp
+                comp[ind_d] = comp[ind_d] - 1 # update comp to reflect that cluster d is removed
                 v = np.arange(self.noc)
                 v = v[v != d]
                 self.noc -= len(d)
@@ -351,28 +548,281 @@ class MultinomialSBM(object): # changed name from IRMUnipartiteMultinomial to Mu
                 self.sumZ = self.sumZ[v]
                 n_link = n_link[v][:,v,:]
                 mult_eval = mult_eval[v][:,v]                
-            
+        
         # Calculate likelihood for sampled solution (after seeing all nodes and subjects)
         logP_A = np.sum(np.triu(mult_eval)) - self.noc * (self.noc + 1) / 2 * const
-        if self.model_type == 'nonparametric':
-            constZ = np.sum(gammaln(self.sumZ))
-            logP_Z = self.noc * np.log(self.alpha) + constZ - gammaln(self.N + self.alpha) + gammaln(self.alpha)
-        else:
-            logP_Z = gammaln(self.alpha) - gammaln(self.alpha + self.N) - self.noc * gammaln(self.alpha/self.noc) + np.sum(gammaln(self.sumZ + self.alpha/self.noc))
+        logP_Z = self.logP_Z_eval(self.sumZ, self.alpha)
 
         return Z, logP_A, logP_Z, logQ_trans, comp
     
 
+    def gibbs_sample_Z_slots(self, Z, JJ):
+        # Gibbs sweep (no split-merge restriction) with cluster-indexed state (partition, n_link, mult_eval, sumZ) kept in preallocated 
+        # buffers with spare capacity. A cluster occupies a slot: opening a cluster takes a slot from the free list (capacity is doubled 
+        # when none is left) and an emptied cluster returns its slot, so the noc x noc x S tensors are not copied when the number of 
+        # clusters changes. Candidate clusters are ordered by creation (same chain for the same seed as the list-based sweep it replaced).
+        # The buffers are compacted to noc clusters at the end of the sweep.
+        #
+        # Candidate pruning (candidate_pruning = m > 0): only the blocks of clusters node i links to (neighbour clusters) change when node i 
+        # is added to a cluster, so candidates are scored on these rows only, and only the neighbour clusters, the current cluster, a new 
+        # cluster and a random subset R of m of the M non-neighbour clusters are candidates (R contains the current cluster if it is a 
+        # non-neighbour). The sampled cluster is a Metropolis-Hastings proposal: the probability of R given the current and proposed 
+        # cluster only differs when moving from a non-neighbour to a neighbour (or new) cluster, which is accepted with probability m/M 
+        # (otherwise 1), so the posterior is unchanged. Exact Gibbs sampling if M <= m.
+        rng = self.rng['gibbs']
+        const = self.multinomialln(self.eta0) # likelihood constant, log B(eta0)
+        nonparametric = self.model_type == 'nonparametric'
+        m = self.candidate_pruning
+        noc = Z.shape[0]
+        if Z is self.Z and self.n_link_base is not None:
+            n_link_noc = self.n_link_base + self.eta0 # sufficient statistic (kept from last sweep, Z has not changed since)
+        else:
+            n_link_noc = self.compute_n_link(Z=Z, noc=noc, add_eta0=True, eta0=self.eta0)
+        
+        cap = 2 * noc + 2 # capacity (number of slots)
+        Zbuf = np.zeros((cap, self.N))
+        Zbuf[:noc] = Z
+        n_link = np.empty((cap, cap, self.S))
+        n_link[:noc, :noc] = n_link_noc
+        mult_eval = np.zeros((cap, cap)) # zero in rows and columns of free slots
+        mult_eval[:noc, :noc] = self.multinomialln(n_link_noc)
+        sumZ = np.zeros(cap)
+        sumZ[:noc] = np.sum(Z, axis=1)
+        active = np.zeros(cap, dtype=bool) # active-slot mask
+        active[:noc] = True
+        free = list(range(cap-1, noc-1, -1)) # free slot ids (stack, lowest slot on top)
+        order = np.arange(noc) # active slots in order of creation (candidate order)
+        labels = np.argmax(Z, axis=0) # slot of each node
+        
+        self.n_moves = 0
+        self.n_reject_pruning = 0
+        for i in JJ: # for each node (in random permutated order)
+            d = labels[i]
+            sumZ[d] -= 1
+            # Compute link contribution of node i to log likelihood (rows of free slots are zero)
+            if self.dataset == 'hcp':
+                ZAi = np.vstack([(As[i,:] @ Zbuf.T) for As in self.A]).T
+            else:
+                ZAi = Zbuf @ self.A[:, i, :]
+            if m > 0:
+                neighbour = np.zeros(cap, dtype=bool) # clusters node i has links to (in any subject)
+                neighbour[order] = np.any(ZAi[order] != 0, axis=1)
+                rows = order if self.A_diag is not None else order[neighbour[order]] # blocks that change when node i is moved (all for parcel-level graphs)
+            else:
+                rows = order
+            
+            # Remove node i from cluster d
+            Zbuf[d, i] = 0
+            n_link[rows, d, :] -= ZAi[rows]
+            n_link[d, rows, :] = n_link[rows, d, :]
+            if self.A_diag is not None:
+                n_link[d, d, :] -= self.A_diag[i] # removing links within node i (parcel-level graphs)
+            moved_from = d
+            if sumZ[d] == 0: # singleton cluster is closed, its slot is freed
+                active[d] = False
+                free.append(d)
+                order = order[order != d]
+                rows = rows[rows != d]
+                mult_eval[d, :] = 0
+                mult_eval[:, d] = 0
+                moved_from = None
+            else:
+                mult_eval[rows, d] = self.multinomialln(n_link[rows, d, :])
+                mult_eval[d, rows] = mult_eval[rows, d]
+            noc = len(order)
+            
+            # Candidate clusters
+            n_other = 0 # number of non-neighbour clusters (M)
+            if m > 0:
+                others = order[~neighbour[order]]
+                n_other = len(others)
+            if n_other > m:
+                in_R = np.zeros(cap, dtype=bool)
+                if moved_from is not None and not neighbour[d]: # current cluster is always in R
+                    in_R[d] = True
+                    in_R[rng.choice(others[others != d], m-1, replace=False)] = True
+                else:
+                    in_R[rng.choice(others, m, replace=False)] = True
+                cand = order[neighbour[order] | in_R[order]]
+            else:
+                cand = order
+            n_cand = len(cand)
+            
+            # Calculate probability for candidate clusters as well as proposal cluster
+            ZAi_rows = ZAi[rows][:, np.newaxis, :]
+            if self.A_diag is not None:
+                row_index = np.zeros(cap, dtype=int)
+                row_index[rows] = np.arange(len(rows))
+            n_link_di = self.add_node_links(n_link[np.ix_(rows, cand)], ZAi_rows, i, row_index[cand] if self.A_diag is not None else None)
+            sum_mult_eval_dnoi = np.sum(mult_eval[np.ix_(rows, cand)], axis=0)
+            if nonparametric:
+                mult_eval_di = self.multinomialln(np.concatenate((n_link_di, ZAi_rows + self.eta0), axis=1)) # (note we use broadcasting here to add the contribution of node i to each cluster)
+                const_new = const if self.A_diag is None else self.multinomialln(self.eta0 + self.A_diag[i]) # block of new cluster with itself (only links within node i)
+                logQ = np.append(np.sum(mult_eval_di[:, :n_cand], axis=0), np.sum(mult_eval_di[:, n_cand], axis=0) - len(rows) * const + const_new - const) - np.append(sum_mult_eval_dnoi, 0)
+                weight = np.append(sumZ[cand], self.alpha) # alpha is the weight for the CRP prior
+            else:
+                mult_eval_di = self.multinomialln(n_link_di)
+                logQ = np.sum(mult_eval_di, axis=0) - sum_mult_eval_dnoi
+                weight = sumZ[cand] + self.alpha
+            
+            if self.unit_test and self.rng['unit_test'].random() < self.unit_test_rate:
+                row = np.zeros(cap, dtype=int)
+                row[order] = np.arange(noc)
+                self.unit_test_gibbs(Zbuf[order], row[cand], logQ, weight, i)
+            
+            # Sample from posterior conditional
+            QQ = np.exp((logQ - np.max(logQ)) / self.T) # tempered by T when annealing
+            QQ = weight ** (1 / self.T) * QQ
+            ind = np.argmax(rng.random() < np.cumsum(QQ/np.sum(QQ)), axis=0) # generate random sample using cdf (inverse transform sampling)
+            if n_other > m and moved_from is not None and not neighbour[d] and (ind >= n_cand or neighbour[cand[ind]]):
+                # move from a non-neighbour to a neighbour (or new) cluster, MH acceptance probability m/M
+                if rng.random() >= m / n_other:
+                    ind = np.nonzero(cand == d)[0][0]
+                    self.n_reject_pruning += 1
+            if ind < n_cand:
+                slot = cand[ind]
+                self.n_moves += slot != moved_from
+                mult_eval_di = mult_eval_di[:, ind]
+            else: # open new cluster in a free slot
+                if len(free) == 0: # double capacity
+                    Zbuf = np.concatenate((Zbuf, np.zeros((cap, self.N))), axis=0)
+                    n_link_new = np.empty((2*cap, 2*cap, self.S))
+                    n_link_new[:cap, :cap] = n_link
+                    n_link = n_link_new
+                    mult_eval = np.pad(mult_eval, ((0, cap), (0, cap)))
+                    sumZ = np.append(sumZ, np.zeros(cap))
+                    active = np.append(active, np.zeros(cap, dtype=bool))
+                    free = list(range(2*cap-1, cap-1, -1))
+                    ZAi = np.concatenate((ZAi, np.zeros((cap, self.S))), axis=0)
+                    cap *= 2
+                self.n_moves += moved_from is not None # a singleton node that opens a new cluster has not moved
+                slot = free.pop()
+                active[slot] = True
+                n_link[slot, :, :] = self.eta0
+                n_link[:, slot, :] = self.eta0
+                mult_eval[order, slot] = const # blocks with clusters node i has no links to
+                mult_eval[slot, order] = const
+                mult_eval_di = np.append(mult_eval_di[:, n_cand], const_new)
+                order = np.append(order, slot)
+                rows = np.append(rows, slot)
+            
+            # Add contribution of new node i partition assignment
+            labels[i] = slot
+            Zbuf[slot, i] = 1
+            sumZ[slot] += 1
+            n_link[rows, slot, :] += ZAi[rows]
+            if self.A_diag is not None:
+                n_link[slot, slot, :] += self.A_diag[i] # links within node i (parcel-level graphs)
+            n_link[slot, rows, :] = n_link[rows, slot, :]
+            mult_eval[rows, slot] = mult_eval_di
+            mult_eval[slot, rows] = mult_eval_di
+        
+        # Compact buffers to the noc active clusters (in order of creation)
+        self.noc = len(order)
+        Z = Zbuf[order]
+        self.sumZ = sumZ[order]
+        mult_eval = mult_eval[np.ix_(order, order)]
+        self.n_link_base = n_link[np.ix_(order, order)] - self.eta0 # sufficient statistic of sampled partition (used by sample_eta0, eta and the next sweep)
+        self._eta = None
+        
+        # Calculate likelihood for sampled solution (after seeing all nodes and subjects)
+        logP_A = np.sum(np.triu(mult_eval)) - self.noc * (self.noc + 1) / 2 * const
+        logP_Z = self.logP_Z_eval(self.sumZ, self.alpha)
+        return Z, logP_A, logP_Z, 0, []
+
+    def gibbs_sample_Z_sharded(self, Z, JJ):
+        # Gibbs sweep with subject-sharded workers (see sharding.py). Same conditional distribution as gibbs_sample_Z_slots,
+        # the multinomial log likelihood of a block is sum_s gammaln(n_link[:, :, s]) (reduced over workers) - gammaln(total number of links of block)
+        rng = self.rng['gibbs']
+        const = self.multinomialln(self.eta0) # likelihood constant, log B(eta0)
+        sum_eta0 = np.sum(self.eta0)
+        labels = np.argmax(Z, axis=0)
+        self.noc = Z.shape[0]
+        self.sumZ = np.bincount(labels, minlength=self.noc)
+        
+        G, n_link_tot = self.shards.begin(labels, self.noc, self.eta0) # n_link_tot: noc x noc number of links (+ eta0) summed over subjects
+        mult_eval = G - gammaln(n_link_tot)
+        self.n_moves = 0
+        prev = None # (node, cluster) of previous node, sent to the workers with the next node
+        for i in JJ:
+            G_prev, zai, G_d, G_cand = self.shards.node(i, prev)
+            if prev is not None: # log likelihood of blocks of the cluster the previous node was assigned to
+                mult_eval[:, prev[1]] = G_prev - gammaln(n_link_tot[:, prev[1]])
+                mult_eval[prev[1], :] = mult_eval[:, prev[1]]
+            
+            # Remove node i from its cluster d
+            d = labels[i]
+            self.sumZ[d] -= 1
+            labels[i] = -1
+            n_link_tot[:, d] -= zai
+            n_link_tot[d, :] = n_link_tot[:, d]
+            moved_from = d
+            if self.sumZ[d] == 0: # singleton cluster is removed
+                v = np.arange(self.noc) != d
+                self.noc -= 1
+                n_link_tot = n_link_tot[v][:, v]
+                mult_eval = mult_eval[v][:, v]
+                zai = zai[v]
+                self.sumZ = self.sumZ[v]
+                labels[labels > d] -= 1
+                moved_from = None
+            else:
+                mult_eval[:, d] = G_d - gammaln(n_link_tot[:, d])
+                mult_eval[d, :] = mult_eval[:, d]
+            sum_mult_eval_dnoi = np.sum(mult_eval, axis=0)
+            
+            # Log likelihood with node i added to each cluster (and to a new cluster for the nonparametric model)
+            logQ = G_cand[:self.noc] - np.sum(gammaln(n_link_tot + zai[:, np.newaxis]), axis=0)
+            if self.model_type == 'nonparametric':
+                logQ_new = G_cand[self.noc] - np.sum(gammaln(zai + sum_eta0))
+                logQ = np.append(logQ, logQ_new - self.noc * const) - np.append(sum_mult_eval_dnoi, 0)
+                weight = np.append(self.sumZ, self.alpha)
+            else:
+                logQ = logQ - sum_mult_eval_dnoi
+                weight = self.sumZ + self.alpha
+            
+            # Sample from posterior conditional
+            QQ = np.exp((logQ - np.max(logQ)) / self.T)
+            QQ = weight ** (1 / self.T) * QQ
+            ind = np.argmax(rng.random() < np.cumsum(QQ/np.sum(QQ)), axis=0)
+            self.n_moves += (ind != moved_from) if moved_from is not None else (ind < self.noc)
+            if ind >= self.noc: # new cluster
+                self.noc += 1
+                self.sumZ = np.append(self.sumZ, 0)
+                n_link_tot = np.pad(n_link_tot, ((0, 1), (0, 1)), constant_values=sum_eta0)
+                mult_eval = np.pad(mult_eval, ((0, 1), (0, 1)))
+                zai = np.append(zai, 0)
+            labels[i] = ind
+            self.sumZ[ind] += 1
+            n_link_tot[:, ind] += zai
+            n_link_tot[ind, :] = n_link_tot[:, ind]
+            prev = (i, ind)
+        
+        G_prev, n_link_base = self.shards.finish(prev)
+        if prev is not None:
+            mult_eval[:, prev[1]] = G_prev - gammaln(n_link_tot[:, prev[1]])
+            mult_eval[prev[1], :] = mult_eval[:, prev[1]]
+        self.n_link_base = n_link_base # kept for sample_eta0, eta and the next sweep
+        self._eta = None
+        Z = np.zeros((self.noc, self.N))
+        Z[labels, np.arange(self.N)] = 1
+        
+        logP_A = np.sum(np.triu(mult_eval)) - self.noc * (self.noc + 1) / 2 * const
+        logP_Z = self.logP_Z_eval(self.sumZ, self.alpha)
+        return Z, logP_A, logP_Z, 0, []
+
+
 ############################################################### Metropolis-Hastings samplers ###############################################################
 # Split-merge (version of MH) sampler for Z
 # MH sampler for alpha
 # MH sampler for eta0
 
     def splitmerge_sample_Z(self, Z, logP_A, logP_Z):
+        rng = self.rng['splitmerge']
         self.noc, self.N = Z.shape # number of clusters and number of nodes
         # choose two random nodes
-        ind1 = int(np.ceil(self.N * np.random.rand()))-1
-        ind2 = int(np.ceil((self.N-1) * np.random.rand()))-1
+        ind1 = int(np.ceil(self.N * rng.random()))-1
+        ind2 = int(np.ceil((self.N-1) * rng.random()))-1
         
         if ind1 <= ind2:
             ind2 += 1
@@ -394,7 +844,7 @@ class MultinomialSBM(object): # changed name from IRMUnipartiteMultinomial to Mu
             Z_t[comp[1], ind2] = 1
             
             # Reassign by restricted Gibbs sampling
-            JJ = setZ[np.random.permutation(n_setZ)]
+            JJ = setZ[rng.permutation(n_setZ)]
             if n_setZ > 0:
                 for _ in range(3): # "3 restricted gibbs sampling sweeps"
                     Z_t, logP_A_t, logP_Z_t, logQ_trans, comp = self.gibbs_sample_Z(Z_t, JJ, comp, Force=[]) # input: Z, A, eta0, alpha, N. Output: Z, logP_A, logP_Z
@@ -403,13 +853,15 @@ class MultinomialSBM(object): # changed name from IRMUnipartiteMultinomial to Mu
                 logP_A_t, logP_Z_t = self.evalProbs(Z_t, self.eta0, self.alpha)
                 
             # Calculate Metropolis-Hastings ratio
-            a_split = np.random.rand() < np.exp(logP_A_t + logP_Z_t - logP_A - logP_Z - logQ_trans) # acceptance probability for splitting cluster
+            a_split = rng.random() < np.exp((logP_A_t + logP_Z_t - logP_A - logP_Z) / self.T - logQ_trans) # acceptance probability for splitting cluster (target P^(1/T) when annealing)
             
             if a_split:
                 print('Splitting cluster', str(clust1))
+                self.n_accept_splitmerge += 1
                 logP_A = logP_A_t
                 logP_Z = logP_Z_t
                 Z = Z_t.copy()
+                self.n_link_base = None # sufficient statistic of accepted partition is computed when needed
         else: # merge
             Z_t = Z.copy()
             Z_t[clust1, :] = Z_t[clust1, :] + Z_t[clust2, :] # merging clusters by adding node contribution of clust2 to clust1
@@ -435,27 +887,46 @@ class MultinomialSBM(object): # changed name from IRMUnipartiteMultinomial to Mu
             Z_tt[comp[1], ind2] = 1
             
             # Reassign by restricted Gibbs sampling
-            JJ = setZ[np.random.permutation(n_setZ)]
+            JJ = setZ[rng.permutation(n_setZ)]
             if n_setZ > 0:
                 for _ in range(2):
                     Z_tt, _, _, _, comp = self.gibbs_sample_Z(Z_tt, JJ, comp, Force=[])
                 Force = np.array([0, 1]) @ Z[[clust1, clust2], :]
-                JJ = setZ[np.random.permutation(n_setZ)]
+                JJ = setZ[rng.permutation(n_setZ)]
                 _, _, _, logQ_trans, _ = self.gibbs_sample_Z(Z_tt, JJ, comp, Force)
             else:
                 logQ_trans = 0
             
             # Calculate Metropolis-Hastings ratio
-            a_merge = np.random.rand() < np.exp(logP_A_t + logP_Z_t - logP_A - logP_Z + logQ_trans) # acceptance probability for mergin clusters
+            a_merge = rng.random() < np.exp((logP_A_t + logP_Z_t - logP_A - logP_Z) / self.T + logQ_trans) # acceptance probability for mergin clusters (target P^(1/T) when annealing)
             if a_merge:
                 print('Merging clusters', str(clust1), 'and', str(clust2))
+                self.n_accept_splitmerge += 1
                 logP_A = logP_A_t.copy()
                 logP_Z = logP_Z_t.copy()
                 Z = Z_t.copy()
+                self.n_link_base = None # sufficient statistic of accepted partition is computed when needed
         
         return Z, logP_A, logP_Z
 
 
+    def update_temperature(self): # annealing schedule for temperature of Z updates
+        # linear:       T decreases linearly from T0 to Tend over anneal_iters iterations
+        # geometric:    T decreases by a constant factor (Tend/T0)^(1/anneal_iters) per iteration
+        # adaptive:     geometric factor raised to (fraction of nodes moved in last sweep)/anneal_target, i.e. cool fast while the chain is mobile and slow when it freezes
+        # T stays at Tend once reached
+        if self.anneal_schedule == 'linear':
+            self.T = self.anneal_T0 + (self.anneal_Tend - self.anneal_T0) * min(self.it / self.anneal_iters, 1)
+        elif self.anneal_schedule == 'geometric':
+            self.T = self.anneal_T0 * (self.anneal_Tend / self.anneal_T0) ** min(self.it / self.anneal_iters, 1)
+        elif self.anneal_schedule == 'adaptive':
+            factor = (self.anneal_Tend / self.anneal_T0) ** (1 / self.anneal_iters)
+            move_rate = (self.n_moves + self.n_accept_splitmerge) / self.N
+            self.T = self.T * factor ** min(move_rate / self.anneal_target, 2)
+        else:
+            raise ValueError('Unknown annealing schedule: ' + str(self.anneal_schedule))
+        self.T = max(self.T, self.anneal_Tend) if self.anneal_T0 >= self.anneal_Tend else min(self.T, self.anneal_Tend)
+
     def sample_alpha(self): # MH sampler for alpha
         # sample hyperparameter: "concentration parameter" / "rate of generating new clusters" used in CRP dist., imposes improper uniform prior, Metropolis Hastings
         if self.model_type == 'nonparametric':
@@ -463,17 +934,17 @@ class MultinomialSBM(object): # changed name from IRMUnipartiteMultinomial to Mu
         
         accept = 0
         for i in range(self.maxiter_alpha):
-            randnalpha = np.random.randn() # Normally distributed random variable
+            randnalpha = self.rng['hyper'].standard_normal() # Normally distributed random variable
             alpha_new = np.exp(np.log(self.alpha) + 0.1 * randnalpha)  # symmetric proposal distribution in log-domain (use change of variable in acceptance rate alpha_new/alpha)
             if self.model_type == 'nonparametric':
                 logP_Z_new = self.noc * np.log(alpha_new) + constZ - gammaln(self.N + alpha_new) + gammaln(alpha_new)
             else:
                 logP_Z_new = gammaln(self.noc * alpha_new) - gammaln(self.noc * alpha_new + self.N) - self.noc * gammaln(alpha_new) + np.sum(gammaln(self.sumZ + alpha_new))
 
-            #if self.unit_test:
-            #    self.unit_test_MH_alpha(alpha_new=alpha_new, logP_Z_new=logP_Z_new, logP_Z=self.logP_Z)
+            if self.unit_test and self.rng['unit_test'].random() < self.unit_test_rate:
+                self.unit_test_MH_alpha(alpha_new=alpha_new, logP_Z_new=logP_Z_new, logP_Z=self.logP_Z)
             
-            randalpha = np.random.rand()
+            randalpha = self.rng['hyper'].random()
             if randalpha < alpha_new / self.alpha * np.exp(logP_Z_new - self.logP_Z):  # if u_k < acceptance probability A
                 self.alpha = alpha_new
                 self.logP_Z = logP_Z_new
@@ -483,13 +954,13 @@ class MultinomialSBM(object): # changed name from IRMUnipartiteMultinomial to Mu
 
 
     def sample_eta0(self): # MH sampler for eta0
-        n_link_noeta0 = self.compute_n_link(Z=self.Z, noc=self.noc, add_eta0=False, eta0=None)
+        n_link_noeta0 = self.get_n_link_base()
         n_link = n_link_noeta0 + self.eta0
  
         accept = 0
         for s in range(self.S):
             for i in range(self.maxiter_eta0):
-                randneta0 = np.random.randn() # Normally distributed random variable
+                randneta0 = self.rng['hyper'].standard_normal() # Normally distributed random variable
                 # generate candidate sample eta0 by adding noise (en from standard deviation) to current eta0
                 eta_new = np.exp(np.log(self.eta0[s]) + 0.1 * randneta0)  # symmetric proposal distribution in log-domain (use change of variable in acceptance rate alpha_new/alpha)
                 eta0_new = self.eta0.copy()
@@ -499,11 +970,11 @@ class MultinomialSBM(object): # changed name from IRMUnipartiteMultinomial to Mu
                 n_link_new[:,:,s] = n_link_noeta0[:,:,s] + eta_new
                 logP_A_new = np.sum(np.triu(self.multinomialln(n_link_new))) - self.noc*(self.noc+1)/2 * const_new
                 
-                #if self.unit_test:
-                #    self.unit_test_MH_eta0(eta0_new = eta0_new, logP_A_new = logP_A_new, logP_A = self.logP_A)
+                if self.unit_test and self.rng['unit_test'].random() < self.unit_test_rate:
+                    self.unit_test_MH_eta0(eta0_new = eta0_new, logP_A_new = logP_A_new, logP_A = self.logP_A)
                 
                 # randeta0 is u_k
-                randeta0 = np.random.rand()
+                randeta0 = self.rng['hyper'].random()
                 if randeta0 < (eta_new/self.eta0[s]) * np.exp(logP_A_new - self.logP_A): # r_p = logP_A_new - self.logP_A
                     self.eta0[s] = eta_new
                     self.logP_A = logP_A_new
@@ -514,42 +985,134 @@ class MultinomialSBM(object): # changed name from IRMUnipartiteMultinomial to Mu
 
 
 ############################################################### Data processing functions ###############################################################    
+    def subject_sources(self):
+        # source of each subject's graph (used by subject-sharded workers to load only their own subjects, see sharding.py)
+        data_path = os.path.join(self.main_dir, 'data/'+self.dataset)
+        if self.dataset == 'synthetic':
+            filename = synthetic_filename(self)
+            S = np.load(os.path.join(data_path, filename+'.npy'), mmap_mode='r').shape[2]
+            return [(os.path.join(data_path, filename+'.npy'), s) for s in range(S)]
+        elif self.dataset == 'hcp':
+            return [os.path.join(data_path, filename) for filename in hcp_filenames]
+        raise ValueError('Subject sharding is not supported for dataset ' + str(self.dataset))
+
+    def data_files(self):
+        # paths of the data files of the dataset
+        if self.dataset == 'synthetic':
+            return [os.path.join(self.main_dir, 'data', 'synthetic', synthetic_filename(self)+'.npy')]
+        elif self.dataset == 'hcp':
+            return [os.path.join(self.main_dir, 'data', 'hcp', filename) for filename in hcp_filenames]
+        elif self.dataset == 'parcel':
+            return [os.path.join(self.main_dir, 'data', 'hcp', self.parcel_file)]
+        return []
+
     def load_data(self):
+        # load graphs (reused if they are resident, see keep_data_resident, and the data files have not changed since)
+        key = None
+        if resident_data is not None:
+            key = (self.dataset, self.cache is not None) + tuple((path, os.stat(path).st_mtime_ns) for path in self.data_files())
+            if key in resident_data:
+                resident_data.move_to_end(key)
+                self.__dict__.update(resident_data[key])
+                return
+            paths = [path for path, _ in key[2:]]
+            for old_key in [old_key for old_key in resident_data if [path for path, _ in old_key[2:]] == paths]: # data files have changed
+                del resident_data[old_key]
+            while len(resident_data) >= max(resident_max, 1): # least recently used dataset is dropped
+                resident_data.popitem(last=False)
+        self.read_data()
+        if key is not None and resident_max > 0:
+            resident_data[key] = {name: getattr(self, name) for name in ['A', 'A_diag', 'parcel_sizes', 'data_digest'] if hasattr(self, name)}
+
+    def read_data(self):
         data_path = os.path.join(self.main_dir, 'data/'+self.dataset)
+        cache_dir = self.cache.cache_dir if self.cache is not None else None
         if self.dataset == 'synthetic':
-            filename = 'A_'+str(self.K)+'_'+str(self.S1)+'_'+str(self.S2)+'_'+str(self.Nc_type)+'_{:.3g}'.format(self.alpha)
+            filename = synthetic_filename(self)
             self.A = np.load(os.path.join(data_path, filename+'.npy'))
+            if self.cache is not None:
+                self.data_digest = file_digest(os.path.join(data_path, filename+'.npy'), cache_dir)
         elif self.dataset == 'hcp':
-            filename_list = ['fmri_sparse1.npz', 'fmri_sparse2.npz', 'fmri_sparse3.npz', 'fmri_sparse4.npz', 'fmri_sparse5.npz', 
-                            'dmri_sparse1.npz', 'dmri_sparse2.npz', 'dmri_sparse3.npz', 'dmri_sparse4.npz', 'dmri_sparse5.npz']
             self.A = []
-            for filename in filename_list:
-                graph = load_npz(os.path.join(data_path, filename)).astype(dtype=np.int32) # single graph
-                graph_sym = triu(graph,1)+triu(graph,1).T
+            digests = []
+            for filename in hcp_filenames:
+                path = os.path.join(data_path, filename)
+                def symmetrise():
+                    graph = load_npz(path).astype(dtype=np.int32) # single graph
+                    return (triu(graph,1)+triu(graph,1).T).tocsr()
+                if self.cache is not None:
+                    digests.append(file_digest(path, cache_dir))
+                    graph_sym = self.cache.get_or_compute(self.cache.key('hcp_sym', digests[-1]), symmetrise)
+                else:
+                    graph_sym = symmetrise()
                 self.A.append(graph_sym)
+            if self.cache is not None:
+                self.data_digest = self.cache.key('hcp', digests)
+        elif self.dataset == 'parcel':
+            # parcel-level graphs with number of links between parcels (output of parcellate_graphs.py), stored in the smallest integer dtype that fits
+            data = np.load(os.path.join(self.main_dir, 'data', 'hcp', self.parcel_file))
+            if self.cache is not None:
+                self.data_digest = file_digest(os.path.join(self.main_dir, 'data', 'hcp', self.parcel_file), cache_dir)
+            Nlink = data['Nlink'] # K x K x S
+            K = Nlink.shape[0]
+            self.A_diag = Nlink[np.arange(K), np.arange(K), :].copy() # links within parcels
+            self.A = Nlink.copy()
+            self.A[np.arange(K), np.arange(K), :] = 0 # links between parcels
+            self.A = self.A.astype(np.min_scalar_type(int(self.A.max())))
+            self.A_diag = self.A_diag.astype(np.min_scalar_type(int(self.A_diag.max())))
+            self.parcel_sizes = data['sizes'] if 'sizes' in data else np.rint((1 + np.sqrt(1 + 8 * np.diag(data['Ntot']))) / 2).astype(np.int64) # number of vertices in each parcel (derived from pair counts if not saved)
         else:
             print('Unknown dataset')
             
 ############################################################### Model evaluation functions ###############################################################
 
     def compute_n_link(self, Z, noc, add_eta0, eta0):
-        if self.dataset == 'hcp':
+        if self.shards is not None:
+            n_link = self.shards.block_links(Z) # computed by the workers holding the graphs
+        elif self.dataset == 'hcp':
             n_link = np.stack([Z @ spdenmatmul(As, Z.T) for As in self.A],axis=2) # used for list of scipy sparse csr matrix (NEW numba version)
-        elif self.dataset == 'synthetic':
-            n_link = np.stack([Z @ self.A[:, :, s] @ Z.T for s in range(self.S)],axis=2) # used for stacked 3D array of dense matric
+        else:
+            n_link = np.stack([Z @ self.A[:, :, s] @ Z.T for s in range(self.S)],axis=2) # used for stacked 3D array of dense matric (synthetic and parcel-level data)
         if add_eta0 == False:
             eta0 = np.zeros(self.S)
         n_link = np.stack([n_link[:, :, s] - 0.5 * np.diag(np.diag(n_link[:, :, s])) + eta0[s] for s in range(self.S)], axis=2) # old line that works (can probably be optimized)
+        if self.A_diag is not None:
+            n_link[np.arange(noc), np.arange(noc), :] += Z @ self.A_diag # links within nodes belong to the block of their cluster with itself
         return n_link
+    
+    def add_node_links(self, n_link, ZAi, i, clusters):
+        # number of links between clusters when node i is added to each candidate cluster (column j of n_link is cluster clusters[j])
+        n_link_di = n_link + ZAi
+        if self.A_diag is not None:
+            n_link_di[clusters, np.arange(len(clusters)), :] += self.A_diag[i] # links within node i are added to the block of the candidate cluster with itself
+        return n_link_di
+    
+    def calculate_density(self, Z, n_link):
+        # link density between clusters for parcel-level graphs: number of links relative to number of possible links (vertex pairs)
+        sizes = Z @ self.parcel_sizes
+        Ntot = np.outer(sizes, sizes)
+        Ntot[np.diag_indices_from(Ntot)] = sizes * (sizes - 1) / 2
+        return (n_link - self.eta0) / Ntot[:, :, np.newaxis]
      
     def multinomialln(self, x): # logbeta func 
         # Multinomial distribution (log probability)
         return np.sum(gammaln(x), axis=-1) - gammaln(np.sum(x, axis=-1))
 
-    def calculate_eta(self):
-        n_link = self.compute_n_link(Z=self.Z, noc=self.noc, add_eta0=True, eta0=self.eta0)
-        sum_n_link = np.sum(n_link, axis=2)
-        self.eta = n_link/sum_n_link[:,:,np.newaxis]
+    def get_n_link_base(self):
+        # number of links between clusters of self.Z without eta0 (reused from the last Gibbs sweep if Z has not changed since)
+        if self.n_link_base is None:
+            self.n_link_base = self.compute_n_link(Z=self.Z, noc=self.noc, add_eta0=False, eta0=None)
+        return self.n_link_base
+
+    @property
+    def eta(self): # expected value of posterior of eta, computed when first used after Z or eta0 changed
+        if self._eta is None:
+            t0 = time.time()
+            n_link = self.get_n_link_base() + self.eta0
+            sum_n_link = np.sum(n_link, axis=2)
+            self._eta = n_link/sum_n_link[:,:,np.newaxis]
+            self.timings['eta'] += time.time() - t0
+        return self._eta
 
     def evalProbs(self, Z, eta0, alpha):
         # used to evaluate the likelihood and prior probabilities of the model in unit tests
@@ -561,81 +1124,77 @@ class MultinomialSBM(object): # changed name from IRMUnipartiteMultinomial to Mu
         const = self.multinomialln(eta0)
         
         logP_A = np.sum(np.triu(mult_eval)) - noc * (noc + 1) / 2 * const
-        if self.model_type == 'nonparametric':
-            constZ = np.sum(gammaln(sumZ))
-            logP_Z = noc * np.log(alpha) + constZ - gammaln(self.N + alpha) + gammaln(alpha)
-        else:
-            logP_Z = gammaln(noc * alpha) - gammaln(noc * alpha + self.N) - noc * gammaln(alpha) + np.sum(gammaln(sumZ + alpha))
+        logP_Z = self.logP_Z_eval(sumZ, alpha)
         return logP_A, logP_Z
 
+    def logP_Z_eval(self, sumZ, alpha):
+        # log prior of partition with cluster sizes sumZ: CRP (nonparametric) or symmetric Dirichlet-multinomial with concentration alpha 
+        # for each cluster (parametric, conditional prior of a node in Gibbs sweeps is proportional to sumZ + alpha)
+        noc = len(sumZ)
+        if self.model_type == 'nonparametric':
+            return noc * np.log(alpha) + np.sum(gammaln(sumZ)) - gammaln(self.N + alpha) + gammaln(alpha)
+        return gammaln(noc * alpha) - gammaln(noc * alpha + self.N) - noc * gammaln(alpha) + np.sum(gammaln(sumZ + alpha))
+
 
 ############################################################### Unit tests ###############################################################
-    def unit_test_gibbs(self, logQ, weight, i):
-        noc_tmp1 = int(np.ceil((self.Z.shape[0]-1) * np.random.rand())) # generate cluster index between 1 and noc
-        Z_tmp1 = self.Z.copy()
-        Z_tmp1[noc_tmp1, i] = 1
-        logP_A_tmp1, logP_Z_tmp1 = self.evalProbs(Z_tmp1, self.eta0, self.alpha)
-        if self.model_type == 'nonparametric':
-            noc_tmp2 = int(np.ceil(self.Z.shape[0] * np.random.rand())) # generate cluster index between 1 and noc+1
-            Z_tmp2 = self.Z.copy()
-            if noc_tmp2 >= self.Z.shape[0]:
-                Z_tmp2 = np.concatenate((Z_tmp2, np.zeros((1, self.Z.shape[1]))), axis=0)
-            Z_tmp2[noc_tmp2, i] = 1
-            logP_A_tmp2, logP_Z_tmp2 = self.evalProbs(Z_tmp2, self.eta0, self.alpha)
-            a1 = logP_A_tmp1 + logP_Z_tmp1 - (logP_A_tmp2 + logP_Z_tmp2)
-            a2 = logQ[noc_tmp1] + np.log(weight[noc_tmp1]) - (logQ[noc_tmp2] + np.log(weight[noc_tmp2]))
-        else:
-            noc_tmp2 = int(np.ceil((self.Z.shape[0]-1) * np.random.rand())) # generate cluster index between 1 and noc
-            Z_tmp2 = self.Z.copy()
-            Z_tmp2[noc_tmp2, i] = 1
-            logP_A_tmp2, logP_Z_tmp2 = self.evalProbs(Z_tmp2, self.eta0, self.alpha)
-            a1 = logP_A_tmp1 + logP_Z_tmp1 - (logP_A_tmp2 + logP_Z_tmp2)
-            a2 = logQ[noc_tmp1] - logQ[noc_tmp2]
-            
-        reldiff = (a1-a2)/abs(a2)
-        if reldiff > self.reltol:
-            print('Gibbs unit test failed for node', str(i))
-            print('reldiff: ', reldiff)
-        #else:
-        #    print('Gibbs unit test passed')
+# Validation mode (main.py --unit_test True): incremental log probabilities of the samplers are compared with evalProbs (computed from scratch)
+# for a random fraction unit_test_rate of the nodes in Gibbs sweeps and of the MH proposals, and after every sweep and hyperparameter update.
+# The unit_test random number generator is used, so the sampled chain is the same as without validation.
+    def unit_test_record(self, name, a1, a2, scale):
+        # record difference between value computed from scratch (a1) and incremental value (a2) and report it if it exceeds the tolerance.
+        # The relative difference is relative to the magnitude of the compared values (e.g. a logQ difference of two candidates, not the
+        # full logP). The tolerance also allows for the rounding error of computing a1 from log probabilities of magnitude scale
+        # (differences of from-scratch logP values are exact only up to ~eps*|logP|)
+        absdiff = abs(a1 - a2)
+        magnitude = max(abs(a1), abs(a2))
+        reldiff = absdiff / magnitude if magnitude > 0 else 0.0
+        failed = absdiff > self.reltol * magnitude + 1e3 * np.finfo(float).eps * abs(scale)
+        stats = self.unit_test_stats.setdefault(name, {'absdiff': [], 'reldiff': [], 'failed': 0})
+        stats['absdiff'].append(absdiff)
+        stats['reldiff'].append(reldiff)
+        stats['failed'] += failed
+        if failed:
+            print(name, 'unit test failed in iteration', self.it, '- absdiff:', absdiff, 'reldiff:', reldiff, '(from scratch:', a1, ', incremental:', a2, ')')
+    
+    def unit_test_summary(self):
+        # drift statistics of each check: number of checks, max and mean absolute and relative difference, number of failed checks
+        return {name: {'n': len(stats['absdiff']), 
+                       'max_absdiff': float(np.max(stats['absdiff'])), 'mean_absdiff': float(np.mean(stats['absdiff'])), 
+                       'max_reldiff': float(np.max(stats['reldiff'])), 'mean_reldiff': float(np.mean(stats['reldiff'])), 
+                       'failed': int(stats['failed'])} 
+                for name, stats in self.unit_test_stats.items()}
+    
+    def unit_test_logP(self, name):
+        # logP_A and logP_Z kept by the sampler against evalProbs of the current partition
+        logP_A, logP_Z = self.evalProbs(self.Z, self.eta0, self.alpha)
+        self.unit_test_record(name+'_logP_A', logP_A, self.logP_A, logP_A)
+        self.unit_test_record(name+'_logP_Z', logP_Z, self.logP_Z, logP_Z)
     
-    def unit_test_MH_eta0(self, eta0_new, logP_A_new, logP_A, alpha_new=None, logP_Z_new=None, logP_Z=None):
+    def unit_test_gibbs(self, Z, cand, logQ, weight, i, name='gibbs'):
+        # log conditional (logQ + log weight) of two random candidates of node i against the difference of evalProbs of the two assignments
+        ## INPUT
+        # Z         noc x N partition without node i
+        # cand      row of Z of each candidate in logQ (logQ has an additional last entry for a new cluster if len(logQ) > len(cand))
+        if len(logQ) < 2:
+            return
+        logP = []
+        for c in self.rng['unit_test'].choice(len(logQ), 2, replace=False):
+            if c < len(cand):
+                Z_c = Z.copy()
+                Z_c[cand[c], i] = 1
+            else: # new cluster
+                Z_c = np.concatenate((Z, np.zeros((1, self.N))), axis=0)
+                Z_c[-1, i] = 1
+            logP_A, logP_Z = self.evalProbs(Z_c, self.eta0, self.alpha)
+            logP.append((logP_A + logP_Z, logQ[c] + np.log(weight[c])))
+        self.unit_test_record(name, logP[0][0] - logP[1][0], logP[0][1] - logP[1][1], logP[0][0])
+    
+    def unit_test_MH_eta0(self, eta0_new, logP_A_new, logP_A):
         logP_A_tmp, _ = self.evalProbs(self.Z, self.eta0, self.alpha)
         logP_A_tmp_new, _ = self.evalProbs(self.Z, eta0_new, self.alpha)
-        a1 = logP_A_tmp_new - logP_A_tmp
-        a2 = logP_A_new - logP_A
-        reldiff = (a1-a2)/abs(a2)
-        if reldiff > self.reltol:
-            print('MH eta0 unit test failed')
-            print('reldiff: ', reldiff)
-        #else:
-        #    print('MH eta0 unit test passed')
-            
-    def unit_test_MH_alpha(self, alpha_new, logP_Z_new, logP_Z, eta0_new=None, logP_A_new=None, logP_A=None):
+        self.unit_test_record('MH_eta0', logP_A_tmp_new - logP_A_tmp, logP_A_new - logP_A, logP_A_tmp)
+            
+    def unit_test_MH_alpha(self, alpha_new, logP_Z_new, logP_Z):
         _ , logP_Z_tmp = self.evalProbs(self.Z, self.eta0, self.alpha)
         _ , logP_Z_tmp_new = self.evalProbs(self.Z, self.eta0, alpha_new)
-        a1 = logP_Z_tmp_new - logP_Z_tmp
-        a2 = logP_Z_new - logP_Z
-        reldiff = (a1-a2)/abs(a2)
-        if reldiff > self.reltol:
-            print('MH alpha unit test failed')
-            print('reldiff: ', reldiff)
-        #else:
-        #    print('MH alpha unit test passed')
-        
-    def unit_test_splitmerge_Z(self, Z, comp, i, logQ, weight):
-        noc1t = comp[0]
-        noc2t = comp[1]
-        Z_t = Z.copy()
-        Z_t[noc1t, i] = 1
-        logP_A1, logP_Z1 = self.evalProbs(Z_t, self.eta0, self.alpha)
-        Z_t = Z.copy()
-        logP_A2, logP_Z2 = self.evalProbs(Z_t, self.eta0, self.alpha)
-        a1 = logP_A1 + logP_Z1 - (logP_A2 + logP_Z2)
-        a2 = logQ[0] + np.log(weight[0])-(logQ[1]+np.log[weight[1]])
-        reldiff = (a1-a2)/abs(a2)
-        if reldiff > self.reltol:
-            print('MH splitmerge Z unit test failed')
-            print('reldiff: ', reldiff)
-        #else:
-        #    print('MH splitmerge Z unit test passed')
+        self.unit_test_record('MH_alpha', logP_Z_tmp_new - logP_Z_tmp, logP_Z_new - logP_Z, logP_Z_tmp)
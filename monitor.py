@@ -0,0 +1,138 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+# Live monitor of running chains: follows the metrics files (metrics.jsonl, one json line per iteration, see main.py --metrics)
+# of all runs under a results folder and prints a table with progress, throughput (sweeps per hour), split-merge acceptance
+# and memory of each run, and convergence within (ESS of logP) and across chains (split-Rhat of logP of the runs of the same
+# experiment, i.e. the same log.txt settings).
+#
+# Usage: python monitor.py --results_dir /work3/s174162/speciale/results [--interval 30] [--window 20] [--once]
+
+
+class MetricsTail(object):
+    # Records of a metrics file, new lines are read incrementally (a partially written last line is read on the next update)
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.records = []
+
+    def update(self):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1 # only complete lines
+        for line in data[:end].splitlines():
+            try:
+                self.records.append(json.loads(line))
+            except ValueError: # corrupt line (e.g. run killed while writing)
+                pass
+        self.offset += end
+
+
+def experiment_key(manifest):
+    # runs with the same experiment settings (chains of the same experiment) have the same key
+    if manifest is None:
+        return None
+    experiment = {key: value for key, value in manifest.get('experiment', {}).items() if key not in ['exp_name', 'init_from']}
+    return json.dumps(experiment, sort_keys=True)
+
+
+def find_metrics(results_dir):
+    # paths of all metrics files under results_dir
+    from run_utils import METRICS_NAME
+    paths = []
+    for root, dirs, files in os.walk(results_dir):
+        if METRICS_NAME in files:
+            paths.append(os.path.join(root, METRICS_NAME))
+    return sorted(paths)
+
+
+def run_summary(records, window):
+    # summary of the records of one run (throughput and split-merge acceptance over the last window iterations)
+    last = records[-1]
+    recent = records[-window:]
+    if len(recent) >= 2 and recent[-1]['time'] > recent[0]['time']:
+        sweeps_per_hour = (recent[-1]['iter'] - recent[0]['iter']) / (recent[-1]['time'] - recent[0]['time']) * 3600
+    else:
+        sweeps_per_hour = 3600 / last['iter_time'] if last['iter_time'] > 0 else np.nan
+    accept = [r['splitmerge_accept'] for r in recent if r.get('splitmerge_accept') is not None]
+    logP = np.array([r['logP'] for r in records])
+    from convergence import ess
+    return {'iter': last['iter'],
+            'noc': last['noc'],
+            'logP': last['logP'],
+            'sweeps_per_hour': sweeps_per_hour,
+            'splitmerge_accept': np.mean(accept) if len(accept) > 0 else None,
+            'rss_mb': last['rss_mb'],
+            'ess_logP': last.get('convergence', {}).get('ess_logP') or ess(logP[len(logP)//2:]), # (null: not computed or not finite)
+            'age': time.time() - last['time']}
+
+
+def collect(tails, window):
+    # rows of the table (one per run) and split-Rhat of logP of each experiment with more than one chain
+    from run_utils import read_manifest
+    from convergence import split_rhat
+    rows = []
+    groups = {}
+    for tail in tails.values():
+        tail.update()
+        if len(tail.records) == 0:
+            continue
+        run_dir = os.path.dirname(tail.path)
+        manifest = read_manifest(run_dir)
+        row = run_summary(tail.records, window)
+        row['run'] = os.path.relpath(run_dir, os.path.dirname(os.path.dirname(run_dir)))
+        row['status'] = manifest['status'] if manifest is not None else '?'
+        row['group'] = experiment_key(manifest)
+        rows.append(row)
+        if row['group'] is not None:
+            logP = np.array([r['logP'] for r in tail.records])
+            groups.setdefault(row['group'], []).append(logP[len(logP)//2:]) # second half (first half is burn-in)
+    rhat = {group: split_rhat(chains) for group, chains in groups.items() if len(chains) > 1}
+    for row in rows:
+        row['rhat_logP'] = rhat.get(row['group'])
+        row['chains'] = len(groups.get(row['group'], []))
+    return rows
+
+
+def format_table(rows):
+    header = '{:<48} {:>10} {:>6} {:>5} {:>12} {:>9} {:>7} {:>8} {:>7} {:>10} {:>8}'.format(
+        'run', 'status', 'iter', 'noc', 'logP', 'sweeps/h', 'sm acc', 'RSS MB', 'ESS', 'Rhat (n)', 'updated')
+    lines = [header, '-' * len(header)]
+    for row in sorted(rows, key=lambda row: (row['group'] or '', row['run'])):
+        lines.append('{:<48} {:>10} {:>6} {:>5} {:>12.5e} {:>9.1f} {:>7} {:>8.0f} {:>7.1f} {:>10} {:>7.0f}s'.format(
+            row['run'][-48:], row['status'][:10], row['iter'], row['noc'], row['logP'], row['sweeps_per_hour'],
+            '{:.3f}'.format(row['splitmerge_accept']) if row['splitmerge_accept'] is not None else '-',
+            row['rss_mb'], row['ess_logP'],
+            '{:.3f} ({})'.format(row['rhat_logP'], row['chains']) if row['rhat_logP'] is not None else '-', row['age']))
+    running = [row for row in rows if row['status'] == 'running']
+    lines.append(f"{len(rows)} runs, {len(running)} running, {sum(row['sweeps_per_hour'] for row in running):.0f} sweeps/h in total")
+    return '\n'.join(lines)
+
+
+def main(args):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    tails = {}
+    while True:
+        for path in find_metrics(args.results_dir):
+            if path not in tails:
+                tails[path] = MetricsTail(path)
+        table = format_table(collect(tails, args.window))
+        if args.once:
+            print(table)
+            return
+        print('\033[2J\033[H' + time.strftime('%Y-%m-%d %H:%M:%S') + '  ' + args.results_dir + '\n' + table, flush=True) # clear screen
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--results_dir', type=str, default='/work3/s174162/speciale/results', help='folder with results folders of runs (searched recursively)')
+    parser.add_argument('--interval', type=float, default=30, help='seconds between updates of the table')
+    parser.add_argument('--window', type=int, default=20, help='number of last iterations used for throughput and split-merge acceptance')
+    parser.add_argument('--once', action='store_true', help='print the table once and exit')
+    main(parser.parse_args())
@@ -0,0 +1,144 @@
+import os
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import load_npz
+
+# Batch parcellation of vertex-level graphs into parcel-level link counts (e.g. HCP graphs in Glasser atlas resolution).
+# The atlas is loaded once, and each graph is aggregated with a single pass over its nonzeros (label lookup + bincount),
+# in parallel across graphs in a process pool. The result for all graphs is written as one stacked file.
+#
+# Usage: python parcellate_graphs.py --atlas Glasser_L.mat Glasser_R.mat --graphs fmri_sparse1.npz ... dmri_sparse5.npz --out Glasser_counts.npz
+#
+# Output (.npz):
+# Nlink         K x K x S number of links between parcels for each graph (smallest unsigned integer dtype that fits)
+# Ntot          K x K number of possible links (node pairs) between parcels
+# eta           K x K x S link density between parcels, Nlink/Ntot
+# sizes         number of nodes in each parcel
+# graphs        filenames of the graphs (order of the third dimension)
+
+chunk_nnz = 2**24 # max number of nonzeros processed at once (bounds memory of the label lookup)
+
+
+def load_atlas(atlas_files, key='parcels'):
+    # Load node labels of an atlas, possibly split over several files (e.g. left and right hemisphere)
+    ## INPUT
+    # atlas_files   list of label files (.mat with variable key, .npy or text file), labels start at 1 and 0 means unassigned
+    # key           name of the label variable in .mat files
+
+    ## OUTPUT
+    # z             node labels (0-indexed, -1 for unassigned nodes); labels of each file are shifted by the max label of the previous files
+    # K             number of parcels
+    z_list = []
+    shift = 0
+    for filename in atlas_files:
+        if filename.endswith('.mat'):
+            from scipy.io import loadmat
+            labels = loadmat(filename)[key]
+        elif filename.endswith('.npy'):
+            labels = np.load(filename)
+        else:
+            labels = np.loadtxt(filename)
+        labels = np.asarray(labels).flatten().astype(np.int64)
+        z_list.append(np.where(labels > 0, labels + shift, 0)) # NOTICE THAT LABELS OF LATER FILES ARE SHIFTED, SO ALL LABELS ARE UNIQUE
+        shift += labels.max()
+    z = np.concatenate(z_list) - 1
+    return z, int(shift)
+
+
+def block_counts(A, z, K):
+    # Number of links between parcels for one graph, counting each undirected link once (upper triangle of A)
+    ## INPUT
+    # A             N x N scipy sparse graph (symmetric or upper triangular)
+    # z             node labels from load_atlas
+    # K             number of parcels
+
+    ## OUTPUT
+    # Nlink         K x K symmetric matrix with number of links between parcels (diagonal: links within parcel)
+    A = A.tocsr()
+    indptr = A.indptr
+    counts = np.zeros(K * K)
+    row_start = 0
+    while row_start < A.shape[0]:
+        # rows whose nonzeros fit in the chunk (at least one row)
+        row_end = max(np.searchsorted(indptr, indptr[row_start] + chunk_nnz, side='right') - 1, row_start + 1)
+        lo, hi = indptr[row_start], indptr[row_end]
+        rows = np.repeat(np.arange(row_start, row_end), np.diff(indptr[row_start:row_end+1]))
+        cols = A.indices[lo:hi]
+        keep = cols > rows # upper triangle only
+        zi = z[rows[keep]]
+        zj = z[cols[keep]]
+        assigned = (zi >= 0) & (zj >= 0)
+        counts += np.bincount(zi[assigned] * K + zj[assigned], weights=A.data[lo:hi][keep][assigned], minlength=K * K)
+        row_start = row_end
+    counts = counts.reshape(K, K)
+    return np.rint(counts + counts.T - np.diag(np.diag(counts))).astype(np.int64)
+
+
+def pair_counts(sizes):
+    # Number of possible links (node pairs) between parcels with the given number of nodes, n_k*n_l (k != l) and n_k*(n_k-1)/2 (k == l)
+    sizes = np.asarray(sizes, dtype=np.int64)
+    Ntot = np.outer(sizes, sizes)
+    Ntot[np.diag_indices_from(Ntot)] = sizes * (sizes - 1) // 2
+    return Ntot
+
+
+def smallest_uint(x):
+    # cast non-negative integer array to the smallest unsigned integer dtype that fits
+    return x.astype(np.min_scalar_type(int(x.max()) if x.size > 0 else 0))
+
+
+_z = None # node labels of worker process (set once per worker by _init_worker)
+_K = None
+
+def _init_worker(z, K):
+    global _z, _K
+    _z = z
+    _K = K
+
+def _parcellate_file(filename):
+    return block_counts(load_npz(filename), _z, _K)
+
+
+def parcellate(graph_files, z, K, workers=1):
+    # Parcel-level link counts and pair counts for a list of graph files (.npz scipy sparse)
+    ## OUTPUT
+    # Nlink         K x K x S link counts
+    # Ntot          K x K pair counts
+    # sizes         number of nodes in each parcel
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(z, K)) as executor:
+            Nlink = list(executor.map(_parcellate_file, graph_files))
+    else:
+        _init_worker(z, K)
+        Nlink = [_parcellate_file(filename) for filename in graph_files]
+    sizes = np.bincount(z[z >= 0], minlength=K)
+    return smallest_uint(np.stack(Nlink, axis=2)), pair_counts(sizes), sizes
+
+
+def save_parcellation(out, Nlink, Ntot, sizes, graph_files):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        eta = np.where(Ntot[:, :, np.newaxis] > 0, Nlink / Ntot[:, :, np.newaxis], 0) # link density between parcels
+    np.savez(out, Nlink=Nlink, Ntot=Ntot, eta=eta, sizes=sizes, graphs=np.array([os.path.basename(f) for f in graph_files]))
+    return eta
+
+
+def main(args):
+    atlas_files = [os.path.join(args.data_dir, f) for f in args.atlas]
+    graph_files = [os.path.join(args.data_dir, f) for f in args.graphs]
+    z, K = load_atlas(atlas_files, key=args.atlas_key)
+    print(f"Atlas with {K} parcels and {len(z)} nodes ({np.sum(z < 0)} unassigned), {len(graph_files)} graphs")
+    Nlink, Ntot, sizes = parcellate(graph_files, z, K, workers=args.workers)
+    save_parcellation(os.path.join(args.data_dir, args.out), Nlink, Ntot, sizes, graph_files)
+    print(f"Saved {Nlink.shape} link counts ({Nlink.dtype}) to {os.path.join(args.data_dir, args.out)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default='/work3/s174162/speciale/data/hcp', help='folder with atlas and graph files')
+    parser.add_argument('--atlas', type=str, nargs='+', default=['Glasser_L.mat', 'Glasser_R.mat'], help='atlas label files (labels of later files are shifted)')
+    parser.add_argument('--atlas_key', type=str, default='parcels', help='name of label variable in .mat atlas files')
+    parser.add_argument('--graphs', type=str, nargs='+', required=True, help='graph files (.npz scipy sparse)')
+    parser.add_argument('--out', type=str, default='Glasser_counts.npz', help='output filename (saved in data_dir)')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('LSB_DJOB_NUMPROC', 1)), help='number of worker processes (default: number of LSF slots)')
+    main(parser.parse_args())
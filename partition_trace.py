@@ -0,0 +1,145 @@
+import numpy as np
+
+# Compact trace of the partitions (node labels) of all stored samples, used by MultinomialSBM.train() (sample['Z']).
+# A partition is stored as the (node, new label) pairs of the nodes that changed cluster since the previous stored partition,
+# after applying a relabel map of the previous clusters (clusters are sorted by size in every iteration and can be
+# created/removed, so the same cluster can get a different label). Periodic keyframes (full label vectors) give
+# random access to any stored partition without decoding the trace from the start.
+#
+# Usage: trace = PartitionTrace.from_state(sample['Z']); labels = trace[k] (k'th stored partition, iteration sample['iter'][k])
+#        for labels in trace: ... (sequential decoding of all partitions)
+
+
+def relabel_map(prev, labels, noc_prev, noc):
+    # map of the previous cluster labels to current labels (each previous cluster is mapped to the current cluster holding
+    # most of its nodes, clusters with the largest overlap are matched first, -1: cluster not matched)
+    overlap = np.bincount(prev.astype(np.int64) * noc + labels, minlength=noc_prev*noc).reshape(noc_prev, noc)
+    best = np.argmax(overlap, axis=1)
+    relabel = np.full(noc_prev, -1, dtype=np.int32)
+    used = np.zeros(noc, dtype=bool)
+    for k in np.argsort(-overlap[np.arange(noc_prev), best], kind='stable'):
+        if overlap[k, best[k]] > 0 and not used[best[k]]:
+            relabel[k] = best[k]
+            used[best[k]] = True
+    return relabel
+
+
+class PartitionTrace(object):
+    # Delta-encoded sequence of partitions of N nodes (keyframe every keyframe_step partitions)
+    def __init__(self, N, keyframe_step=100):
+        self.N = N
+        self.keyframe_step = keyframe_step
+        self.n = 0 # number of stored partitions
+        self.prev = None # labels of last stored partition
+        self.keyframe_entries = [] # index of partitions stored as keyframes
+        self.keyframes = [] # labels of keyframes
+        self.n_changes = [] # number of changed nodes of each partition (0 for keyframes)
+        self.change_nodes = [] # changed nodes (concatenated over partitions)
+        self.change_labels = [] # new labels of changed nodes
+        self.relabel_ptr = [0] # relabel map of partition k is relabel[relabel_ptr[k]:relabel_ptr[k+1]] (empty: labels unchanged)
+        self.relabel = []
+
+    def __len__(self):
+        return self.n
+
+    def append(self, labels):
+        # store partition given by node labels (array of N cluster labels)
+        labels = np.asarray(labels, dtype=np.int32)
+        relabel = np.empty(0, dtype=np.int32)
+        if self.n % self.keyframe_step != 0:
+            noc_prev, noc = int(self.prev.max()) + 1, int(labels.max()) + 1
+            relabel = relabel_map(self.prev, labels, noc_prev, noc)
+            if np.array_equal(relabel, np.arange(noc_prev)):
+                relabel = relabel[:0]
+                changed = np.flatnonzero(self.prev != labels)
+            else:
+                changed = np.flatnonzero(relabel[self.prev] != labels)
+        if self.n % self.keyframe_step == 0 or 2 * len(changed) >= self.N: # keyframe (also when it is smaller than the changes)
+            self.keyframe_entries.append(self.n)
+            self.keyframes.append(labels.copy())
+            self.n_changes.append(0)
+            relabel = relabel[:0]
+        else:
+            self.n_changes.append(len(changed))
+            self.change_nodes.append(changed.astype(np.int32))
+            self.change_labels.append(labels[changed])
+        self.relabel.append(relabel)
+        self.relabel_ptr.append(self.relabel_ptr[-1] + len(relabel))
+        self.prev = labels.copy()
+        self.n += 1
+
+    def consolidate(self):
+        # concatenate the stored arrays (appending copies each partition into small arrays, consolidated when needed)
+        for name in ['change_nodes', 'change_labels', 'relabel']:
+            value = getattr(self, name)
+            if len(value) != 1:
+                setattr(self, name, [np.concatenate(value).astype(np.int32) if len(value) > 0 else np.empty(0, dtype=np.int32)])
+
+    def state(self):
+        # dictionary of arrays (saved in sample['Z'], arrays are not modified by later appends)
+        self.consolidate()
+        return {'N': self.N,
+                'keyframe_step': self.keyframe_step,
+                'keyframe_entries': np.array(self.keyframe_entries, dtype=np.int64),
+                'keyframes': np.array(self.keyframes, dtype=np.int32).reshape(-1, self.N),
+                'change_ptr': np.concatenate([[0], np.cumsum(self.n_changes)]).astype(np.int64),
+                'change_nodes': self.change_nodes[0],
+                'change_labels': self.change_labels[0],
+                'relabel_ptr': np.array(self.relabel_ptr, dtype=np.int64),
+                'relabel': self.relabel[0]}
+
+    @classmethod
+    def from_state(cls, state):
+        trace = cls(state['N'], state['keyframe_step'])
+        trace.n = len(state['change_ptr']) - 1
+        trace.keyframe_entries = list(state['keyframe_entries'])
+        trace.keyframes = list(state['keyframes'])
+        trace.n_changes = list(np.diff(state['change_ptr']))
+        trace.change_nodes = [state['change_nodes']]
+        trace.change_labels = [state['change_labels']]
+        trace.relabel_ptr = list(state['relabel_ptr'])
+        trace.relabel = [state['relabel']]
+        if trace.n > 0:
+            trace.prev = trace[trace.n - 1]
+        return trace
+
+    @property
+    def nbytes(self):
+        # size of stored arrays (bytes)
+        state = self.state()
+        return sum(value.nbytes for value in state.values() if isinstance(value, np.ndarray))
+
+    def apply(self, labels, k, change_ptr):
+        # partition k from the previous partition (labels)
+        relabel = self.relabel[0][self.relabel_ptr[k]:self.relabel_ptr[k+1]]
+        if len(relabel) > 0:
+            labels = relabel[labels]
+        else:
+            labels = labels.copy()
+        nodes = slice(change_ptr[k], change_ptr[k+1])
+        labels[self.change_nodes[0][nodes]] = self.change_labels[0][nodes]
+        return labels
+
+    def __getitem__(self, k):
+        # labels of k'th stored partition (decoded from the last keyframe before it)
+        if k < 0:
+            k += self.n
+        if not 0 <= k < self.n:
+            raise IndexError(f"partition {k} not in trace of {self.n} partitions")
+        self.consolidate()
+        change_ptr = np.concatenate([[0], np.cumsum(self.n_changes)])
+        j = np.searchsorted(self.keyframe_entries, k, side='right') - 1
+        labels = self.keyframes[j].copy()
+        for i in range(self.keyframe_entries[j] + 1, k + 1):
+            labels = self.apply(labels, i, change_ptr)
+        return labels
+
+    def __iter__(self):
+        # labels of all stored partitions in order
+        self.consolidate()
+        change_ptr = np.concatenate([[0], np.cumsum(self.n_changes)])
+        keyframes = dict(zip(self.keyframe_entries, self.keyframes))
+        labels = None
+        for k in range(self.n):
+            labels = keyframes[k].copy() if k in keyframes else self.apply(labels, k, change_ptr)
+            yield labels
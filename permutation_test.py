@@ -0,0 +1,225 @@
+import os
+import math
+import argparse
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+# Permutation test of differences between groups of subjects (e.g. 5 functional vs 5 structural HCP graphs) for each
+# cluster pair (block) of the MAP partition. For each block the statistic is Welch's t of a per-subject block value between
+# the two groups, its null distribution is obtained by permuting the group labels of the subjects.
+# All permutations of a chunk are evaluated as one batched tensor operation (group indicator matrix @ subject x block values),
+# chunks bound the memory (chunk_size x number of blocks) and are distributed over a process pool.
+# If the number of distinct group assignments is at most n_perm (e.g. 252 for 5+5 subjects) all are enumerated (exact test).
+#
+# Per-subject block values:
+#   eta       expected value of posterior of eta (fraction of the links of a block in each subject), from the saved MAP sample
+#   density   link density of the block in each subject relative to the density of the subject's graph (needs the graphs)
+#
+# Usage: python permutation_test.py --exp_folder <results folder of run> --groups 0 0 0 0 0 1 1 1 1 1 [--n_perm 10000 --workers 4]
+# Output: permutation_test.npz in the results folder (noc x noc arrays, see permutation_test)
+
+
+def block_counts(labels, A, noc=None):
+    # noc x noc x S number of links between clusters in each graph (each link counted once, also within clusters)
+    ## INPUT
+    # labels    cluster of each node
+    # A         list of N x N scipy sparse matrices (hcp) or N x N x S dense array
+    from scipy.sparse import csr_matrix
+    noc = int(np.max(labels)) + 1 if noc is None else noc
+    N = len(labels)
+    Z = csr_matrix((np.ones(N), (labels, np.arange(N))), shape=(noc, N))
+    if isinstance(A, list):
+        n_link = np.stack([(Z @ As @ Z.T).toarray() for As in A], axis=2)
+    else:
+        n_link = np.stack([Z @ (Z @ A[:, :, s].T).T for s in range(A.shape[2])], axis=2)
+    n_link[np.arange(noc), np.arange(noc), :] *= 0.5
+    return n_link
+
+
+def block_density(n_link, sizes):
+    # noc x noc x S link density of each block relative to the link density of each graph
+    pairs = np.outer(sizes, sizes).astype(float)
+    pairs[np.diag_indices_from(pairs)] = sizes * (sizes - 1) / 2
+    N = np.sum(sizes)
+    graph_density = np.sum(np.triu(np.moveaxis(n_link, 2, 0)), axis=(1, 2)) / (N * (N - 1) / 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        density = n_link / pairs[:, :, np.newaxis] / graph_density
+    return np.nan_to_num(density)
+
+
+def welch_t(G, X, n1, n0):
+    # Welch's t statistic between group 1 and group 0 for each group assignment (rows of G) and each block (columns of X)
+    ## INPUT
+    # G         n_assignments x S indicator matrix of group 1
+    # X         S x B per-subject values of each block
+    ## OUTPUT
+    # t         n_assignments x B
+    # diff      n_assignments x B difference of group means
+    H = 1 - G
+    m1 = G @ X / n1
+    m0 = H @ X / n0
+    X2 = X**2
+    var1 = np.maximum(G @ X2 / n1 - m1**2, 0) * n1 / (n1 - 1)
+    var0 = np.maximum(H @ X2 / n0 - m0**2, 0) * n0 / (n0 - 1)
+    diff = m1 - m0
+    se = np.sqrt(var1 / n1 + var0 / n0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(se > 1e-12 * (np.abs(m1) + np.abs(m0)), diff / se, 0.0) # blocks without variation in both groups have t = 0
+    return t, diff
+
+
+def _null_chunk(X, groups, t_obs, n_chunk, seed=None, assignments=None):
+    # null statistics of a chunk of permutations (random permutations of groups, or the given group 1 index sets)
+    S = X.shape[0]
+    if assignments is None:
+        rng = np.random.default_rng(seed)
+        G = rng.permuted(np.tile(groups, (n_chunk, 1)), axis=1).astype(float)
+    else:
+        G = np.zeros((len(assignments), S))
+        G[np.repeat(np.arange(len(assignments)), len(assignments[0])), np.concatenate(assignments)] = 1
+    n1 = np.sum(groups)
+    t, _ = welch_t(G, X, n1, S - n1)
+    abs_t = np.abs(t)
+    exceed = np.sum(abs_t >= np.abs(t_obs) * (1 - 1e-10), axis=0) # two-sided
+    return exceed, np.max(abs_t, axis=1), np.sum(t, axis=0), np.sum(t**2, axis=0)
+
+
+def fdr_bh(p):
+    # Benjamini-Hochberg adjusted p-values (q-values)
+    p = np.asarray(p)
+    order = np.argsort(p)
+    q = p[order] * len(p) / np.arange(1, len(p) + 1)
+    q = np.minimum.accumulate(q[::-1])[::-1]
+    adjusted = np.empty_like(q)
+    adjusted[order] = np.minimum(q, 1)
+    return adjusted
+
+
+def permutation_test(values, groups, n_perm=10000, chunk_size=1000, workers=1, seed=None):
+    # Two-group permutation test of per-subject block values for all blocks (upper triangle including diagonal) of a partition
+    ## INPUT
+    # values        noc x noc x S per-subject block values (e.g. MAP eta)
+    # groups        group of each subject (two distinct values, e.g. ['fmri']*5 + ['dmri']*5), the first value in sorted order is group 0
+    # n_perm        number of random permutations (all distinct assignments are enumerated if there are at most n_perm)
+    # chunk_size    number of permutations evaluated in one batch
+    # workers       number of processes
+    ## OUTPUT
+    # result        dictionary with noc x noc arrays: t (Welch's t), diff (group 1 mean - group 0 mean), cohen_d,
+    #               p (permutation p-value), p_fwer (max-|t| adjusted), q_fdr (Benjamini-Hochberg), null_z (t standardised by its null distribution),
+    #               and group_names, n_perm, exact
+    noc = values.shape[0]
+    S = values.shape[2]
+    group_names, groups = np.unique(np.asarray(groups), return_inverse=True)
+    if len(group_names) != 2 or len(groups) != S:
+        raise ValueError('groups must assign each of the ' + str(S) + ' subjects to one of two groups')
+    n1 = int(np.sum(groups))
+    n0 = S - n1
+    if min(n1, n0) < 2:
+        raise ValueError('each group needs at least 2 subjects')
+    iu = np.triu_indices(noc)
+    X = values[iu[0], iu[1], :].T.astype(float) # S x B
+    t_obs, diff = welch_t(groups[np.newaxis, :].astype(float), X, n1, n0)
+    t_obs, diff = t_obs[0], diff[0]
+
+    n_assign = math.comb(S, n1)
+    exact = n_assign <= n_perm
+    if exact:
+        assignments = [np.array(c) for c in itertools.combinations(range(S), n1)]
+        jobs = [dict(assignments=assignments[k:k+chunk_size]) for k in range(0, n_assign, chunk_size)]
+    else:
+        seeds = np.random.SeedSequence(seed).spawn((n_perm + chunk_size - 1) // chunk_size)
+        jobs = [dict(seed=s, n_chunk=min(chunk_size, n_perm - k*chunk_size)) for k, s in enumerate(seeds)]
+    for job in jobs:
+        job.setdefault('n_chunk', len(job.get('assignments', [])))
+
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_run_job, [(X, groups, t_obs, job) for job in jobs]))
+    else:
+        results = [_run_job((X, groups, t_obs, job)) for job in jobs]
+    exceed = sum(r[0] for r in results)
+    max_t = np.concatenate([r[1] for r in results])
+    n_null = len(max_t)
+    null_mean = sum(r[2] for r in results) / n_null
+    null_std = np.sqrt(np.maximum(sum(r[3] for r in results) / n_null - null_mean**2, 0))
+
+    # p-values (the observed assignment is one of the enumerated ones in the exact test, and is added to the random permutations)
+    exceed_max = n_null - np.searchsorted(np.sort(max_t), np.abs(t_obs) * (1 - 1e-10), side='left') # permutations with max |t| over blocks >= |t| of block
+    if exact:
+        p = exceed / n_null
+        p_fwer = exceed_max / n_null
+    else:
+        p = (1 + exceed) / (1 + n_null)
+        p_fwer = (1 + exceed_max) / (1 + n_null)
+    pooled_sd = np.sqrt(((n1 - 1) * np.var(X[groups == 1], axis=0, ddof=1) + (n0 - 1) * np.var(X[groups == 0], axis=0, ddof=1)) / (S - 2))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cohen_d = np.where(pooled_sd > 0, diff / pooled_sd, 0.0)
+        null_z = np.where(null_std > 0, (t_obs - null_mean) / null_std, 0.0)
+
+    result = {'group_names': group_names, 'n_perm': n_null, 'exact': exact}
+    for name, block_values in [('t', t_obs), ('diff', diff), ('cohen_d', cohen_d), ('p', p), ('p_fwer', p_fwer), ('q_fdr', fdr_bh(p)), ('null_z', null_z)]:
+        mat = np.zeros((noc, noc))
+        mat[iu] = block_values
+        mat.T[iu] = block_values
+        result[name] = mat
+    return result
+
+
+def _run_job(args):
+    X, groups, t_obs, job = args
+    return _null_chunk(X, groups, t_obs, **job)
+
+
+def load_block_values(exp_folder, statistic='eta', main_dir=None):
+    # per-subject block values of the MAP partition of a run
+    from helper_functions import get_MAP_labels
+    from run_utils import read_manifest, latest_sample_file
+    sample_file = latest_sample_file(exp_folder)
+    if sample_file is None:
+        raise FileNotFoundError('No model_sample{iter}.npy in ' + exp_folder)
+    sample = np.load(sample_file, allow_pickle=True).item()
+    if statistic == 'eta':
+        if sample['MAP'].get('eta') is None:
+            raise ValueError('MAP eta is not stored in sample (run with --MAP_eta_dtype none), use statistic density')
+        return np.asarray(sample['MAP']['eta'], dtype=float)
+    elif statistic == 'density':
+        from sharding import load_subject_graphs
+        from model import hcp_filenames
+        config = read_manifest(exp_folder)['config']
+        if config['dataset'] != 'hcp':
+            raise ValueError('statistic density is only implemented for hcp data')
+        data_path = os.path.join(main_dir or config['main_dir'], 'data', 'hcp')
+        A = load_subject_graphs('hcp', [os.path.join(data_path, filename) for filename in hcp_filenames])
+        labels = get_MAP_labels(sample)
+        n_link = block_counts(labels, A, noc=sample['MAP']['noc'])
+        return block_density(n_link, np.bincount(labels, minlength=sample['MAP']['noc']))
+    raise ValueError('Unknown statistic: ' + str(statistic))
+
+
+def main(args):
+    values = load_block_values(args.exp_folder, args.statistic, args.main_dir)
+    result = permutation_test(values, args.groups, n_perm=args.n_perm, chunk_size=args.chunk_size, workers=args.workers, seed=args.seed)
+    np.savez(os.path.join(args.exp_folder, 'permutation_test.npz'), statistic=args.statistic, groups=np.asarray(args.groups), **result)
+
+    print(f"{'exact' if result['exact'] else 'random'} permutation test with {result['n_perm']} permutations, groups {[str(name) for name in result['group_names']]} (diff = group 1 - group 0)")
+    iu = np.triu_indices(values.shape[0])
+    order = np.argsort(result['p'][iu], kind='stable')[:args.top]
+    print(f"{'block':>10} | {'diff':>10} | {'t':>8} | {'cohen d':>8} | {'p':>8} | {'p_fwer':>8} | {'q_fdr':>8}")
+    for b in order:
+        k, l = int(iu[0][b]), int(iu[1][b])
+        print(f"{str((k, l)):>10} | {result['diff'][k, l]:10.3e} | {result['t'][k, l]:8.2f} | {result['cohen_d'][k, l]:8.2f} | {result['p'][k, l]:8.4f} | {result['p_fwer'][k, l]:8.4f} | {result['q_fdr'][k, l]:8.4f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--exp_folder', type=str, required=True, help='results folder of run (MAP of last saved model_sample{iter}.npy is used)')
+    parser.add_argument('--groups', type=str, nargs='+', default=['fmri']*5 + ['dmri']*5, help='group of each subject/graph in data order (two groups)')
+    parser.add_argument('--statistic', type=str, default='eta', help='per-subject block values: eta (MAP eta) or density (block density relative to graph density, hcp only)')
+    parser.add_argument('--n_perm', type=int, default=10000, help='number of random permutations (all assignments are enumerated if there are fewer)')
+    parser.add_argument('--chunk_size', type=int, default=1000, help='number of permutations evaluated in one batch')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('LSB_DJOB_NUMPROC', 1)), help='number of processes')
+    parser.add_argument('--seed', type=int, default=None, help='seed of random permutations')
+    parser.add_argument('--top', type=int, default=20, help='number of blocks with smallest p-value to print')
+    parser.add_argument('--main_dir', type=str, default=None, help='main directory (data), default: main_dir of run')
+    main(parser.parse_args())
@@ -0,0 +1,191 @@
+import os
+import io
+import time
+import signal
+from collections import Counter
+
+# Profiling of a training run (main.py --profile) over a window of iterations, written next to the results:
+#   profile.pstats      cProfile statistics (mode 'cprofile'), e.g. python -m pstats profile.pstats or snakeviz
+#   profile.collapsed   call stacks in collapsed format (microseconds or samples), e.g. flamegraph.pl profile.collapsed > profile.svg or speedscope
+#   profile_report.txt  top functions by cumulative/sampled time and top allocation sites (tracemalloc)
+#
+# Modes:
+#   cprofile    deterministic profiler (exact call counts and call graph), stacks are reconstructed from the caller-callee graph
+#               (only call paths with more than min_fraction of the profiled time are written)
+#   sample      stack sampling (SIGPROF timer, low overhead), used for long runs
+# The stack sampler interrupts the main thread every 'interval' seconds of process cpu time. Time spent inside compiled code
+# (numba, BLAS) is attributed to the python line that called it.
+
+
+class StackSampler(object):
+    # Statistical profiler of the main thread based on the SIGPROF interval timer (POSIX only)
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter() # collapsed stack -> number of samples
+        self.available = hasattr(signal, 'setitimer') and hasattr(signal, 'SIGPROF')
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        if self.available:
+            signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        if self.available:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def top_functions(self, n=20):
+        # functions by number of samples where they are on top of the stack (self time)
+        counts = Counter()
+        for stack, count in self.stacks.items():
+            counts[stack.rsplit(';', 1)[-1]] += count
+        return counts.most_common(n)
+
+
+def collapsed_from_pstats(stats, max_depth=64, min_fraction=1e-4, max_paths=100000):
+    # Reconstruct collapsed stacks (self time in microseconds) from the caller-callee graph of pstats.Stats.
+    # The time of a function is split over its callers in proportion to the cumulative time of each call edge.
+    # The number of acyclic call paths grows exponentially with the size of the call graph, so paths with less than
+    # min_fraction of the total time are not followed (at most max_depth/min_fraction paths) and at most max_paths are walked.
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+    label = lambda func: f"{func[2]} ({os.path.basename(func[0])}:{func[1]})"
+    stacks = Counter()
+    roots = [func for func, (_, _, _, _, callers) in stats.stats.items() if len(callers) == 0]
+    min_time = min_fraction * sum(stats.stats[func][3] for func in roots) # cumulative time of a path below which it is not followed
+    n_paths = 0
+    
+    def walk(func, path, fraction):
+        nonlocal n_paths
+        n_paths += 1
+        _, _, tt, ct, _ = stats.stats[func]
+        path = path + [func]
+        stacks[';'.join(label(f) for f in path)] += int(round(1e6 * tt * fraction))
+        if len(path) >= max_depth:
+            return
+        for callee, edge_ct in callees.get(func, []):
+            callee_ct = stats.stats[callee][3]
+            if callee not in path and callee_ct > 0 and n_paths < max_paths:
+                callee_fraction = fraction * min(edge_ct / callee_ct, 1)
+                if callee_ct * callee_fraction >= min_time:
+                    walk(callee, path, callee_fraction)
+    
+    for func in roots:
+        walk(func, [], 1.0)
+    return Counter({stack: count for stack, count in stacks.items() if count > 0})
+
+
+class Profiler(object):
+    # Profiles iterations start_iter to stop_iter (inclusive, None: until training ends) of MultinomialSBM.train()
+
+    # Usage: model.profiler = Profiler(...); train() calls profiler.step(it) at the start of each iteration; profiler.finish() writes the output
+
+    # Input:
+    # out_dir       folder for output files (results folder of the run)
+    # mode          'cprofile' or 'sample'
+    # start_iter    first profiled iteration
+    # stop_iter     last profiled iteration
+    # interval      sampling interval (seconds of cpu time) of the stack sampler
+    # memory        trace allocations with tracemalloc (slows down python/numpy code many times, so timings of the window are inflated)
+    def __init__(self, out_dir, mode='cprofile', start_iter=1, stop_iter=None, interval=0.005, memory=False):
+        if mode not in ['cprofile', 'sample']:
+            raise ValueError('Unknown profiling mode: ' + str(mode))
+        self.out_dir = out_dir
+        self.mode = mode
+        self.start_iter = start_iter
+        self.stop_iter = stop_iter
+        self.memory = memory
+        self.sampler = StackSampler(interval) if mode == 'sample' else None
+        self.profile = None
+        self.memory_snapshot = None
+        self.memory_peak = None # peak traced memory in profiled window (bytes)
+        self.active = False
+        self.iterations = 0 # number of profiled iterations
+        self.time = 0.0 # wall time of profiled window
+        self.t0 = None
+
+    def step(self, it):
+        # called at the start of iteration it
+        if not self.active and it >= self.start_iter and (self.stop_iter is None or it <= self.stop_iter):
+            self.start()
+        elif self.active and self.stop_iter is not None and it > self.stop_iter:
+            self.stop()
+        if self.active:
+            self.iterations += 1
+
+    def start(self):
+        if self.memory:
+            import tracemalloc
+            tracemalloc.start(10)
+        if self.mode == 'cprofile':
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.sampler.start()
+        self.active = True
+        self.t0 = time.time()
+
+    def stop(self):
+        if not self.active:
+            return
+        self.time += time.time() - self.t0
+        if self.profile is not None:
+            self.profile.disable()
+        else:
+            self.sampler.stop()
+        if self.memory:
+            import tracemalloc
+            self.memory_snapshot = tracemalloc.take_snapshot()
+            self.memory_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.active = False
+
+    def finish(self, n_top=25):
+        # stop profiling and write pstats, collapsed stacks and report. Returns the path of the report
+        self.stop()
+        report = io.StringIO()
+        report.write(f"Profiled {self.iterations} iterations ({self.mode}), {self.time:.2f} s wall time\n")
+        if self.memory:
+            report.write('NOTE: timings were taken with tracemalloc on (--profile_memory), which inflates the time of python/numpy code\n')
+        report.write('\n')
+        if self.profile is not None:
+            import pstats
+            self.profile.dump_stats(os.path.join(self.out_dir, 'profile.pstats'))
+            stats = pstats.Stats(self.profile, stream=report)
+            with open(os.path.join(self.out_dir, 'profile.collapsed'), 'w') as f:
+                for stack, count in collapsed_from_pstats(stats).most_common():
+                    f.write(f"{stack} {count}\n")
+            report.write('Top functions by cumulative time\n')
+            stats.sort_stats('cumulative').print_stats(n_top)
+        elif self.sampler.available:
+            self.sampler.write_collapsed(os.path.join(self.out_dir, 'profile.collapsed'))
+            n_samples = sum(self.sampler.stacks.values())
+            report.write(f"Top functions by sampled self time ({n_samples} samples, interval {self.sampler.interval} s)\n")
+            for function, count in self.sampler.top_functions(n_top):
+                report.write(f"{100*count/max(n_samples, 1):6.1f} %  {function}\n")
+            report.write('\n')
+        if self.memory_snapshot is not None:
+            report.write(f"Peak traced memory: {self.memory_peak/1024**2:.2f} MB\n")
+            report.write('Top allocation sites (memory allocated in profiled window and still alive at its end)\n')
+            for stat in self.memory_snapshot.statistics('lineno')[:n_top]:
+                report.write(f"{stat.size/1024**2:10.2f} MB  {stat.count:8d} blocks  {stat.traceback}\n")
+        path = os.path.join(self.out_dir, 'profile_report.txt')
+        with open(path, 'w') as f:
+            f.write(report.getvalue())
+        return path
@@ -2,8 +2,7 @@ for ini in 1 2 3 4 5 6 7 8 9 10
 do
 for noc in 1 2 3 4 5 6 7 8 9 10 15 25 50 100
 do
-    sed -i '$ d' submit_big.sh
-    echo "python3 main.py --dataset hcp --noc $noc --model_type parametric --maxiter_gibbs 100" >> submit_big.sh
-    bsub < submit_big.sh
+    # job script is submit_big.sh with its last line (the command) replaced (submit_big.sh itself is not modified)
+    sed '$ d' submit_big.sh | { cat; echo "python3 main.py --dataset hcp --noc $noc --model_type parametric --maxiter_gibbs 100 --use_cache True"; } | bsub
 done
 done
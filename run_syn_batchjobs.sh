@@ -1,15 +1,4 @@
-for ini in 1 2 3 4 5
-do
-for K in 2 5 10
-do
-for Nc_type in 'balanced' 'unbalanced'
-do
-for alpha in 0 0.1 0.2 0.3 0.4 0.5 0.6 0.7 0.8 0.9 0.98
-do
-    sed -i '$ d' submit_hpc.sh
-    echo "python3 main.py --dataset synthetic --maxiter_gibbs 100 --K $K --Nc_type $Nc_type --alpha $alpha --model_type parametric --noc 10" >> submit_hpc.sh
-    bsub < submit_hpc.sh
-done
-done
-done
-done
+# Submit all synthetic data experiments (grid in sweep_synthetic.json) as one batchjob running a local parameter sweep.
+# The job script is submit_hpc.sh with its last line (the command) replaced; submit_hpc.sh itself is not modified.
+# The job inherits the wall-time warning of submit_hpc.sh (-wa USR2): sweep.py then starts no new configurations and running ones stop after their current iteration.
+sed '$ d' submit_hpc.sh | { cat; echo "python3 sweep.py --grid sweep_synthetic.json --workers 5"; } | bsub
@@ -0,0 +1,366 @@
+import os
+import sys
+import json
+import socket
+import tempfile
+import resource
+from datetime import datetime
+import numpy as np
+
+# Small runtime utilities for experiment bookkeeping (run manifest and resource usage).
+# Only standard library + numpy is imported here, so it is cheap to import from main.py and model.py.
+
+MANIFEST_NAME = 'run.json' # name of the machine-readable run manifest written in each results folder
+METRICS_NAME = 'metrics.jsonl' # name of the file with one json line of results per iteration (see MetricsWriter, monitor.py)
+
+# permissions of files written by write-and-rename (tempfile.mkstemp creates files with mode 0600, np.save/open follow the umask);
+# the umask can only be read by setting it, so it is read once at import
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0o666 & ~_umask
+
+
+def _json_default(obj):
+    # convert numpy types (and other non-standard types) to something json can serialize
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return str(obj)
+
+
+def json_safe(obj):
+    # copy of obj with numpy types converted and non-finite floats (nan, inf, e.g. Rhat of short chains) replaced by None,
+    # so the json is valid for strict readers (jq, pandas.read_json)
+    if isinstance(obj, dict):
+        return {key: json_safe(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [json_safe(value) for value in obj]
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return json_safe(obj.tolist() if isinstance(obj, np.ndarray) else obj.item())
+    if isinstance(obj, float) and not np.isfinite(obj):
+        return None
+    return obj
+
+
+def write_json_atomic(path, data):
+    # Write data as json to path using write-and-rename, so a reader never sees a half-written file
+    ## INPUT
+    # path      path of json file
+    # data      json serializable dictionary (numpy types are converted, non-finite floats are written as null)
+    dir_name = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix='.'+os.path.basename(path)+'.', suffix='.tmp')
+    try:
+        os.fchmod(fd, FILE_MODE) # readable by others as a file written with open() (e.g. results on a shared volume)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(json_safe(data), f, indent=2, default=_json_default, allow_nan=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path) # atomic on POSIX when source and destination are on the same filesystem
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_manifest(run_dir):
+    # Read run manifest from results folder. Returns None if the folder has no (readable) manifest
+    path = os.path.join(run_dir, MANIFEST_NAME)
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def latest_sample_file(run_dir):
+    # Path of the last saved model_sample{iter}.npy in results folder (None if the run has not saved a sample)
+    iters = [int(name[len('model_sample'):-len('.npy')]) for name in os.listdir(run_dir)
+             if name.startswith('model_sample') and name.endswith('.npy') and name[len('model_sample'):-len('.npy')].isdigit()]
+    if len(iters) == 0:
+        return None
+    return os.path.join(run_dir, 'model_sample'+str(max(iters))+'.npy')
+
+
+def peak_rss_mb():
+    # peak resident set size of this process in MB
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': # bytes on macOS, kilobytes on Linux
+        return maxrss / 1024**2
+    return maxrss / 1024
+
+
+def current_rss_mb():
+    # current resident set size of this process in MB (peak resident set size where /proc is not available)
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def timestamp():
+    return datetime.now().isoformat(timespec='seconds')
+
+
+def new_manifest(exp_name, config, experiment):
+    # Initial manifest written when a run starts
+    ## INPUT
+    # exp_name      name of experiment (results subfolder)
+    # config        argparse config of the run
+    # experiment    dictionary with the experiment specification (same entries as log.txt)
+    return {'status': 'running',
+            'exp_name': exp_name,
+            'experiment': experiment,
+            'config': {key: value for key, value in vars(config).items() if isinstance(value, (str, int, float, bool, type(None)))},
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'job_id': os.environ.get('LSB_JOBID'), # LSF job id (None if not run through bsub)
+            'start_time': timestamp(),
+            'end_time': None,
+            'timings': {},
+            'iterations': 0,
+            'stop_reason': None,
+            'peak_rss_mb': None}
+
+
+def save_npy_atomic(path, obj):
+    # np.save using write-and-rename, so a reader (or a job killed while writing) never leaves a half-written file
+    dir_name = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix='.'+os.path.basename(path)+'.', suffix='.tmp')
+    try:
+        os.fchmod(fd, FILE_MODE) # same permissions as np.save (see FILE_MODE)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, obj, allow_pickle=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class AsyncWriter(object):
+    # Background thread that saves objects (atomically, see save_npy_atomic), so the sampler does not block on a slow (shared) filesystem.
+    # Objects are saved in the order they are submitted. Objects must not be modified after submission (submit a snapshot).
+    # The queue is bounded: save() blocks if the writer is max_queue objects behind, which bounds the memory held by pending snapshots.
+    # Only the latest keep_latest files written by the writer are kept (older ones are deleted), 0 keeps all files.
+    # Pending objects are written when the writer is closed, which also happens at interpreter exit (or with close_writers, used by
+    # processes that run many jobs, e.g. daemon.py and sweep.py workers, so writers of failed runs do not stay alive).
+
+    # Usage: writer = AsyncWriter(); writer.save(path, obj); ...; writer.close() (waits until everything is written)
+    
+    def __init__(self, max_queue=2, keep_latest=0):
+        import queue
+        import atexit
+        import threading
+        from collections import deque
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.keep_latest = keep_latest
+        self.written = deque() # paths of files written so far (oldest first)
+        self.error = None # first exception raised in the writer thread (re-raised in the sampler)
+        self.thread = threading.Thread(target=self._run, name='AsyncWriter', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+        _open_writers.add(self)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            path, obj, prune = item
+            try:
+                save_npy_atomic(path, obj)
+                if prune:
+                    self._prune(path)
+            except BaseException as e:
+                if self.error is None:
+                    self.error = e
+    
+    def _prune(self, path):
+        # remember written file and delete the oldest files beyond keep_latest
+        if path in self.written:
+            self.written.remove(path)
+        self.written.append(path)
+        while self.keep_latest > 0 and len(self.written) > self.keep_latest:
+            old_path = self.written.popleft()
+            if os.path.exists(old_path):
+                os.remove(old_path)
+    
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+    
+    def save(self, path, obj, prune=True):
+        # prune=False: file is not counted in (or deleted by) keep_latest
+        self._raise_error()
+        self.queue.put((path, obj, prune))
+
+    def close(self):
+        # wait until all submitted objects are written
+        import atexit
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        atexit.unregister(self.close)
+        _open_writers.discard(self)
+        self._raise_error()
+
+
+_open_writers = set() # AsyncWriters that have not been closed
+
+
+def close_writers():
+    # close all open AsyncWriters (e.g. of a run that failed before closing its writer), errors of the writers are printed
+    for writer in list(_open_writers):
+        try:
+            writer.close()
+        except Exception as e:
+            print('Error in writer of samples:', repr(e))
+
+
+class MetricsWriter(object):
+    # Appends records as json lines to a file (e.g. metrics.jsonl, one line per iteration) that can be followed while the run is going.
+    # Every line is flushed to the operating system when written, but only synced to disk (fsync) every fsync_every lines and
+    # when closed, since an fsync on a shared filesystem can take longer than a short iteration (0: only when closed).
+
+    # Usage: metrics = MetricsWriter(path, fsync_every=10); metrics.write({...}); ...; metrics.close()
+
+    def __init__(self, path, fsync_every=0):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.file = open(path, 'a')
+        self.unsynced = 0 # number of lines written since last fsync
+
+    def write(self, record):
+        self.file.write(json.dumps(json_safe(record), default=_json_default, allow_nan=False) + '\n')
+        self.file.flush()
+        self.unsynced += 1
+        if self.fsync_every > 0 and self.unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.file.flush()
+            self.sync()
+            self.file.close()
+
+
+############################################################### Threading configuration ###############################################################
+_blas_limits = None # keeps the threadpoolctl limits alive for the lifetime of the process
+
+def parse_cpu_list(cpu_list):
+    # parse cpu list string like '0-4,8,10-11' into a sorted list of cpu ids
+    cpus = set()
+    for part in cpu_list.split(','):
+        part = part.strip()
+        if len(part) == 0:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.update(range(int(start), int(end)+1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def numa_nodes():
+    # dictionary {numa node id: list of cpu ids} read from sysfs (empty if not available, e.g. on macOS)
+    nodes = {}
+    node_dir = '/sys/devices/system/node'
+    if os.path.isdir(node_dir):
+        for name in sorted(os.listdir(node_dir)):
+            if name.startswith('node') and name[4:].isdigit():
+                with open(os.path.join(node_dir, name, 'cpulist'), 'r') as f:
+                    nodes[int(name[4:])] = parse_cpu_list(f.read())
+    return nodes
+
+
+def available_cpus():
+    # cpus this process may run on, ordered by NUMA node so that consecutive blocks of cpus share a node
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    node_of = {cpu: node for node, node_cpus in numa_nodes().items() for cpu in node_cpus}
+    return sorted(cpus, key=lambda cpu: (node_of.get(cpu, 0), cpu))
+
+
+def default_num_threads():
+    # number of cores granted by LSF (bsub -n) if run as a batch job, otherwise number of available cpus
+    if os.environ.get('LSB_DJOB_NUMPROC'):
+        return int(os.environ['LSB_DJOB_NUMPROC'])
+    return len(available_cpus())
+
+
+def set_affinity(cpus):
+    # pin all threads of this process (including BLAS/numba threads that already exist) to the given cpus
+    for tid in os.listdir('/proc/self/task'):
+        try:
+            os.sched_setaffinity(int(tid), cpus)
+        except OSError: # thread exited in the meantime
+            pass
+
+
+def configure_threads(num_threads=None, blas_threads=None, cpu_list=None, chain_index=None):
+    # Configure parallelism of the sampler. Call before the model (numba) is imported.
+    ## INPUT
+    # num_threads       number of threads for numba kernels (spmatmul), default: default_num_threads()
+    # blas_threads      number of BLAS threads (numpy matrix products), default: num_threads
+    # cpu_list          cpus to pin the process to, e.g. '0-4' (default: no pinning unless chain_index is given)
+    # chain_index       index of this chain on a shared node; the chain is pinned to the chain_index'th block of num_threads cpus (blocks follow NUMA nodes)
+    
+    ## OUTPUT
+    # info              dictionary describing the effective parallelism (see parallelism_info)
+    global _blas_limits
+    if num_threads is None:
+        num_threads = default_num_threads()
+    if blas_threads is None:
+        blas_threads = num_threads
+    
+    # environment variables only affect libraries loaded after this point and child processes (numba reads NUMBA_NUM_THREADS when
+    # it is imported, but numpy and its BLAS are already loaded, so BLAS threads of this process are set with threadpoolctl below)
+    os.environ['NUMBA_NUM_THREADS'] = str(max(num_threads, int(os.environ.get('NUMBA_NUM_THREADS', 0))))
+    for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[var] = str(blas_threads)
+    
+    cpus = None
+    if cpu_list is not None:
+        cpus = parse_cpu_list(cpu_list)
+    elif chain_index is not None:
+        allowed = available_cpus()
+        start = (chain_index * num_threads) % len(allowed)
+        cpus = allowed[start:start + num_threads]
+    if cpus is not None:
+        if not hasattr(os, 'sched_setaffinity'):
+            print('Pinning to cpus is not supported on this platform')
+        else:
+            set_affinity(cpus)
+    
+    import numba
+    numba.set_num_threads(min(num_threads, numba.config.NUMBA_NUM_THREADS))
+    try:
+        from threadpoolctl import threadpool_limits
+        _blas_limits = threadpool_limits(limits=blas_threads, user_api='blas')
+    except ImportError:
+        print('threadpoolctl not installed (see speciale.yml): BLAS threads of this process are not limited (numpy is already loaded), only those of child processes')
+    return parallelism_info()
+
+
+def parallelism_info():
+    # effective parallelism of this process (numba threads, BLAS thread pools and cpu affinity)
+    import numba
+    info = {'numba_threads': numba.get_num_threads(),
+            'numba_max_threads': numba.config.NUMBA_NUM_THREADS,
+            'cpus': sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else None,
+            'numa_nodes': len(numa_nodes())}
+    try:
+        from threadpoolctl import threadpool_info
+        info['blas'] = [{'library': pool['internal_api'], 'num_threads': pool['num_threads']} for pool in threadpool_info() if pool['user_api'] == 'blas']
+    except ImportError:
+        info['blas'] = None
+    return info
@@ -0,0 +1,227 @@
+import numpy as np
+from scipy.special import gammaln
+
+# Subject-sharded Gibbs sweeps (main.py --subject_workers W): each worker process loads and owns the graphs of a contiguous
+# range of subjects and the corresponding slices n_link[:, :, s] of the number of links between clusters. The master
+# process (MultinomialSBM) holds the partition and never loads the graphs, so cohorts whose combined graphs do not fit in
+# one process can be used.
+#
+# The multinomial log likelihood of a block, log B(n_link[k, l, :]) = sum_s gammaln(n_link[k, l, s]) - gammaln(sum_s n_link[k, l, s]),
+# only couples subjects through the total number of links of the block. The master keeps these totals (computed from the
+# per-node link counts summed over subjects), and the workers return partial sums over their subjects of gammaln terms.
+# For each node, every worker returns vectors of length noc (one round trip per node):
+#   G_prev      gammaln sums of the column of the cluster the previous node was assigned to
+#   zai         number of links between the node and each cluster (summed over the worker's subjects)
+#   G_d         gammaln sums of the column of the node's cluster after removing the node
+#   G_cand      gammaln sums over all blocks of each candidate cluster (and a new cluster) with the node added
+# The master reduces them, samples the assignment, and sends it with the next node.
+# Split-merge moves and parcel-level graphs (links within nodes) are not supported in this mode.
+
+
+def load_subject_graphs(dataset, sources):
+    # Graphs of a subset of subjects
+    ## INPUT
+    # dataset   'hcp' (sources: list of .npz files, one per subject) or 'synthetic' (sources: list of (.npy file, subject index))
+    ## OUTPUT
+    # A         list of N x N scipy sparse csr matrices (hcp) or N x N x S_shard dense array (synthetic)
+    if dataset == 'hcp':
+        from scipy.sparse import load_npz, triu
+        A = []
+        for path in sources:
+            graph = load_npz(path).astype(dtype=np.int32)
+            A.append((triu(graph, 1) + triu(graph, 1).T).tocsr())
+        return A
+    elif dataset == 'synthetic':
+        path = sources[0][0]
+        data = np.load(path, mmap_mode='r') # only the subjects of this shard are read into memory
+        return np.array(data[:, :, [s for _, s in sources]])
+    raise ValueError('Subject sharding is not supported for dataset ' + str(dataset))
+
+
+class SubjectShard(object):
+    # State of one worker: graphs, partition (labels) and n_link (with eta0) of its subjects
+    def __init__(self, dataset, sources, model_type):
+        self.dataset = dataset
+        self.model_type = model_type
+        self.A = load_subject_graphs(dataset, sources)
+        if dataset == 'hcp':
+            self.N = self.A[0].shape[0]
+            self.S = len(self.A)
+        else:
+            self.N, _, self.S = self.A.shape
+        self.labels = None
+        self.n_link_base = None # n_link without eta0 of the last sweep (reused if the partition is only relabelled)
+        self.n_link = None
+        self.zai = None
+
+    def block_links(self, labels, noc):
+        # noc x noc x S_shard number of links between clusters, Z @ A_s @ Z.T (diagonal counts links within clusters twice)
+        from scipy.sparse import csr_matrix
+        Z = csr_matrix((np.ones(self.N), (labels, np.arange(self.N))), shape=(noc, self.N))
+        if self.dataset == 'hcp':
+            return np.stack([(Z @ As @ Z.T).toarray() for As in self.A], axis=2)
+        return np.stack([Z @ (Z @ self.A[:, :, s].T).T for s in range(self.S)], axis=2)
+
+    def base_links(self, labels, noc):
+        # n_link without eta0 of the partition (each link counted once), reused from the last sweep if the partition is the same up to relabelling
+        if self.n_link_base is not None and self.n_link_base.shape[0] == noc:
+            old_labels = np.full(noc, -1)
+            old_labels[labels] = self.labels # cluster of previous labelling for each new cluster
+            if old_labels.min() >= 0 and np.array_equal(old_labels[labels], self.labels) and len(np.unique(old_labels)) == noc:
+                return self.n_link_base[old_labels][:, old_labels]
+        n_link = self.block_links(labels, noc)
+        diag = np.arange(noc)
+        n_link[diag, diag, :] *= 0.5
+        return n_link
+
+    def begin(self, labels, noc, eta0):
+        # start of sweep: partial sums (over this shard's subjects) of gammaln(n_link) and n_link for all blocks
+        labels = np.array(labels)
+        self.n_link = self.base_links(labels, noc) + eta0 # (compared with the labels of the last sweep)
+        self.labels = labels
+        self.noc = noc
+        self.sumZ = np.bincount(self.labels, minlength=noc)
+        self.eta0 = eta0
+        self.zai = None
+        return np.sum(gammaln(self.n_link), axis=2), np.sum(self.n_link, axis=2)
+
+    def _zai(self, i):
+        # noc x S_shard number of links between node i and each cluster
+        zai = np.zeros((self.noc, self.S))
+        if self.dataset == 'hcp':
+            for s, As in enumerate(self.A):
+                start, end = As.indptr[i], As.indptr[i+1]
+                zai[:, s] = np.bincount(self.labels[As.indices[start:end]], weights=As.data[start:end], minlength=self.noc)
+        else:
+            for s in range(self.S):
+                zai[:, s] = np.bincount(self.labels, weights=self.A[:, i, s], minlength=self.noc)
+        return zai
+
+    def _assign(self, i, ind):
+        # assign node i to cluster ind (ind == noc opens a new cluster), returns gammaln sums of column ind
+        if ind >= self.noc:
+            n_link = np.empty((self.noc+1, self.noc+1, self.S))
+            n_link[:self.noc, :self.noc] = self.n_link
+            n_link[self.noc, :, :] = self.eta0
+            n_link[:, self.noc, :] = self.eta0
+            self.n_link = n_link
+            self.zai = np.concatenate((self.zai, np.zeros((1, self.S))), axis=0)
+            self.sumZ = np.append(self.sumZ, 0)
+            self.noc += 1
+        self.labels[i] = ind
+        self.sumZ[ind] += 1
+        self.n_link[:, ind, :] += self.zai
+        self.n_link[ind, :, :] = self.n_link[:, ind, :]
+        return np.sum(gammaln(self.n_link[:, ind, :]), axis=1)
+
+    def node(self, i, prev):
+        # assign previous node (prev = (node, cluster) or None), remove node i from its cluster and score candidate clusters
+        G_prev = self._assign(*prev) if prev is not None else None
+        zai = self._zai(i)
+        zai_sum = np.sum(zai, axis=1) # before the node's cluster is (possibly) removed, the master removes it from its own copies
+        d = self.labels[i]
+        self.sumZ[d] -= 1
+        self.n_link[:, d, :] -= zai
+        self.n_link[d, :, :] = self.n_link[:, d, :]
+        self.labels[i] = -1
+        G_d = None
+        if self.sumZ[d] == 0: # singleton cluster is removed
+            v = np.arange(self.noc) != d
+            self.n_link = self.n_link[v][:, v]
+            zai = zai[v]
+            self.sumZ = self.sumZ[v]
+            self.labels[self.labels > d] -= 1
+            self.noc -= 1
+        else:
+            G_d = np.sum(gammaln(self.n_link[:, d, :]), axis=1)
+        G_cand = np.sum(gammaln(self.n_link + zai[:, np.newaxis, :]), axis=(0, 2))
+        if self.model_type == 'nonparametric':
+            G_cand = np.append(G_cand, np.sum(gammaln(zai + self.eta0)))
+        self.zai = zai
+        return G_prev, zai_sum, G_d, G_cand
+
+    def finish(self, prev):
+        # end of sweep: assign last node, keep and return n_link without eta0
+        G_prev = self._assign(*prev) if prev is not None else None
+        self.n_link_base = self.n_link - self.eta0
+        return G_prev, self.n_link_base
+
+
+def _worker(conn, dataset, sources, model_type):
+    shard = SubjectShard(dataset, sources, model_type)
+    conn.send((shard.N, shard.S))
+    while True:
+        message = conn.recv()
+        if message[0] == 'close':
+            break
+        try:
+            result = getattr(shard, message[0])(*message[1:])
+        except Exception as e:
+            result = e
+        conn.send(result)
+    conn.close()
+
+
+class ShardedSubjects(object):
+    # Master side of the subject-sharded workers
+
+    # Input:
+    # dataset       'hcp' or 'synthetic'
+    # sources       list with the source of each subject (see load_subject_graphs), in subject order
+    # n_workers     number of worker processes (subjects are split in contiguous ranges)
+    # model_type    'parametric' or 'nonparametric'
+    def __init__(self, dataset, sources, n_workers, model_type):
+        import multiprocessing
+        context = multiprocessing.get_context('spawn') # workers do not inherit the numba/BLAS thread pools of the master
+        n_workers = min(n_workers, len(sources))
+        self.subjects = np.array_split(np.arange(len(sources)), n_workers)
+        self.conns = []
+        self.processes = []
+        for subjects in self.subjects:
+            conn, child_conn = context.Pipe()
+            process = context.Process(target=_worker, args=(child_conn, dataset, [sources[s] for s in subjects], model_type), daemon=True)
+            process.start()
+            self.conns.append(conn)
+            self.processes.append(process)
+        info = [conn.recv() for conn in self.conns]
+        self.N = info[0][0]
+        self.S = sum(S for _, S in info)
+
+    def call(self, method, *args, per_worker=None):
+        # call method on all workers (per_worker: list of extra arguments of each worker) and return their results
+        for w, conn in enumerate(self.conns):
+            conn.send((method,) + args + (tuple(per_worker[w]) if per_worker is not None else ()))
+        results = [conn.recv() for conn in self.conns]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def block_links(self, Z):
+        # noc x noc x S number of links between clusters of partition matrix Z (Z @ A_s @ Z.T for each subject)
+        results = self.call('block_links', np.argmax(Z, axis=0), Z.shape[0])
+        return np.concatenate(results, axis=2)
+
+    def begin(self, labels, noc, eta0):
+        results = self.call('begin', labels, noc, per_worker=[(eta0[subjects],) for subjects in self.subjects])
+        return sum(G for G, _ in results), sum(T for _, T in results)
+
+    def node(self, i, prev):
+        results = self.call('node', i, prev)
+        G_prev = sum(r[0] for r in results) if prev is not None else None
+        G_d = sum(r[2] for r in results) if results[0][2] is not None else None
+        return G_prev, sum(r[1] for r in results), G_d, sum(r[3] for r in results)
+
+    def finish(self, prev):
+        results = self.call('finish', prev)
+        G_prev = sum(r[0] for r in results) if prev is not None else None
+        return G_prev, np.concatenate([r[1] for r in results], axis=2)
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(('close',))
+            except OSError:
+                pass
+        for process in self.processes:
+            process.join(timeout=10)
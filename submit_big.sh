@@ -7,6 +7,8 @@
 #BSUB -o out_big_%J.txt
 #BSUB -e err_big_%J.txt
 #BSUB -W 168:00
+#BSUB -wa USR2
+#BSUB -wt 30
 #BSUB -n 5
 #BSUB -R "span[hosts=1]"
 
@@ -14,6 +14,9 @@
 #BSUB -M 3GB
 ### -- set walltime limit: hh:mm -- 
 #BSUB -W 48:00 
+### -- send SIGUSR2 30 minutes before the walltime limit (main.py then stops training and saves) -- 
+#BSUB -wa USR2
+#BSUB -wt 30
 ### -- set the email address -- 
 # please uncomment the following line and put in your e-mail address,
 # if you want to receive e-mail notifications on a non-default address
@@ -0,0 +1,156 @@
+import os
+import sys
+import signal
+import json
+import time
+import hashlib
+import argparse
+import itertools
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# Parameter sweep of main.py runs in a local process pool (e.g. all synthetic experiments in one LSF job).
+# Each worker process imports the model (and compiles the numba kernels) once and runs many configurations, so small
+# synthetic runs do not pay interpreter, import and compilation startup each time. Every run writes the same results
+# folder as 'python main.py ...'. Configurations that already have a finished run (run.json with the same sweep_key) are skipped.
+#
+# Usage: python sweep.py --grid sweep_synthetic.json --workers 5 [--main_dir ...] [--dry_run]
+#
+# Grid file (json):
+# base      main.py arguments shared by all runs, e.g. {"dataset": "synthetic", "model_type": "parametric", "noc": 10}
+# grid      main.py arguments to sweep over (all combinations), e.g. {"K": [2, 5, 10], "Nc_type": ["balanced", "unbalanced"]}
+# repeats   number of runs of each combination (different random initializations, default 1)
+#
+# SIGUSR2/SIGTERM (LSF warning before the wall-time kill, bsub -wa USR2, sent to all processes of the job): no new configurations
+# are started, running configurations stop after their current iteration (main.py) and the sweep exits when they are saved.
+# Skipped configurations are run by the next submission of the same sweep.
+
+
+def expand_grid(spec):
+    # list of main.py configurations (dictionaries) of a grid specification, each with a unique sweep_key
+    base = spec.get('base', {})
+    grid = spec.get('grid', {})
+    keys = list(grid.keys())
+    configs = []
+    for values in itertools.product(*[grid[key] for key in keys]):
+        for repeat in range(spec.get('repeats', 1)):
+            config = dict(base)
+            config.update(zip(keys, values))
+            config['sweep_key'] = sweep_key(config, repeat)
+            configs.append(config)
+    return configs
+
+
+def sweep_key(config, repeat):
+    # identifier of a configuration (and repeat) stored in run.json of its run
+    text = json.dumps({'config': config, 'repeat': repeat}, sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def finished_keys(main_dir, datasets):
+    # sweep keys of finished runs in the results folders of the given datasets
+    from run_utils import read_manifest
+    keys = set()
+    for dataset in datasets:
+        results_dir = os.path.join(main_dir, 'results', dataset)
+        if not os.path.isdir(results_dir):
+            continue
+        for name in os.listdir(results_dir):
+            manifest = read_manifest(os.path.join(results_dir, name))
+            if manifest is None or manifest['status'] != 'finished' or manifest.get('stop_reason') == 'time_limit': # (runs stopped by the wall-time warning are run again)
+                continue
+            if manifest['config'].get('sweep_key') is not None:
+                keys.add(manifest['config']['sweep_key'])
+    return keys
+
+
+def init_worker():
+    # worker processes ignore SIGUSR2/SIGTERM between runs (main.py handles them during a run)
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def run_config(config_dict, log_dir):
+    # run main.py with the given arguments in this (worker) process, output is written to log_dir/<sweep_key>.out
+    import main as main_module # imported once per worker process
+    from run_utils import close_writers
+    config = main_module.get_parser().parse_args([])
+    for key, value in config_dict.items():
+        if not hasattr(config, key):
+            raise ValueError('Unknown main.py argument in grid: ' + key)
+        setattr(config, key, value)
+    t0 = time.time()
+    with open(os.path.join(log_dir, config_dict['sweep_key']+'.out'), 'w') as f, contextlib.redirect_stdout(f), contextlib.redirect_stderr(f):
+        try:
+            main_module.main(config)
+            status = 'finished'
+        except SystemExit as e: # SIGTERM outside of training (see main.terminate)
+            status = 'terminated: ' + repr(e)
+        except Exception as e:
+            print(repr(e))
+            status = 'failed: ' + repr(e)
+        finally:
+            close_writers() # (writer of a run that failed before closing it)
+            init_worker()
+    return config_dict['sweep_key'], status, time.time() - t0
+
+
+def main(args):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    with open(args.grid, 'r') as f:
+        spec = json.load(f)
+    configs = expand_grid(spec)
+    for config in configs:
+        config['main_dir'] = args.main_dir
+        config.setdefault('num_threads', args.threads_per_worker)
+    done = finished_keys(args.main_dir, set(config.get('dataset', 'synthetic') for config in configs))
+    todo = [config for config in configs if config['sweep_key'] not in done]
+    print(f"{len(configs)} configurations, {len(configs) - len(todo)} already finished, {len(todo)} to run with {args.workers} workers")
+    if args.dry_run:
+        for config in todo:
+            print(config)
+        return
+
+    log_dir = args.log_dir or os.path.join(args.main_dir, 'results', 'sweep_logs')
+    os.makedirs(log_dir, exist_ok=True)
+    n_failed = 0
+    n_done = 0
+    stop_signal = None
+    def request_stop(signum, frame):
+        nonlocal stop_signal
+        stop_signal = signum
+        print('Received signal', signum, '- not starting new configurations, waiting for running ones', flush=True)
+    signal.signal(signal.SIGUSR2, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+    
+    # configurations are submitted when a worker is free (none are queued in the pool, so none start after a stop signal)
+    pending = iter(todo)
+    futures = {}
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker) as executor:
+        while True:
+            while stop_signal is None and len(futures) < args.workers:
+                config = next(pending, None)
+                if config is None:
+                    break
+                futures[executor.submit(run_config, config, log_dir)] = config
+            if len(futures) == 0:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                config = futures.pop(future)
+                key, status, elapsed = future.result()
+                n_done += 1
+                n_failed += status != 'finished'
+                print(f"[{n_done}/{len(todo)}] {key} {status} ({elapsed:.1f} s)", {k: v for k, v in config.items() if k in spec.get('grid', {})}, flush=True)
+    print(f"Sweep done: {n_done - n_failed} finished, {n_failed} failed, {len(todo) - n_done} not started (output in {log_dir})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--grid', type=str, required=True, help='json file with grid specification (base, grid, repeats)')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('LSB_DJOB_NUMPROC', os.cpu_count())), help='number of worker processes (default: number of LSF slots)')
+    parser.add_argument('--threads_per_worker', type=int, default=1, help='numba/BLAS threads of each run (unless num_threads is given in the grid)')
+    parser.add_argument('--main_dir', type=str, default='/work3/s174162/speciale/', help='main directory (data and results)')
+    parser.add_argument('--log_dir', type=str, default=None, help='folder for output of each run (default: main_dir/results/sweep_logs)')
+    parser.add_argument('--dry_run', action='store_true', help='only list configurations that would be run')
+    main(parser.parse_args())